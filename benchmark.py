@@ -0,0 +1,209 @@
+"""
+图片处理微基准
+对比 ImageProcessor 快速路径与旧实现的耗时和内存拷贝次数
+
+用法：
+    python benchmark.py fastpath --count 12 --size 1920x1080
+    python benchmark.py resample --size 3840x2160
+    python benchmark.py tiers
+    python benchmark.py overlap --count 12
+"""
+
+import io
+import os
+import time
+import argparse
+import tempfile
+
+from PIL import Image, ImageDraw
+
+from image_processor import ImageProcessor, RESAMPLERS, create_resampler
+
+
+def make_screenshots(count, width, height):
+    """生成一批同尺寸的模拟截图"""
+    images = []
+    for i in range(count):
+        img = Image.linear_gradient('L').resize((width, height))
+        images.append(Image.merge('RGB', (img, img.rotate(90 * (i % 4)).resize((width, height)), img)))
+    return images
+
+
+def make_scrolling_screens(count, width, body, step, header=40, footer=30):
+    """生成一组模拟滚动截图：固定的页眉和彩色页脚，中间是每屏向下滚动 step 行的文字内容
+
+    彩色页脚在 JPEG 色度抽样下会渗到相邻几行，用来检查有损截图的重叠识别。
+    """
+    page = Image.new('RGB', (width, body + step * (count - 1)), (255, 255, 255))
+    draw = ImageDraw.Draw(page)
+    for i, y in enumerate(range(4, page.height - 16, 22)):
+        draw.text((12 + (i * 37) % 90, y), f"line {i:04d} " + "lorem ipsum " * (i % 5 + 1), fill=(20, 20, 20))
+    screens = []
+    for i in range(count):
+        screen = Image.new('RGB', (width, header + body + footer), (235, 235, 235))
+        ImageDraw.Draw(screen).rectangle((0, header + body, width, header + body + footer), fill=(200, 40, 40))
+        screen.paste(page.crop((0, i * step, width, i * step + body)), (0, header))
+        screens.append(screen)
+    return screens
+
+
+def legacy_render(images, layout, bg_color):
+    """旧实现：每张图都先 convert('RGB') 再 LANCZOS 缩放"""
+    out_w, out_h, placements = layout
+    out = Image.new('RGB', (out_w, out_h), bg_color)
+    for idx, x, y, w, h in placements:
+        img = images[idx].convert('RGB')
+        out.paste(img.resize((w, h), Image.Resampling.LANCZOS), (x, y))
+    return out
+
+
+def count_copies(images, layout):
+    """统计快速路径省掉的转换和缩放拷贝"""
+    saved = 0
+    for idx, _, _, w, h in layout[2]:
+        img = images[idx]
+        saved += ImageProcessor.normalize_mode(img) is img
+        saved += img.size == (w, h)
+    return saved
+
+
+def best_of(func, repeat):
+    """多次运行取最短耗时"""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def bench_fastpath(args):
+    """同尺寸截图批次的拼接：旧实现 vs 快速路径"""
+    width, height = (int(v) for v in args.size.lower().split('x'))
+    images = make_screenshots(args.count, width, height)
+    sizes = [img.size for img in images]
+    cases = [
+        ("grid", ImageProcessor.plan_stitch_layout(sizes, "grid", 0, 0, 10)),
+        ("horizontal", ImageProcessor.plan_stitch_layout(sizes, "horizontal", spacing=10)),
+        ("vertical", ImageProcessor.plan_stitch_layout(sizes, "vertical", spacing=10)),
+    ]
+    bg = (255, 255, 255)
+    print(f"{args.count} 张 {width}x{height} 截图，取 {args.repeat} 次最短耗时")
+    print(f"{'模式':<12}{'旧实现':>10}{'快速路径':>10}{'加速':>8}{'省掉拷贝':>10}")
+    for name, layout in cases:
+        old = best_of(lambda: legacy_render(images, layout, bg), args.repeat)
+        new = best_of(lambda: ImageProcessor.render_layout(images, layout, bg), args.repeat)
+        saved = count_copies(images, layout)
+        print(f"{name:<12}{old * 1000:>8.1f}ms{new * 1000:>8.1f}ms{old / new:>7.1f}x{saved:>6}/{2 * len(images)}")
+
+
+def bench_resample(args):
+    """各重采样后端在常用缩小比例下的耗时（lanczos 在各后端都由 Pillow 完成，默认比较 box）"""
+    width, height = (int(v) for v in args.size.lower().split('x'))
+    img = make_screenshots(1, width, height)[0]
+    targets = [
+        ("1/2", (width // 2, height // 2)),
+        ("1/3", (width // 3, height // 3)),
+        ("1/4", (width // 4, height // 4)),
+        ("1/8", (width // 8, height // 8)),
+        ("缩略图180", ImageProcessor.thumbnail(Image.new('L', img.size), (180, 180)).size),
+    ]
+    backends = []
+    for name, cls in RESAMPLERS.items():
+        try:
+            backends.append(cls())
+        except ImportError:
+            print(f"跳过 {name}：未安装")
+    print(f"源图 {width}x{height}，滤镜 {args.method}，取 {args.repeat} 次最短耗时")
+    print(f"{'比例':<10}" + "".join(f"{b.name:>14}" for b in backends))
+    for label, size in targets:
+        times = [best_of(lambda: b.resize(img, size, args.method), args.repeat) for b in backends]
+        print(f"{label:<10}" + "".join(f"{t * 1000:>12.1f}ms" for t in times))
+
+
+def bench_tiers(args):
+    """交互档位与导出档位在缩略图、预览上的耗时
+
+    「文件」用例从 JPEG 文件开始计时（包括解码），与界面生成缩略图的实际路径一致。
+    """
+    width, height = (int(v) for v in args.size.lower().split('x'))
+    img = make_screenshots(1, width, height)[0]
+    fd, path = tempfile.mkstemp(suffix='.jpg')
+    os.close(fd)
+    img.save(path, quality=90)
+    cases = [
+        ("列表缩略图 60", lambda tier: ImageProcessor.thumbnail(img, (60, 60), tier)),
+        ("网格缩略图 180", lambda tier: ImageProcessor.thumbnail(img, (180, 180), tier)),
+        ("画布预览 800", lambda tier: ImageProcessor.thumbnail(img, (800, 600), tier)),
+        ("文件 缩略图 180", lambda tier: ImageProcessor.open_thumbnail(path, (180, 180), tier)),
+        ("文件 预览 800", lambda tier: ImageProcessor.open_thumbnail(path, (800, 600), tier)),
+    ]
+    ImageProcessor.resampler = create_resampler(args.backend)
+    tiers = ImageProcessor.resample_tiers
+    print(f"源图 {width}x{height}，后端 {ImageProcessor.resampler.name}，取 {args.repeat} 次最短耗时")
+    print(f"{'操作':<14}{'导出 ' + tiers['export']:>14}{'交互 ' + tiers['interactive']:>14}{'加速':>8}")
+    for label, func in cases:
+        export = best_of(lambda: func('export'), args.repeat)
+        interactive = best_of(lambda: func('interactive'), args.repeat)
+        print(f"{label:<14}{export * 1000:>12.1f}ms{interactive * 1000:>12.1f}ms{export / interactive:>7.1f}x")
+    os.remove(path)
+
+
+def bench_overlap(args):
+    """滚动截图去重叠：无损与不同 JPEG 质量下拼出的高度应与预期一致"""
+    width, body, step = 480, 700, args.step
+    screens = make_scrolling_screens(args.count, width, body, step)
+    expected = 40 + 30 + body + step * (args.count - 1)
+    print(f"{args.count} 屏，每屏滚动 {step} 行，预期高度 {expected}px")
+    print(f"{'格式':<10}{'高度':>8}{'耗时':>10}{'结果':>6}")
+    failed = 0
+    for label, fmt, quality in [("PNG", 'PNG', None), ("JPEG q95", 'JPEG', 95),
+                                ("JPEG q85", 'JPEG', 85), ("JPEG q75", 'JPEG', 75)]:
+        images = []
+        for screen in screens:
+            img = Image.open(io.BytesIO(ImageProcessor.encode_image(screen, fmt, quality or 95)))
+            img.load()
+            images.append(img)
+        start = time.perf_counter()
+        out = ImageProcessor.stitch_images_vertical_overlap(images)
+        elapsed = time.perf_counter() - start
+        ok = out.height == expected
+        failed += not ok
+        print(f"{label:<10}{out.height:>6}px{elapsed * 1000:>8.1f}ms{'通过' if ok else '失败':>6}")
+    if failed:
+        raise SystemExit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="图片处理微基准")
+    sub = parser.add_subparsers(dest='command', required=True)
+    
+    fastpath = sub.add_parser('fastpath', help="同尺寸截图拼接的快速路径")
+    fastpath.add_argument('--count', type=int, default=12)
+    fastpath.add_argument('--size', default='1920x1080')
+    fastpath.add_argument('--repeat', type=int, default=3)
+    fastpath.set_defaults(func=bench_fastpath)
+    
+    resample = sub.add_parser('resample', help="各重采样后端的缩小耗时")
+    resample.add_argument('--size', default='3840x2160')
+    resample.add_argument('--repeat', type=int, default=3)
+    resample.add_argument('--method', default='box', choices=sorted(RESAMPLERS['pillow'].METHODS))
+    resample.set_defaults(func=bench_resample)
+    
+    tiers = sub.add_parser('tiers', help="交互档位与导出档位的耗时")
+    tiers.add_argument('--size', default='3840x2160')
+    tiers.add_argument('--repeat', type=int, default=3)
+    tiers.add_argument('--backend', default='pillow')
+    tiers.set_defaults(func=bench_tiers)
+    
+    overlap = sub.add_parser('overlap', help="滚动截图去重叠的正确性（含 JPEG）与耗时")
+    overlap.add_argument('--count', type=int, default=12)
+    overlap.add_argument('--step', type=int, default=450)
+    overlap.set_defaults(func=bench_overlap)
+    
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -6,10 +6,22 @@
 """
 
 import os
+import sys
 import math
+import json
+import time
+STARTUP_T0 = time.perf_counter()  # 启动计时起点（--profile-startup）
+import socket
+import hashlib
+import tempfile
+import threading
+import struct
+import zlib
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
 import tkinter as tk
 from tkinter import filedialog, messagebox
-from PIL import Image, ImageTk, ImageDraw
+from PIL import Image, ImageFile, ImageTk
 import customtkinter as ctk
 
 # 拖拽功能暂时禁用（与CustomTkinter存在兼容性问题）
@@ -33,117 +45,3316 @@ DnDCTk = ctk.CTk
 #     DnDCTk = ctk.CTk
 #     print(f"提示：拖拽功能不可用 ({e})。可使用按钮添加图片。")
 
+# 默认配置，可由程序目录下的 config.json 按节覆盖
+DEFAULT_CONFIG = {
+    "server": {
+        "host": "127.0.0.1",
+        "port": 8765,
+        "workers": 4,               # 同时处理的请求数
+        "queue_size": 16,           # 允许排队的请求数，超出后直接返回 503
+        "max_queue_wait": 10.0,     # 排队等待超过该秒数返回 503
+        "request_timeout": 60.0,    # 单个请求处理超过该秒数返回 504
+        "max_body_mb": 200,         # 请求体大小上限
+    },
+    "decode_cache": {
+        "enabled": False,           # 反复处理同一批大图时开启
+        "dir": "",                  # 缓存目录，留空使用系统临时目录
+        "max_mb": 4096,             # 缓存容量上限，超出后淘汰最久未用的
+    },
+    "resample": {
+        "backend": "pillow",        # pillow / opencv / auto；OpenCV 需显式开启，auto 在已安装时使用 OpenCV
+        "tiers": {                  # 各质量档位使用的滤镜：lanczos / bilinear / box / reduce / nearest
+            "export": "lanczos",        # 导出：拼接、瓦片
+            "interactive": "reduce",    # 交互：缩略图、预览（先整数倍缩小再双线性）
+            "zoom": "nearest",          # 预览放大超过 1:1，保证能看清每个源像素
+        },
+    },
+    "dedupe": {
+        "radius": 6,                # 感知哈希汉明距离不超过该值视为相似（0~64）
+        "cache": "",                # 哈希缓存数据库，留空使用系统临时目录
+    },
+    "memory": {
+        "budget_mb": 2048,          # 并行批处理同时解码的图片总内存上限（按图片头估算）
+    },
+    "watch": {
+        "settle_seconds": 2.0,      # 文件大小和修改时间保持不变超过该秒数才视为写入完成
+        "poll_interval": 1.0,       # 扫描输入目录的间隔
+        "batch_max": 64,            # 突发到达时每批并行处理的最大张数
+        "max_retries": 3,           # 读取失败（文件被占用、内容不完整）时的重试次数
+    },
+}
+
+
+def load_config(path=None):
+    """读取配置文件并与默认配置合并"""
+    import copy
+    config = copy.deepcopy(DEFAULT_CONFIG)
+    if path is None:
+        base = os.path.dirname(sys.executable if getattr(sys, 'frozen', False) else os.path.abspath(__file__))
+        path = os.path.join(base, 'config.json')
+    if os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as f:
+            user_config = json.load(f)
+        for section, values in user_config.items():
+            if isinstance(values, dict) and isinstance(config.get(section), dict):
+                config[section].update(values)
+            else:
+                config[section] = values
+    return config
+
+
+def imap_bounded(fn, items, workers=None, window=None, governor=None):
+    """在线程池中并行执行 fn(item)，按输入顺序逐个产出结果
+
+    同时提交的任务数不超过 window（默认工作线程数的两倍），已完成但未取走的结果也计入其中，
+    因此无论输入有多少项，内存中只保留有限个结果。items 为图片路径时可传入 MemoryGovernor，
+    提交前按图片头估算解码内存，超出预算时等待正在执行的任务释放。
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from collections import deque
+    
+    workers = workers or os.cpu_count() or 1
+    window = window or workers * 2
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        try:
+            for item in items:
+                if governor is None:
+                    pending.append(pool.submit(fn, item))
+                else:
+                    cost = governor.admit(item)
+                    pending.append(pool.submit(governor.run, cost, fn, item))
+                if len(pending) >= window:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            # 提前中止（出错或取消）时丢弃尚未开始的任务
+            for f in pending:
+                f.cancel()
+
+
+# ==================== 重采样后端 ====================
+
+class PillowResampler:
+    """Pillow 重采样（安装了 pillow-simd 时自动使用其 SIMD 实现）"""
+    
+    METHODS = {
+        'lanczos': Image.Resampling.LANCZOS,
+        'bilinear': Image.Resampling.BILINEAR,
+        'box': Image.Resampling.BOX,
+        'reduce': Image.Resampling.BILINEAR,
+        'nearest': Image.Resampling.NEAREST,
+    }
+    
+    def __init__(self):
+        import PIL
+        # pillow-simd 的版本号形如 9.0.0.post1
+        self.name = 'pillow-simd' if '.post' in PIL.__version__ else 'pillow'
+    
+    def resize(self, img, size, method='lanczos', box=None):
+        """缩放图片（box 为源图中参与缩放的区域）"""
+        if method == 'reduce':
+            # 先按整数倍快速缩小，再用双线性补齐剩余比例
+            return img.resize(size, self.METHODS[method], box=box, reducing_gap=2.0)
+        return img.resize(size, self.METHODS[method], box=box)
+
+
+class OpenCVResampler(PillowResampler):
+    """OpenCV 重采样：只加速交互档位常用的 box（缩小用 INTER_AREA）和 bilinear（INTER_LINEAR）
+
+    lanczos 始终交给 Pillow，导出像素与 Pillow 后端逐字节一致，不因是否安装 OpenCV 而变化。
+    """
+    
+    name = 'opencv'
+    
+    def __init__(self):
+        import cv2
+        import numpy
+        self.cv2 = cv2
+        self.np = numpy
+    
+    def resize(self, img, size, method='lanczos', box=None):
+        """缩放图片"""
+        # RGBA 交给 Pillow，按预乘透明度缩放避免边缘发黑；
+        # lanczos 用于导出，reduce / nearest 在 Pillow 中本身很快，省掉与 numpy 之间的拷贝
+        if box is not None or img.mode not in ('RGB', 'RGBX', 'L') or method not in ('box', 'bilinear'):
+            return super().resize(img, size, method, box)
+        if method == 'bilinear':
+            interp = self.cv2.INTER_LINEAR
+        elif size[0] < img.width and size[1] < img.height:
+            interp = self.cv2.INTER_AREA
+        else:
+            return super().resize(img, size, method, box)
+        arr = self.cv2.resize(self.np.asarray(img), size, interpolation=interp)
+        if img.mode == 'RGBX':
+            arr = arr[:, :, :3]
+        return Image.fromarray(arr)
+
+
+RESAMPLERS = {
+    'pillow': PillowResampler,
+    'opencv': OpenCVResampler,
+}
+
+
+def create_resampler(backend='pillow'):
+    """按名称创建重采样后端；指定的后端未安装时退回 Pillow"""
+    names = ['opencv', 'pillow'] if backend == 'auto' else [backend, 'pillow']
+    for name in names:
+        try:
+            return RESAMPLERS[name]()
+        except (ImportError, KeyError):
+            continue
+
 
 class ImageProcessor:
     """图像处理逻辑类"""
     
+    decode_cache = None  # 可选的解码缓存（DecodeCache），由 configure() 设置
+    resampler = None     # 重采样后端，由 configure() 设置，未配置时首次缩放使用 Pillow
+    resample_tiers = dict(DEFAULT_CONFIG['resample']['tiers'])  # 质量档位 -> 滤镜
+    dedupe = dict(DEFAULT_CONFIG['dedupe'])  # 相似图片检测参数
+    memory = None        # 批处理内存调度（MemoryGovernor），由 configure() 设置
+    ALPHA_FORMATS = ('PNG', 'WEBP', 'TIFF')  # 支持透明通道的输出格式
+    # 解码 TIFF 像素所需的标签，区域解码时复制到只含相交瓦片的临时 TIFF 中
+    TIFF_DECODE_TAGS = (258, 259, 262, 266, 277, 284, 317, 320, 338, 339, 347, 529, 530, 532)
+    
+    @staticmethod
+    def configure(config):
+        """根据配置初始化可选功能"""
+        cache = config.get('decode_cache', {})
+        if cache.get('enabled'):
+            cache_dir = cache.get('dir') or os.path.join(tempfile.gettempdir(), 'image_processor_decode_cache')
+            ImageProcessor.decode_cache = DecodeCache(cache_dir, int(cache.get('max_mb', 4096)) * 1024 * 1024)
+        else:
+            ImageProcessor.decode_cache = None
+        resample = config.get('resample', {})
+        ImageProcessor.resampler = create_resampler(resample.get('backend', DEFAULT_CONFIG['resample']['backend']))
+        tiers = dict(DEFAULT_CONFIG['resample']['tiers'])
+        tiers.update(resample.get('tiers', {}))
+        for tier, method in tiers.items():
+            if method not in PillowResampler.METHODS:
+                raise ValueError(f"质量档位 {tier} 的滤镜无效：{method}")
+        ImageProcessor.resample_tiers = tiers
+        ImageProcessor.dedupe = dict(DEFAULT_CONFIG['dedupe'], **config.get('dedupe', {}))
+        memory = dict(DEFAULT_CONFIG['memory'], **config.get('memory', {}))
+        budget = int(memory['budget_mb']) * 1024 * 1024
+        ImageProcessor.memory = MemoryGovernor(budget)
+    
+    @staticmethod
+    def resize(img, size, tier='export', box=None):
+        """使用当前重采样后端按质量档位缩放图片"""
+        if ImageProcessor.resampler is None:
+            ImageProcessor.resampler = create_resampler()
+        return ImageProcessor.resampler.resize(img, size, ImageProcessor.resample_tiers[tier], box)
+    
+    @staticmethod
+    def thumbnail(img, max_size, tier='interactive'):
+        """等比缩小到不超过 max_size（不放大），返回新图片
+
+        img 也可以是刚打开、尚未解码的图片：交互档位下 JPEG 先在 DCT 阶段按 1/2~1/8 缩小解码，
+        导出档位仍完整解码以保证质量。
+        """
+        scale = min(max_size[0] / img.width, max_size[1] / img.height, 1.0)
+        size = (max(1, round(img.width * scale)), max(1, round(img.height * scale)))
+        if isinstance(img, ImageFile.ImageFile) and img.tile:
+            if tier == 'interactive':
+                img.draft('RGB', size)
+            img.load()
+            img = ImageProcessor.normalize_mode(img)
+        if size == img.size:
+            return img
+        return ImageProcessor.resize(img, size, tier)
+    
+    @staticmethod
+    def normalize_mode(img):
+        """统一为 RGB / RGBA / L；已经是这些模式时原样返回，不做转换拷贝"""
+        if img.mode in ('RGB', 'RGBA', 'L'):
+            return img
+        if img.mode in ('LA', 'PA') or (img.mode == 'P' and 'transparency' in img.info):
+            return img.convert('RGBA')
+        return img.convert('RGB')
+    
+    @staticmethod
+    def source_file(path):
+        """打开输入文件；「压缩包::成员」形式的路径直接从压缩包中读取，不解压到磁盘"""
+        archive, member = ArchiveReader.split(path)
+        if member is None:
+            return open(path, 'rb')
+        return ArchiveReader.get(archive).open(member)
+    
+    @staticmethod
+    def source_stat(path):
+        """输入文件的大小和修改时间（压缩包成员取成员自身的记录）"""
+        archive, member = ArchiveReader.split(path)
+        if member is None:
+            return os.stat(path)
+        return ArchiveReader.get(archive).stat(member)
+    
+    @staticmethod
+    def decode_image(path):
+        """完整解码图片（RGB / RGBA / L）"""
+        with ImageProcessor.source_file(path) as f:
+            img = Image.open(f)
+            img.load()
+        return ImageProcessor.normalize_mode(img)
+    
+    @staticmethod
+    def open_image(path):
+        """完整解码图片；启用解码缓存时，命中缓存直接内存映射而不再解码"""
+        if ImageProcessor.decode_cache is not None:
+            return ImageProcessor.decode_cache.load(path)
+        return ImageProcessor.decode_image(path)
+    
+    @staticmethod
+    def open_thumbnail(path, max_size, tier='interactive'):
+        """解码缩略图（交互档位下 JPEG 缩小解码，见 thumbnail），不走全分辨率解码和解码缓存"""
+        with ImageProcessor.source_file(path) as f, Image.open(f) as img:
+            return ImageProcessor.thumbnail(img, max_size, tier)
+    
+    @staticmethod
+    def output_mode(images, fmt):
+        """根据输入图片和输出格式选择画布模式：格式支持透明时保留 RGBA，全部为灰度时输出 L"""
+        modes = {img.mode for img in images}
+        if 'RGBA' in modes and (fmt or '').upper() in ImageProcessor.ALPHA_FORMATS:
+            return 'RGBA'
+        if modes == {'L'}:
+            return 'L'
+        return 'RGB'
+    
+    @staticmethod
+    def format_for_path(path):
+        """根据扩展名得到 Pillow 格式名"""
+        return Image.registered_extensions().get(os.path.splitext(path)[1].lower())
+    
+    @staticmethod
+    def encode_image(img, fmt, quality=95):
+        """把图片编码为字节串（JPEG 不支持透明通道，先转为 RGB）"""
+        import io
+        if fmt == 'JPEG' and img.mode not in ('RGB', 'L'):
+            img = img.convert('RGB')
+        buf = io.BytesIO()
+        img.save(buf, format=fmt, quality=quality)
+        return buf.getvalue()
+    
+    @staticmethod
+    def crop_image(img, left, top, right, bottom):
+        """裁剪图片（尚未解码的图片只解码保留区域，见 decode_region）"""
+        w, h = img.size
+        r = max(left, w - right)
+        b = max(top, h - bottom)
+        if r <= left or b <= top:
+            return None
+        return ImageProcessor.decode_region(img, (left, top, r, b))
+    
+    @staticmethod
+    def decode_region(img, box):
+        """从刚打开、尚未解码的图片中只解码 box 区域
+
+        - 分块 / 分条 TIFF：只读取与区域相交的瓦片或条带，组成一个临时的小 TIFF 交给 Pillow 解码；
+        - 非隔行 PNG：只解码到区域底边为止的行（PNG 是单个压缩流，无法跳过上方的行）；
+        - 其他格式以及已解码的图片：完整解码后裁剪。JPEG 也属于此类，Pillow 的 JPEG 解码器
+          无法在中途停止。
+
+        PNG 的部分解码会就地修改 img，之后不应再使用原图。
+        """
+        if not isinstance(img, ImageFile.ImageFile) or not img.tile or img.fp is None:
+            return img.crop(box)
+        region = None
+        try:
+            if img.format == 'TIFF':
+                region = ImageProcessor.decode_tiff_region(img, box)
+            elif img.format == 'PNG' and not img.info.get('interlace') and len(img.tile) == 1:
+                region = ImageProcessor.decode_rows(img, box[3]).crop(box)
+        except Exception:
+            region = None  # 结构不常见的文件回退到完整解码
+        return region if region is not None else img.crop(box)
+    
+    @staticmethod
+    def decode_rows(img, bottom):
+        """只解码前 bottom 行（适用于只有一个按行顺序压缩的数据块的格式）"""
+        tile = img.tile[0]
+        extents = (0, 0, img.width, bottom)
+        img._size = (img.width, bottom)
+        img.tile = [tile._replace(extents=extents) if hasattr(tile, '_replace') else (tile[0], extents) + tuple(tile[2:])]
+        img.load()
+        return img
+    
+    @staticmethod
+    def decode_png_bands(img, ys):
+        """按 ys 给出的水平分界逐条解码刚打开的非隔行 8 位 PNG（L / RGB / RGBA），产出 (条带顶边, 图片)
+
+        PNG 是单个压缩流：这里自己解压 IDAT，每次只取一个条带的过滤行，连同上一条带的最后一行
+        （过滤类型为 None）重新打包成不压缩的 zlib 流交给 Pillow 的 zip 解码器还原，
+        Up / Average / Paeth 过滤可以跨条带衔接；因此除第一条外，产出的图片从条带顶边的上一行开始。
+        内存只与条带大小有关；不符合上述条件的文件产出 None，由调用方改为完整解码。
+        """
+        tile = img.tile[0]
+        if (img.format != 'PNG' or img.info.get('interlace') or len(img.tile) != 1
+                or img.mode not in ('L', 'RGB', 'RGBA') or tile[3] != img.mode):
+            yield ys[0], None
+            return
+        
+        def idat_chunks():
+            # tile 的偏移指向第一个 IDAT 块的数据，IDAT 块依次相连
+            img.fp.seek(tile[2] - 8)
+            while True:
+                length, chunk_type = struct.unpack('>I4s', img.fp.read(8))
+                if chunk_type != b'IDAT':
+                    return
+                yield img.fp.read(length)
+                img.fp.read(4)  # CRC
+        
+        width = img.width
+        stride = width * len(img.mode) + 1  # 每行前有 1 字节过滤类型
+        chunks = idat_chunks()
+        inflate = zlib.decompressobj()
+        pending = b''
+        prev = None
+        for top, bottom in zip(ys, ys[1:]):
+            deflate = zlib.compressobj(0)
+            parts = [] if prev is None else [deflate.compress(b'\0' + prev)]
+            need = (bottom - top) * stride
+            while need:
+                if not pending:
+                    pending = next(chunks, None)
+                    if pending is None:
+                        raise EOFError("PNG 图像数据不完整")
+                data = inflate.decompress(pending, min(need, 1 << 20))
+                pending = inflate.unconsumed_tail
+                parts.append(deflate.compress(data))
+                need -= len(data)
+            parts.append(deflate.flush())
+            start = top if prev is None else top - 1
+            band = Image.frombytes(img.mode, (width, bottom - start), b''.join(parts), 'zip', img.mode)
+            del parts
+            prev = band.crop((0, band.height - 1, width, band.height)).tobytes()
+            yield start, band
+    
+    @staticmethod
+    def decode_tiff_region(img, box):
+        """读取与 box 相交的 TIFF 瓦片 / 条带并解码，返回区域图片；不适用时返回 None"""
+        import io
+        from PIL import TiffImagePlugin, TiffTags
+        
+        tags = img.tag_v2
+        width, height = img.size
+        if tags.get(259, 1) == 6:
+            return None  # 旧式 JPEG 压缩
+        if 322 in tags and 324 in tags:
+            tiled = True
+            tw, th = tags[322], tags[323]
+            offsets, counts = tags[324], tags[325]
+        elif 273 in tags:
+            tiled = False
+            tw, th = width, min(tags.get(278, height), height)
+            offsets, counts = tags[273], tags[279]
+        else:
+            return None
+        across, down = math.ceil(width / tw), math.ceil(height / th)
+        per_plane = across * down
+        if not per_plane or len(offsets) % per_plane or len(counts) != len(offsets):
+            return None
+        planes = len(offsets) // per_plane
+        
+        x0, y0, x1, y1 = box
+        c0, r0 = x0 // tw, y0 // th
+        c1, r1 = math.ceil(x1 / tw), math.ceil(y1 / th)
+        if (c1 - c0) * (r1 - r0) * 2 > per_plane:
+            return None  # 区域覆盖大半个图片时，直接完整解码更省事
+        
+        # 按 平面 -> 行 -> 列 的顺序读取相交的数据块
+        chunks = []
+        for plane in range(planes):
+            for r in range(r0, r1):
+                for c in range(c0, c1):
+                    i = plane * per_plane + r * across + c
+                    img.fp.seek(offsets[i])
+                    chunks.append(img.fp.read(counts[i]))
+        
+        # 临时 TIFF 的字节序与源文件一致，16 位等多字节采样无需转换
+        prefix = tags.prefix
+        order = '<' if prefix == b'II' else '>'
+        ifd = TiffImagePlugin.ImageFileDirectory_v2(prefix + struct.pack(order + 'HI', 42, 8))
+        for tag in ImageProcessor.TIFF_DECODE_TAGS:
+            if tag in tags:
+                ifd[tag] = tags[tag]
+                ifd.tagtype[tag] = tags.tagtype[tag]
+        ifd[256] = (c1 - c0) * tw if tiled else width
+        ifd[257] = (r1 - r0) * th if tiled else min(r1 * th, height) - r0 * th
+        if tiled:
+            ifd[322], ifd[323] = tw, th
+            offset_tag, count_tag = 324, 325
+        else:
+            ifd[278] = th
+            offset_tag, count_tag = 273, 279
+        ifd[count_tag] = tuple(len(chunk) for chunk in chunks)
+        ifd.tagtype[count_tag] = ifd.tagtype[offset_tag] = TiffTags.LONG
+        
+        # 数据块紧跟在目录之后。Pillow 写 StripOffsets 时会自动加上目录末尾的位置，
+        # TileOffsets 则需要先按占位值算出目录长度再填入（目录长度不变）
+        starts = []
+        pos = 0
+        for chunk in chunks:
+            starts.append(pos)
+            pos += len(chunk)
+        if tiled:
+            ifd[offset_tag] = (0,) * len(chunks)
+            base = 8 + len(ifd.tobytes(8))
+            starts = [base + start for start in starts]
+        ifd[offset_tag] = tuple(starts)
+        data = prefix + struct.pack(order + 'HI', 42, 8) + ifd.tobytes(8) + b''.join(chunks)
+        
+        sub = Image.open(io.BytesIO(data))
+        sub.load()
+        return sub.crop((x0 - c0 * tw, y0 - r0 * th, x1 - c0 * tw, y1 - r0 * th))
+    
+    @staticmethod
+    def dhash(path, hash_size=8):
+        """差值哈希（dHash）：缩小解码为灰度图，按相邻像素的明暗关系生成 64 位指纹"""
+        with ImageProcessor.source_file(path) as f, Image.open(f) as img:
+            # JPEG 直接在 DCT 阶段按 1/2~1/8 缩小解码
+            img.draft('L', (hash_size * 8, hash_size * 8))
+            # 固定用 BOX 滤镜，不随重采样配置变化，保证缓存的哈希前后一致
+            small = img.convert('L').resize((hash_size + 1, hash_size), Image.Resampling.BOX)
+        px = small.tobytes()
+        value = 0
+        for y in range(hash_size):
+            row = y * (hash_size + 1)
+            for x in range(hash_size):
+                value = (value << 1) | (px[row + x] > px[row + x + 1])
+        return value
+    
+    @staticmethod
+    def file_signature(path, content_hash=False):
+        """输入文件签名：路径 + 大小 + 修改时间，或内容哈希"""
+        st = ImageProcessor.source_stat(path)
+        if not content_hash:
+            return [ArchiveReader.abspath(path), st.st_size, st.st_mtime_ns]
+        h = hashlib.sha1()
+        with ImageProcessor.source_file(path) as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        return [ArchiveReader.abspath(path), h.hexdigest()]
+    
+    @staticmethod
+    def save_atomic(img, path, **params):
+        """原子写入：先写同目录临时文件，再重命名，避免留下写了一半的输出"""
+        directory, name = os.path.split(os.path.abspath(path))
+        fmt = ImageProcessor.format_for_path(name)
+        fd, tmp_path = tempfile.mkstemp(prefix=f".{name}.", suffix=".tmp", dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                img.save(f, format=fmt, **params)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+    
+    @staticmethod
+    def plan_stitch_layout(sizes, mode, rows=0, cols=0, spacing=0):
+        """根据图片尺寸计算拼接布局（不解码像素）
+
+        返回 (画布宽, 画布高, [(图片序号, x, y, 宽, 高), ...])
+        """
+        if not sizes:
+            return None
+        
+        placements = []
+        if mode == "grid":
+            # 自动计算行列数
+            if rows <= 0 and cols <= 0:
+                cols = math.ceil(math.sqrt(len(sizes)))
+                rows = math.ceil(len(sizes) / cols)
+            elif rows <= 0:
+                rows = math.ceil(len(sizes) / cols)
+            elif cols <= 0:
+                cols = math.ceil(len(sizes) / rows)
+            
+            # 计算每个单元格大小
+            cell_w = max(w for w, h in sizes)
+            cell_h = max(h for w, h in sizes)
+            
+            # 计算输出图片大小
+            out_w = cols * cell_w + spacing * (cols - 1) if cols > 0 else cell_w
+            out_h = rows * cell_h + spacing * (rows - 1) if rows > 0 else cell_h
+            
+            for idx, (w, h) in enumerate(sizes):
+                if idx >= rows * cols:
+                    break
+                r = idx // cols
+                c = idx % cols
+                
+                # 等比例缩放以适应单元格，并居中
+                ratio = min(cell_w / w, cell_h / h)
+                new_w, new_h = int(w * ratio), int(h * ratio)
+                x = c * (cell_w + spacing) + (cell_w - new_w) // 2
+                y = r * (cell_h + spacing) + (cell_h - new_h) // 2
+                placements.append((idx, x, y, new_w, new_h))
+        elif mode == "horizontal":
+            max_h = max(h for w, h in sizes)
+            x = 0
+            for idx, (w, h) in enumerate(sizes):
+                new_w = int(w * (max_h / h))
+                placements.append((idx, x, 0, new_w, max_h))
+                x += new_w + spacing
+            out_w, out_h = x - spacing, max_h
+        else:  # vertical
+            max_w = max(w for w, h in sizes)
+            y = 0
+            for idx, (w, h) in enumerate(sizes):
+                new_h = int(h * (max_w / w))
+                placements.append((idx, 0, y, max_w, new_h))
+                y += new_h + spacing
+            out_w, out_h = max_w, y - spacing
+        
+        return out_w, out_h, placements
+    
+    @staticmethod
+    def canvas_color(bg_color, out_mode):
+        """把 RGB 背景色转换为对应画布模式的颜色"""
+        r, g, b = bg_color[:3]
+        if out_mode == 'L':
+            return (r * 299 + g * 587 + b * 114) // 1000
+        if out_mode == 'RGBA':
+            return (r, g, b, 255)
+        return (r, g, b)
+    
+    @staticmethod
+    def render_layout(images, layout, bg_color=(255, 255, 255), out_mode='RGB', tier='export'):
+        """按布局把图片粘贴到画布上（尺寸已符合的图片直接粘贴，不再缩放）"""
+        out_w, out_h, placements = layout
+        out = Image.new(out_mode, (out_w, out_h), ImageProcessor.canvas_color(bg_color, out_mode))
+        for idx, x, y, w, h in placements:
+            img = images[idx]
+            if img.size != (w, h):
+                img = ImageProcessor.resize(img, (w, h), tier)
+            out.paste(img, (x, y))
+        return out
+    
+    @staticmethod
+    def stitch_images_grid(images, rows, cols, spacing, bg_color=(255, 255, 255), out_mode='RGB', tier='export'):
+        """网格拼接图片"""
+        if not images:
+            return None
+        layout = ImageProcessor.plan_stitch_layout([img.size for img in images], "grid", rows, cols, spacing)
+        return ImageProcessor.render_layout(images, layout, bg_color, out_mode, tier)
+    
+    @staticmethod
+    def stitch_images_horizontal(images, spacing, bg_color=(255, 255, 255), out_mode='RGB', tier='export'):
+        """水平拼接图片"""
+        if not images:
+            return None
+        layout = ImageProcessor.plan_stitch_layout([img.size for img in images], "horizontal", spacing=spacing)
+        return ImageProcessor.render_layout(images, layout, bg_color, out_mode, tier)
+    
+    @staticmethod
+    def stitch_images_vertical(images, spacing, bg_color=(255, 255, 255), out_mode='RGB', tier='export'):
+        """垂直拼接图片"""
+        if not images:
+            return None
+        layout = ImageProcessor.plan_stitch_layout([img.size for img in images], "vertical", spacing=spacing)
+        return ImageProcessor.render_layout(images, layout, bg_color, out_mode, tier)
+    
+    @staticmethod
+    def stitch_images(images, mode, rows=0, cols=0, spacing=0, bg_color=(255, 255, 255), out_mode='RGB', tier='export'):
+        """按拼接模式分派到对应的拼接函数"""
+        if mode == "grid":
+            return ImageProcessor.stitch_images_grid(images, rows, cols, spacing, bg_color, out_mode, tier)
+        if mode == "horizontal":
+            return ImageProcessor.stitch_images_horizontal(images, spacing, bg_color, out_mode, tier)
+        if mode == "vertical_overlap":
+            return ImageProcessor.stitch_images_vertical_overlap(images, bg_color, out_mode, tier)
+        return ImageProcessor.stitch_images_vertical(images, spacing, bg_color, out_mode, tier)
+    
+    @staticmethod
+    def row_profile(img, width=64):
+        """行特征：缩成固定宽度的灰度图，以及每行量化后（像素只取高 5 位）的指纹
+
+        指纹用 CRC32 而不是内置 hash()（按进程加盐），不同进程、不同次运行得到的指纹相同。
+        """
+        # 固定用 BOX 滤镜，与重采样配置无关，保证相同内容得到相同指纹
+        small = img.convert('L').resize((min(width, img.width), img.height), Image.Resampling.BOX)
+        data = small.point(lambda v: v >> 3).tobytes()
+        w = small.width
+        return small, [zlib.crc32(data[i:i + w]) for i in range(0, len(data), w)]
+    
+    @staticmethod
+    def row_differences(a, b):
+        """两张同尺寸灰度图逐行的平均差值（0~255）"""
+        from PIL import ImageChops
+        diff = ImageChops.difference(a, b)
+        return diff.resize((1, diff.height), Image.Resampling.BOX).tobytes()
+    
+    @staticmethod
+    def longest_overlap(upper, lower):
+        """upper 的后缀与 lower 的前缀相同的最大长度（KMP 前缀函数，线性时间）"""
+        if not upper or not lower:
+            return 0
+        fail = [0] * len(lower)
+        k = 0
+        for i in range(1, len(lower)):
+            while k and lower[i] != lower[k]:
+                k = fail[k - 1]
+            if lower[i] == lower[k]:
+                k += 1
+            fail[i] = k
+        k = 0
+        for value in upper:
+            if k == len(lower):
+                k = fail[k - 1]
+            while k and value != lower[k]:
+                k = fail[k - 1]
+            if value == lower[k]:
+                k += 1
+        return k
+    
+    @staticmethod
+    def find_vertical_overlap(upper, lower, min_overlap=16, max_static=0.25, tolerance=4):
+        """比较相邻两张图的行特征（row_profile 的结果），返回 (固定页眉行数, 固定页脚行数, 重叠行数)
+
+        滚动截图中状态栏、导航栏等固定区域在两张图的同一位置重复出现，先把它们去掉；
+        再在中间的滚动区域里用 KMP 找上图末尾与下图开头指纹相同的最长一段。
+        有损压缩导致指纹对不上时，退回到缩小图上按容差比较：
+        先用行均值快速排除候选偏移，只对少数候选比较整段。抽查行避开重叠段两端，
+        且容差放宽到整段的 3 倍：JPEG 在固定页眉页脚旁的色块渗色会让边缘单行偏差超过 tolerance。
+        """
+        (a, a_hashes), (b, b_hashes) = upper, lower
+        n = min(a.height, b.height)
+        limit = int(n * max_static)
+        top = ImageProcessor.row_differences(a.crop((0, 0, a.width, n)), b.crop((0, 0, b.width, n)))
+        bottom = ImageProcessor.row_differences(
+            a.crop((0, a.height - n, a.width, a.height)), b.crop((0, b.height - n, b.width, b.height))
+        )
+        head = 0
+        while head < limit and top[head] <= tolerance:
+            head += 1
+        foot = 0
+        while foot < limit and bottom[n - 1 - foot] <= tolerance:
+            foot += 1
+        
+        overlap = ImageProcessor.longest_overlap(a_hashes[head:a.height - foot], b_hashes[head:b.height - foot])
+        if overlap < min_overlap:
+            body_a = a.crop((0, head, a.width, a.height - foot))
+            body_b = b.crop((0, head, b.width, b.height - foot))
+            means_a = body_a.resize((1, body_a.height), Image.Resampling.BOX).tobytes()
+            means_b = body_b.resize((1, body_b.height), Image.Resampling.BOX).tobytes()
+            overlap, best = 0, tolerance + 1
+            for k in range(min(len(means_a), len(means_b)), min_overlap - 1, -1):
+                # 抽查 1/4、1/2、3/4 处三行的均值
+                if any(abs(means_a[-k + i] - means_b[i]) > 3 * tolerance for i in (k // 4, k // 2, 3 * k // 4)):
+                    continue
+                diffs = ImageProcessor.row_differences(
+                    body_a.crop((0, body_a.height - k, body_a.width, body_a.height)),
+                    body_b.crop((0, 0, body_b.width, k))
+                )
+                # 取平均差值最小的偏移（内容平滑时相邻偏移也可能在容差内）
+                score = sum(diffs) / k
+                if score < best:
+                    overlap, best = k, score
+                    if score == 0:
+                        break
+        if overlap < min_overlap:
+            return 0, 0, 0
+        return head, foot, overlap
+    
+    @staticmethod
+    def stitch_images_vertical_overlap(images, bg_color=(255, 255, 255), out_mode='RGB', tier='export'):
+        """垂直拼接滚动截图：去掉相邻图片之间的重叠部分和重复的固定页眉页脚"""
+        if not images:
+            return None
+        max_w = max(img.width for img in images)
+        scaled = [
+            img if img.width == max_w else ImageProcessor.resize(img, (max_w, int(img.height * max_w / img.width)), tier)
+            for img in images
+        ]
+        profiles = [ImageProcessor.row_profile(img) for img in scaled]
+        
+        # 每张图保留的行区间 [起始行, 结束行)
+        spans = [[0, img.height] for img in scaled]
+        for i in range(len(scaled) - 1):
+            head, foot, overlap = ImageProcessor.find_vertical_overlap(profiles[i], profiles[i + 1])
+            if overlap:
+                spans[i][1] = min(spans[i][1], scaled[i].height - foot)
+                spans[i + 1][0] = head + overlap
+        
+        out_h = sum(max(0, end - start) for start, end in spans)
+        out = Image.new(out_mode, (max_w, out_h), ImageProcessor.canvas_color(bg_color, out_mode))
+        y = 0
+        for img, (start, end) in zip(scaled, spans):
+            if end > start:
+                out.paste(img.crop((0, start, max_w, end)), (0, y))
+                y += end - start
+        return out
+    
+    @staticmethod
+    def crop_file(src, out_path, left, top, right, bottom, quality=95):
+        """裁剪单个文件并原子写入输出，返回是否生成了输出"""
+        with ImageProcessor.source_file(src) as f, Image.open(f) as img:
+            cropped = ImageProcessor.crop_image(img, left, top, right, bottom)
+            if not cropped:
+                return False
+            ImageProcessor.save_atomic(cropped, out_path, quality=quality)
+            return True
+    
+    @staticmethod
+    def crop_files_to_archive(paths, archive_path, left, top, right, bottom, quality=95,
+                              workers=None, progress=None):
+        """并行裁剪并编码，结果由单个写线程顺序写入压缩包，返回写入的图片数"""
+        
+        def crop_and_encode(path):
+            try:
+                with ImageProcessor.source_file(path) as f, Image.open(f) as img:
+                    fmt = img.format or 'JPEG'
+                    cropped = ImageProcessor.crop_image(img, left, top, right, bottom)
+                    if not cropped:
+                        return path, None
+                    return path, ImageProcessor.encode_image(cropped, fmt, quality)
+            except Exception as e:
+                print(f"处理 {path} 时出错：{e}")
+                return path, None
+        
+        count = 0
+        with ArchiveWriter(archive_path) as writer:
+            results = imap_bounded(crop_and_encode, paths, workers, governor=ImageProcessor.memory)
+            for i, (path, data) in enumerate(results):
+                if data is not None:
+                    writer.add(os.path.basename(path), data, src=path)
+                    count += 1
+                if progress:
+                    progress(i + 1, len(paths))
+        return count
+    
+    @staticmethod
+    def stitch_files(paths, out_path, mode, rows=0, cols=0, spacing=0, bg_color=(255, 255, 255), quality=95,
+                     cell_size=(300, 300), crop=None):
+        """拼接一组文件并原子写入输出，返回是否生成了输出
+
+        crop 为 (左, 上, 右, 下) 边距时先逐张裁剪再拼接，裁剪结果不落盘。
+        """
+        if mode == "contact":
+            pages = ImageProcessor.export_contact_sheets(
+                paths, out_path, rows, cols, cell_size, spacing, bg_color, quality
+            )
+            return pages > 0
+        pipe = Pipeline(paths)
+        if crop:
+            pipe = pipe.crop(*crop)
+        return pipe.stitch(mode, rows, cols, spacing, bg_color).save(out_path, quality)
+    
+    # ==================== 分页联系表 ====================
+    
+    @staticmethod
+    def contact_grid(rows, cols):
+        """联系表每页的行列数（0 表示使用默认的 6 行 4 列）"""
+        return (rows if rows > 0 else 6), (cols if cols > 0 else 4)
+    
+    @staticmethod
+    def plan_contact_page(rows, cols, cell_size, spacing=0):
+        """联系表页面尺寸和各单元格左上角坐标；页面尺寸固定，与图片内容无关"""
+        cell_w, cell_h = cell_size
+        page_w = cols * cell_w + spacing * (cols + 1)
+        page_h = rows * cell_h + spacing * (rows + 1)
+        cells = [
+            (spacing + c * (cell_w + spacing), spacing + r * (cell_h + spacing))
+            for r in range(rows) for c in range(cols)
+        ]
+        return page_w, page_h, cells
+    
+    @staticmethod
+    def render_contact_page(paths, rows, cols, cell_size, spacing=0, bg_color=(255, 255, 255), tier='export'):
+        """渲染联系表的一页：逐张缩小解码后放入单元格，内存只与页面尺寸有关"""
+        cell_w, cell_h = cell_size
+        page_w, page_h, cells = ImageProcessor.plan_contact_page(rows, cols, cell_size, spacing)
+        page = Image.new('RGB', (page_w, page_h), tuple(bg_color[:3]))
+        for path, (x, y) in zip(paths, cells):
+            try:
+                with ImageProcessor.source_file(path) as f, Image.open(f) as img:
+                    # JPEG 直接在 DCT 阶段缩小解码到接近单元格大小
+                    img.draft('RGB', (cell_w, cell_h))
+                    img = ImageProcessor.normalize_mode(img)
+                    ratio = min(cell_w / img.width, cell_h / img.height)
+                    w, h = max(1, int(img.width * ratio)), max(1, int(img.height * ratio))
+                    thumb = ImageProcessor.resize(img, (w, h), tier)
+            except Exception as e:
+                print(f"处理 {path} 时出错：{e}")
+                continue
+            pos = (x + (cell_w - w) // 2, y + (cell_h - h) // 2)
+            # 透明图片按背景色合成
+            page.paste(thumb, pos, thumb if thumb.mode == 'RGBA' else None)
+        return page
+    
+    @staticmethod
+    def iter_contact_pages(paths, rows, cols, cell_size, spacing=0, bg_color=(255, 255, 255),
+                           tier='export', workers=None):
+        """按顺序逐页生成联系表；多页并行渲染，同时在内存中的页数不超过工作线程数的两倍"""
+        per_page = rows * cols
+        return imap_bounded(
+            lambda start: ImageProcessor.render_contact_page(
+                paths[start:start + per_page], rows, cols, cell_size, spacing, bg_color, tier
+            ),
+            range(0, len(paths), per_page), workers
+        )
+    
+    @staticmethod
+    def contact_sheet_outputs(out_path, count, rows=0, cols=0):
+        """联系表实际写出的文件：多页文件和压缩包为 out_path 本身，其他格式为按页编号的各个文件"""
+        rows, cols = ImageProcessor.contact_grid(rows, cols)
+        total = math.ceil(count / (rows * cols))
+        if ArchiveWriter.is_archive(out_path) or ImageProcessor.format_for_path(out_path) in ('PDF', 'TIFF'):
+            return [out_path] if total else []
+        base, ext = os.path.splitext(out_path)
+        digits = max(3, len(str(total)))
+        return [f"{base}_{index + 1:0{digits}d}{ext}" for index in range(total)]
+    
+    @staticmethod
+    def export_contact_sheets(paths, out_path, rows=0, cols=0, cell_size=(300, 300), spacing=10,
+                              bg_color=(255, 255, 255), quality=90, workers=None, progress=None):
+        """把图片按固定行列分页排成联系表，返回页数
+
+        输出为 .pdf / .tif 时写成一个多页文件（逐页追加写入）；输出为 .zip / .tar 时各页编码为
+        JPEG 后顺序写入压缩包；其他格式按页编号保存为 name_001.jpg、name_002.jpg ……。
+        progress(已完成页数, 总页数) 可用于汇报进度，在其中抛出异常即可中止导出。
+        """
+        from concurrent.futures import ThreadPoolExecutor, as_completed
+        
+        rows, cols = ImageProcessor.contact_grid(rows, cols)
+        per_page = rows * cols
+        total = math.ceil(len(paths) / per_page)
+        if not total:
+            return 0
+        fmt = ImageProcessor.format_for_path(out_path)
+        digits = max(3, len(str(total)))
+        
+        if ArchiveWriter.is_archive(out_path):
+            stem = os.path.basename(out_path).split('.')[0]
+            
+            def render_and_encode(index):
+                page = ImageProcessor.render_contact_page(
+                    paths[index * per_page:(index + 1) * per_page], rows, cols, cell_size, spacing, bg_color
+                )
+                return ImageProcessor.encode_image(page, 'JPEG', quality)
+            
+            with ArchiveWriter(out_path) as writer:
+                for i, data in enumerate(imap_bounded(render_and_encode, range(total), workers)):
+                    writer.add(f"{stem}_{i + 1:0{digits}d}.jpg", data, page=i + 1)
+                    if progress:
+                        progress(i + 1, total)
+            return total
+        
+        if fmt in ('PDF', 'TIFF'):
+            pages = ImageProcessor.iter_contact_pages(
+                paths, rows, cols, cell_size, spacing, bg_color, workers=workers
+            )
+            directory, name = os.path.split(os.path.abspath(out_path))
+            fd, tmp_path = tempfile.mkstemp(prefix=f".{name}.", suffix=".tmp", dir=directory)
+            os.close(fd)
+            try:
+                if fmt == 'TIFF':
+                    from PIL import TiffImagePlugin
+                    with TiffImagePlugin.AppendingTiffWriter(tmp_path, new=True) as tf:
+                        for i, page in enumerate(pages):
+                            page.save(tf, format='TIFF', compression='tiff_adobe_deflate')
+                            tf.newFrame()
+                            if progress:
+                                progress(i + 1, total)
+                else:
+                    for i, page in enumerate(pages):
+                        page.save(tmp_path, format='PDF', append=i > 0, quality=quality)
+                        if progress:
+                            progress(i + 1, total)
+                os.replace(tmp_path, out_path)
+            except BaseException:
+                pages.close()
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+                raise
+            return total
+        
+        # 逐页编号保存：每页在工作线程中渲染并编码，写完即释放
+        page_paths = ImageProcessor.contact_sheet_outputs(out_path, len(paths), rows, cols)
+        
+        def render_and_save(index):
+            page = ImageProcessor.render_contact_page(
+                paths[index * per_page:(index + 1) * per_page], rows, cols, cell_size, spacing, bg_color
+            )
+            ImageProcessor.save_atomic(page, page_paths[index], quality=quality)
+        
+        with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+            futures = [pool.submit(render_and_save, i) for i in range(total)]
+            try:
+                for done, f in enumerate(as_completed(futures), 1):
+                    f.result()
+                    if progress:
+                        progress(done, total)
+            except BaseException:
+                for f in futures:
+                    f.cancel()
+                raise
+        return total
+    
+    # ==================== 切片 ====================
+    
+    @staticmethod
+    def plan_slices(size, rows=0, cols=0, tile_size=None):
+        """切片的列分界和行分界
+
+        给出 tile_size (宽, 高) 时按固定尺寸切分，最后一行 / 一列可能较小；
+        否则均分为 rows 行 cols 列（0 视为 1），各块尺寸最多相差 1 像素。
+        """
+        width, height = size
+        if tile_size:
+            tw, th = tile_size
+            if tw <= 0 or th <= 0:
+                raise ValueError("切片尺寸必须大于 0")
+            xs = list(range(0, width, tw)) + [width]
+            ys = list(range(0, height, th)) + [height]
+        else:
+            rows, cols = max(1, rows), max(1, cols)
+            if cols > width or rows > height:
+                raise ValueError("切片行列数超过了图片尺寸")
+            xs = [round(i * width / cols) for i in range(cols + 1)]
+            ys = [round(i * height / rows) for i in range(rows + 1)]
+        return xs, ys
+    
+    @staticmethod
+    def slice_name(stem, row, col, rows, cols, ext):
+        """切片文件名：stem_r行_c列.ext（从 1 开始，按总行列数补零，便于按名称排序）"""
+        rd, cd = len(str(rows)), len(str(cols))
+        return f"{stem}_r{row + 1:0{rd}d}_c{col + 1:0{cd}d}{ext}"
+    
+    @staticmethod
+    def iter_bands(path, ys):
+        """按 ys 给出的水平分界逐条解码源图，产出 (图片第一行在源图中的行号, 覆盖该条带的图片)
+
+        分块 / 分条 TIFF 每条只读取相交的数据块，非隔行 PNG 顺序解压逐条还原（见 decode_png_bands），
+        内存只与条带大小有关；其他格式（包括 JPEG）只能完整解码，解码一次后所有条带共用同一张图片（顶边为 0）。
+        """
+        with ImageProcessor.source_file(path) as f, Image.open(f) as img:
+            bands = None
+            if img.format == 'TIFF':
+                bands = ((top, ImageProcessor.decode_tiff_region(img, (0, top, img.width, bottom)))
+                         for top, bottom in zip(ys, ys[1:]))
+            elif img.format == 'PNG':
+                bands = ImageProcessor.decode_png_bands(img, ys)
+            if bands is not None and len(ys) > 2:
+                for i in range(len(ys) - 1):
+                    try:
+                        top, band = next(bands)
+                    except Exception:
+                        band = None
+                    if band is None:
+                        break
+                    yield top, ImageProcessor.normalize_mode(band)
+                else:
+                    return
+                ys = ys[i:]  # 结构不常见时其余条带改为完整解码
+        full = ImageProcessor.open_image(path)
+        for _ in range(len(ys) - 1):
+            yield 0, full
+    
+    @staticmethod
+    def slice_image(path, out, rows=0, cols=0, tile_size=None, ext=None, quality=95, workers=None, progress=None):
+        """把一张大图切成网格（rows x cols）或固定尺寸（tile_size）的切片，返回切片数
+
+        out 为目录时逐个写入 stem_r行_c列.ext，为 .zip / .tar 时写入同一个压缩包。
+        源图按切片行逐条解码（见 iter_bands），切片在线程池中并行编码；
+        同时在处理中的切片数有上限，因此内存中只保留少数几个条带。
+        """
+        with ImageProcessor.source_file(path) as f, Image.open(f) as img:
+            size = img.size
+            src_fmt = img.format
+        xs, ys = ImageProcessor.plan_slices(size, rows, cols, tile_size)
+        n_rows, n_cols = len(ys) - 1, len(xs) - 1
+        total = n_rows * n_cols
+        
+        stem = os.path.splitext(os.path.basename(ArchiveReader.split(path)[1] or path))[0]
+        if not ext:
+            ext = '.jpg' if src_fmt == 'JPEG' else '.png'
+        ext = '.' + ext.lstrip('.').lower()
+        fmt = ImageProcessor.format_for_path(stem + ext)
+        if fmt is None:
+            raise ValueError(f"不支持的切片格式：{ext}")
+        
+        def tiles():
+            for row, (top, band) in enumerate(ImageProcessor.iter_bands(path, ys)):
+                for col in range(n_cols):
+                    box = (xs[col], ys[row], xs[col + 1], ys[row + 1])
+                    yield band, top, box, ImageProcessor.slice_name(stem, row, col, n_rows, n_cols, ext)
+        
+        archive = ArchiveWriter.is_archive(out)
+        
+        def encode(item):
+            band, top, (x0, y0, x1, y1), name = item
+            tile = band.crop((x0, y0 - top, x1, y1 - top))
+            if archive:
+                return name, (x0, y0, x1, y1), ImageProcessor.encode_image(tile, fmt, quality)
+            if fmt == 'JPEG' and tile.mode not in ('RGB', 'L'):
+                tile = tile.convert('RGB')
+            ImageProcessor.save_atomic(tile, os.path.join(out, name), quality=quality)
+            return name, (x0, y0, x1, y1), None
+        
+        results = imap_bounded(encode, tiles(), workers)
+        if archive:
+            with ArchiveWriter(out) as writer:
+                for i, (name, box, data) in enumerate(results):
+                    writer.add(name, data, box=list(box))
+                    if progress:
+                        progress(i + 1, total)
+            return total
+        
+        os.makedirs(out, exist_ok=True)
+        for i, _ in enumerate(results):
+            if progress:
+                progress(i + 1, total)
+        return total
+    
+    # ==================== 瓦片金字塔导出 ====================
+    
+    @staticmethod
+    def export_deepzoom(paths, layout, dzi_path, bg_color=(255, 255, 255),
+                        tile_size=254, overlap=1, tile_format='jpg', quality=90, workers=None):
+        """导出 DeepZoom (DZI) 多分辨率瓦片金字塔
+
+        最高层瓦片直接从源图按区域缩放渲染，其余各层由上一层瓦片 2x2 缩小得到，
+        全程不会生成完整分辨率的大画布。每一行瓦片作为一个并行任务。
+        每张源图只解码一次，由第一个用到它的行任务解码后在各行之间共用，与它相交的行全部完成后释放；
+        行任务按从上到下的顺序执行，因此内存中只保留与正在渲染的几行相交的源图。
+        """
+        from concurrent.futures import ThreadPoolExecutor
+        
+        out_w, out_h, placements = layout
+        base = os.path.splitext(dzi_path)[0]
+        files_dir = base + '_files'
+        max_level = math.ceil(math.log2(max(out_w, out_h))) if max(out_w, out_h) > 1 else 0
+        
+        def level_size(level):
+            factor = 2 ** (max_level - level)
+            return math.ceil(out_w / factor), math.ceil(out_h / factor)
+        
+        def tile_box(col, row, lw, lh):
+            x0 = col * tile_size - (overlap if col > 0 else 0)
+            y0 = row * tile_size - (overlap if row > 0 else 0)
+            x1 = min((col + 1) * tile_size + overlap, lw)
+            y1 = min((row + 1) * tile_size + overlap, lh)
+            return x0, y0, x1, y1
+        
+        def tile_path(level, col, row):
+            return os.path.join(files_dir, str(level), f"{col}_{row}.{tile_format}")
+        
+        def save_tile(tile, level, col, row):
+            if tile_format == 'png':
+                tile.save(tile_path(level, col, row))
+            else:
+                tile.save(tile_path(level, col, row), quality=quality)
+        
+        def row_band(row):
+            """与最高层第 row 行瓦片相交的源图放置信息，按从左到右排序"""
+            _, band_y0, _, band_y1 = tile_box(0, row, out_w, out_h)
+            band = [p for p in placements if p[2] < band_y1 and p[2] + p[4] > band_y0]
+            band.sort(key=lambda p: p[1])
+            return band
+        
+        top_rows = math.ceil(out_h / tile_size)
+        decoded = {}      # 源图序号 -> 解码后的图片
+        rows_left = {}    # 源图序号 -> 还未完成的相交行数
+        for row in range(top_rows):
+            for p in row_band(row):
+                rows_left[p[0]] = rows_left.get(p[0], 0) + 1
+        source_locks = {idx: threading.Lock() for idx in rows_left}
+        state_lock = threading.Lock()
+        
+        def acquire_source(idx):
+            # 同一张源图只由一个线程解码，同时需要它的其他行任务等待解码完成
+            with source_locks[idx]:
+                with state_lock:
+                    src = decoded.get(idx)
+                if src is None:
+                    src = ImageProcessor.open_image(paths[idx])
+                    with state_lock:
+                        decoded[idx] = src
+            return src
+        
+        def release_sources(band):
+            with state_lock:
+                for idx, *_ in band:
+                    rows_left[idx] -= 1
+                    if rows_left[idx] == 0:
+                        decoded.pop(idx, None)
+        
+        def render_top_row(row):
+            """最高层：逐块从源图区域缩放到瓦片"""
+            lw, lh = out_w, out_h
+            cols = math.ceil(lw / tile_size)
+            band = row_band(row)
+            try:
+                for col in range(cols):
+                    x0, y0, x1, y1 = tile_box(col, row, lw, lh)
+                    tile = Image.new('RGB', (x1 - x0, y1 - y0), bg_color)
+                    for idx, px, py, pw, ph in band:
+                        ix0, iy0 = max(x0, px), max(y0, py)
+                        ix1, iy1 = min(x1, px + pw), min(y1, py + ph)
+                        if ix1 <= ix0 or iy1 <= iy0:
+                            continue
+                        src = acquire_source(idx)
+                        sx = src.width / pw
+                        sy = src.height / ph
+                        box = ((ix0 - px) * sx, (iy0 - py) * sy, (ix1 - px) * sx, (iy1 - py) * sy)
+                        part = ImageProcessor.resize(src, (ix1 - ix0, iy1 - iy0), box=box)
+                        tile.paste(part, (ix0 - x0, iy0 - y0))
+                    save_tile(tile, max_level, col, row)
+            finally:
+                release_sources(band)
+        
+        def render_lower_row(level, row):
+            """较低层：读取上一层瓦片的有效区域拼合后缩小一半"""
+            lw, lh = level_size(level)
+            uw, uh = level_size(level + 1)
+            cols = math.ceil(lw / tile_size)
+            for col in range(cols):
+                x0, y0, x1, y1 = tile_box(col, row, lw, lh)
+                ux0, uy0 = x0 * 2, y0 * 2
+                ux1, uy1 = min(x1 * 2, uw), min(y1 * 2, uh)
+                region = Image.new('RGB', (ux1 - ux0, uy1 - uy0), bg_color)
+                for urow in range(uy0 // tile_size, (uy1 - 1) // tile_size + 1):
+                    for ucol in range(ux0 // tile_size, (ux1 - 1) // tile_size + 1):
+                        # 上一层瓦片的有效区域（去掉重叠边）
+                        cx0, cy0 = ucol * tile_size, urow * tile_size
+                        cx1, cy1 = min(cx0 + tile_size, uw), min(cy0 + tile_size, uh)
+                        ix0, iy0 = max(cx0, ux0), max(cy0, uy0)
+                        ix1, iy1 = min(cx1, ux1), min(cy1, uy1)
+                        if ix1 <= ix0 or iy1 <= iy0:
+                            continue
+                        tx0, ty0, _, _ = tile_box(ucol, urow, uw, uh)
+                        with Image.open(tile_path(level + 1, ucol, urow)) as up:
+                            part = up.crop((ix0 - tx0, iy0 - ty0, ix1 - tx0, iy1 - ty0))
+                        region.paste(part, (ix0 - ux0, iy0 - uy0))
+                tile = ImageProcessor.resize(region, (x1 - x0, y1 - y0))
+                save_tile(tile, level, col, row)
+        
+        with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+            for level in range(max_level, -1, -1):
+                os.makedirs(os.path.join(files_dir, str(level)), exist_ok=True)
+                lw, lh = level_size(level)
+                rows = math.ceil(lh / tile_size)
+                if level == max_level:
+                    futures = [pool.submit(render_top_row, row) for row in range(rows)]
+                else:
+                    futures = [pool.submit(render_lower_row, level, row) for row in range(rows)]
+                # 本层全部完成后才能生成下一层
+                for f in futures:
+                    f.result()
+        
+        with open(dzi_path, 'w', encoding='utf-8') as f:
+            f.write(
+                '<?xml version="1.0" encoding="UTF-8"?>\n'
+                f'<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" Format="{tile_format}" '
+                f'Overlap="{overlap}" TileSize="{tile_size}">\n'
+                f'  <Size Width="{out_w}" Height="{out_h}"/>\n'
+                '</Image>\n'
+            )
+        return max_level + 1
+
+
+class Pipeline:
+    """惰性的处理链：裁剪 -> 缩放 -> 拼接 -> 编码
+
+    crop() / fit() / stitch() 只记录步骤并返回新的处理链，调用 images() / render() / save()
+    时才执行。每张源图只解码一次：开头连续的裁剪合并为一个区域，只解码该区域
+    （见 ImageProcessor.decode_region）；紧接着的缩放在 JPEG 上通过 draft 直接缩小解码。
+    中间结果只在内存中传递，不写入磁盘。
+    """
+    
+    def __init__(self, paths, steps=(), stitch_args=None):
+        self.paths = list(paths)
+        self.steps = tuple(steps)
+        self.stitch_args = stitch_args
+    
+    def then(self, *step):
+        """追加一个逐张图片执行的步骤"""
+        return Pipeline(self.paths, self.steps + (step,), self.stitch_args)
+    
+    def crop(self, left, top, right, bottom):
+        """按四边边距裁剪（与 ImageProcessor.crop_image 相同）"""
+        return self.then('crop', left, top, right, bottom)
+    
+    def fit(self, max_w, max_h):
+        """等比缩小到不超过 max_w x max_h（不放大）"""
+        return self.then('fit', max_w, max_h)
+    
+    def stitch(self, mode, rows=0, cols=0, spacing=0, bg_color=(255, 255, 255)):
+        """所有逐张步骤完成后拼接为一张图"""
+        if mode == "contact":
+            raise ValueError("联系表请使用 ImageProcessor.export_contact_sheets")
+        return Pipeline(self.paths, self.steps, (mode, rows, cols, spacing, tuple(bg_color)))
+    
+    @staticmethod
+    def crop_box(size, crops):
+        """把连续的边距裁剪合并为源图上的一个区域，结果为空时返回 None"""
+        x0, y0, x1, y1 = 0, 0, size[0], size[1]
+        for left, top, right, bottom in crops:
+            w, h = x1 - x0, y1 - y0
+            r = max(left, w - right)
+            b = max(top, h - bottom)
+            if r <= left or b <= top:
+                return None
+            x0, y0, x1, y1 = x0 + left, y0 + top, x0 + r, y0 + b
+        return x0, y0, x1, y1
+    
+    def process(self, path, tier='export'):
+        """对单张图片执行逐张步骤，返回结果图片；裁剪后为空时返回 None"""
+        steps = list(self.steps)
+        crops = []
+        while steps and steps[0][0] == 'crop':
+            crops.append(steps.pop(0)[1:])
+        fit = steps[0][1:] if steps and steps[0][0] == 'fit' else None
+        
+        out = None
+        with ImageProcessor.source_file(path) as f, Image.open(f) as img:
+            box = Pipeline.crop_box(img.size, crops)
+            if box is None:
+                return None
+            drafted = False
+            if fit is not None and img.format == 'JPEG':
+                # 按裁剪区域的缩放比例在 DCT 阶段缩小解码，区域坐标随之缩小
+                scale = min(fit[0] / (box[2] - box[0]), fit[1] / (box[3] - box[1]), 1.0)
+                if scale <= 0.5:
+                    orig_w, orig_h = img.size
+                    want = (max(1, math.ceil(orig_w * scale)), max(1, math.ceil(orig_h * scale)))
+                    result = img.draft(img.mode, want)
+                    # draft 之后 img.size 已是缩小后的尺寸，缩小倍数由原始尺寸得出
+                    if result is not None and img.size != (orig_w, orig_h):
+                        d = orig_w / result[1][2]
+                        box = (int(box[0] / d), int(box[1] / d),
+                               min(img.width, math.ceil(box[2] / d)), min(img.height, math.ceil(box[3] / d)))
+                        drafted = True
+            if crops or drafted:
+                out = ImageProcessor.normalize_mode(ImageProcessor.decode_region(img, box))
+        if out is None:
+            # 没有裁剪也没有缩小解码时完整解码（可命中解码缓存）
+            out = ImageProcessor.open_image(path)
+        
+        for step in steps:
+            if step[0] == 'crop':
+                out = ImageProcessor.crop_image(out, *step[1:])
+                if out is None:
+                    return None
+            elif step[0] == 'fit':
+                out = ImageProcessor.thumbnail(out, step[1:], tier)
+            else:
+                raise ValueError(f"未知步骤：{step[0]}")
+        return out
+    
+    def images(self, tier='export', workers=None, progress=None):
+        """并行处理所有图片，按输入顺序产出结果（跳过裁剪后为空的图片）"""
+        results = imap_bounded(
+            lambda path: self.process(path, tier), self.paths, workers, governor=ImageProcessor.memory
+        )
+        for i, out in enumerate(results):
+            if progress:
+                progress(i + 1, len(self.paths))
+            if out is not None:
+                yield out
+    
+    def render(self, fmt=None, tier='export', workers=None, progress=None):
+        """执行处理链并拼接，返回拼接结果；没有可拼接的图片时返回 None"""
+        if self.stitch_args is None:
+            raise ValueError("处理链没有拼接步骤")
+        mode, rows, cols, spacing, bg_color = self.stitch_args
+        images = list(self.images(tier, workers, progress))
+        if not images:
+            return None
+        out_mode = ImageProcessor.output_mode(images, fmt)
+        return ImageProcessor.stitch_images(images, mode, rows, cols, spacing, bg_color, out_mode, tier)
+    
+    def save(self, out_path, quality=95, workers=None, progress=None):
+        """拼接并原子写入 out_path，返回是否生成了输出"""
+        result = self.render(ImageProcessor.format_for_path(out_path), 'export', workers, progress)
+        if not result:
+            return False
+        ImageProcessor.save_atomic(result, out_path, quality=quality)
+        return True
+    
+    def save_each(self, out_dir, quality=95, workers=None, progress=None):
+        """不拼接，逐张处理后以原文件名写入 out_dir，返回写入的图片数"""
+        
+        def process_and_save(path):
+            out = self.process(path)
+            if out is None:
+                return False
+            out_path = os.path.join(out_dir, os.path.basename(path))
+            if ImageProcessor.format_for_path(out_path) == 'JPEG' and out.mode not in ('RGB', 'L'):
+                out = out.convert('RGB')
+            ImageProcessor.save_atomic(out, out_path, quality=quality)
+            return True
+        
+        os.makedirs(out_dir, exist_ok=True)
+        count = 0
+        results = imap_bounded(process_and_save, self.paths, workers, governor=ImageProcessor.memory)
+        for i, saved in enumerate(results):
+            count += saved
+            if progress:
+                progress(i + 1, len(self.paths))
+        return count
+
+
+class DecodeCache:
+    """解码缓存：把解码后的全分辨率像素以原始格式存到磁盘，再次打开时直接内存映射
+
+    以 路径 + 大小 + 修改时间 为键，文件名记录像素格式和尺寸；总大小超过上限时淘汰最久未用的。
+    只有 RGBA / L 是零拷贝映射。RGB 按每像素 3 字节存储（比 Pillow 内部的 4 字节布局小 1/4），
+    Pillow 不能直接映射 RGB 缓冲区，命中时会展开成一份内存中的副本：省掉解码，但不是零拷贝。
+    """
+
+    def __init__(self, cache_dir, max_bytes):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # 键 -> (文件名, 字节数)，按最近使用排序
+        self.total = 0
+        
+        # 按修改时间恢复上次运行留下的使用顺序
+        files = []
+        for entry in os.scandir(cache_dir):
+            if entry.name.endswith('.raw'):
+                st = entry.stat()
+                files.append((st.st_mtime, entry.name, st.st_size))
+        for _, name, size in sorted(files):
+            self.entries[name.split('_', 1)[0]] = (name, size)
+            self.total += size
+
+    @staticmethod
+    def make_key(path):
+        """缓存键：路径 + 大小 + 修改时间"""
+        st = ImageProcessor.source_stat(path)
+        return hashlib.sha1(f"{ArchiveReader.abspath(path)}|{st.st_size}|{st.st_mtime_ns}".encode('utf-8')).hexdigest()
+
+    def load(self, path):
+        """返回解码后的图片：命中时为映射到缓存文件的只读图片，未命中时解码并写入缓存"""
+        key = self.make_key(path)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry:
+                self.entries.move_to_end(key)
+        if entry:
+            img = self.map_file(entry[0])
+            if img is not None:
+                return img
+        
+        img = ImageProcessor.decode_image(path)
+        self.store(key, img)
+        return img
+
+    def map_file(self, name):
+        """把缓存文件映射为图片，失败时返回 None"""
+        import mmap
+        try:
+            _, rawmode, dims = name[:-len('.raw')].split('_')
+            size = tuple(int(v) for v in dims.split('x'))
+            file_path = os.path.join(self.cache_dir, name)
+            with open(file_path, 'rb') as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            os.utime(file_path)  # 记录最近使用
+            if rawmode == 'RGBX':
+                # 旧版本按 RGBX 存储的 RGB 条目
+                return Image.frombuffer('RGBX', size, mm, 'raw', 'RGBX', 0, 1).convert('RGB')
+            return Image.frombuffer(rawmode, size, mm, 'raw', rawmode, 0, 1)
+        except (OSError, ValueError):
+            return None
+
+    def store(self, key, img):
+        """把像素写入缓存（先写临时文件再重命名），并按容量淘汰旧条目"""
+        name = f"{key}_{img.mode}_{img.width}x{img.height}.raw"
+        data = img.tobytes()
+        if len(data) > self.max_bytes:
+            return
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=self.cache_dir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, os.path.join(self.cache_dir, name))
+        except OSError:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return
+        
+        with self.lock:
+            if key in self.entries:
+                self.total -= self.entries.pop(key)[1]
+            self.entries[key] = (name, len(data))
+            self.total += len(data)
+            while self.total > self.max_bytes and len(self.entries) > 1:
+                _, (old_name, old_size) = self.entries.popitem(last=False)
+                self.total -= old_size
+                try:
+                    os.remove(os.path.join(self.cache_dir, old_name))
+                except OSError:
+                    pass  # Windows 下仍被映射的文件无法删除，下次启动时再清理
+
+
+class BatchJournal:
+    """批处理日志：只追加记录已完成的输出，程序崩溃或中断后可以续跑
+
+    每行一条 JSON 记录 {"out": 输出路径, "key": 任务键, "out_stat": [大小, 修改时间], ...}，
+    同一输出以最后一条为准。任务键包含输入文件签名和参数，因此也用作增量构建缓存：
+    输入、参数和输出文件都没有变化的项目会被跳过。
+    """
+
+    FSYNC_EVERY = 64
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        lines = 0
+        needs_newline = False
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    lines += 1
+                    needs_newline = not line.endswith('\n')
+                    try:
+                        rec = json.loads(line)
+                    except ValueError:
+                        continue  # 崩溃时可能留下不完整的最后一行
+                    self.entries[rec['out']] = rec
+        
+        # 重复记录过多时压缩日志
+        if lines > 2 * len(self.entries) + 100:
+            self.compact()
+            needs_newline = False
+        
+        self.file = open(path, 'a', encoding='utf-8')
+        if needs_newline:
+            self.file.write('\n')
+        self.pending = 0
+        self.lock = threading.Lock()  # 并行批处理时多个工作线程同时记录
+
+    @staticmethod
+    def make_key(*parts):
+        """根据任务参数生成稳定的任务键"""
+        data = json.dumps(parts, ensure_ascii=False, sort_keys=True, default=str)
+        return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+    def is_done(self, out_path, key):
+        """该输出是否已由相同任务生成，且输出文件未被删除或改动"""
+        rec = self.entries.get(out_path)
+        if rec is None or rec.get('key') != key:
+            return False
+        try:
+            st = os.stat(out_path)
+        except OSError:
+            return False
+        return rec.get('out_stat') in (None, [st.st_size, st.st_mtime_ns])
+
+    def record(self, out_path, key, **info):
+        """追加一条完成记录（应在输出文件落盘之后调用）"""
+        rec = dict(info, out=out_path, key=key)
+        try:
+            st = os.stat(out_path)
+            rec['out_stat'] = [st.st_size, st.st_mtime_ns]
+        except OSError:
+            pass
+        with self.lock:
+            self.file.write(json.dumps(rec, ensure_ascii=False) + '\n')
+            self.file.flush()
+            self.entries[out_path] = rec
+            self.pending += 1
+            if self.pending >= self.FSYNC_EVERY:
+                os.fsync(self.file.fileno())
+                self.pending = 0
+
+    def compact(self):
+        """用当前有效记录重写日志"""
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for rec in self.entries.values():
+                f.write(json.dumps(rec, ensure_ascii=False) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def close(self):
+        """关闭日志文件"""
+        if self.file:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+            self.file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class MemoryGovernor:
+    """批处理内存调度：按图片头估算每项解码后的峰值内存，总量不超过预算时才放行
+
+    估算值为 宽 × 高 × 每像素字节数（Pillow 内部 RGB 也按 4 字节存储）× 同时存在的副本数
+    （裁剪时为解码图 + 裁剪结果两份，需要转换模式时再多一份）。单项超过预算时等其他任务
+    全部结束后独占执行。
+
+    Pillow 的解压炸弹阈值只在本调度放行的项目处理期间放宽到预算能容纳的像素数（见 pixel_limit），
+    超过预算两倍的图片仍被拒绝；没有批处理在运行时，界面和 HTTP 服务中打开的图片保持 Pillow 的默认阈值。
+    """
+
+    limit_lock = threading.Lock()
+    limit_users = 0          # 正在放宽阈值的 pixel_limit 数
+    saved_max_pixels = None  # 放宽前的 Image.MAX_IMAGE_PIXELS
+
+    def __init__(self, budget_bytes):
+        self.budget = budget_bytes
+        self.cond = threading.Condition()
+        self.used = 0
+        self.reset_peak()
+
+    def reset_peak(self):
+        """清零统计（每次批处理开始时调用）"""
+        with self.cond:
+            self.peak = self.used
+            self.largest = 0
+            self.waits = 0
+
+    @contextmanager
+    def pixel_limit(self):
+        """放宽解压炸弹阈值：超过预算字节数一半的像素数（按每像素 4 字节即超过预算两倍）才拒绝
+
+        Image.MAX_IMAGE_PIXELS 是进程级设置（Pillow 超过它两倍时报错），因此加锁计数：第一个进入时
+        保存原值并放宽，最后一个退出时恢复。放宽期间同一进程中其他线程打开的图片也按放宽后的阈值检查。
+        """
+        with MemoryGovernor.limit_lock:
+            if MemoryGovernor.limit_users == 0:
+                MemoryGovernor.saved_max_pixels = Image.MAX_IMAGE_PIXELS
+            MemoryGovernor.limit_users += 1
+            if Image.MAX_IMAGE_PIXELS is not None:
+                Image.MAX_IMAGE_PIXELS = max(Image.MAX_IMAGE_PIXELS, self.budget // 4)
+        try:
+            yield
+        finally:
+            with MemoryGovernor.limit_lock:
+                MemoryGovernor.limit_users -= 1
+                if MemoryGovernor.limit_users == 0:
+                    Image.MAX_IMAGE_PIXELS = MemoryGovernor.saved_max_pixels
+
+    def estimate(self, path, copies=2):
+        """只读图片头估算解码后的内存占用（字节）；无法识别时返回 0，交给后续处理报错"""
+        try:
+            # 只读取图片头，不解码，可以按放宽后的阈值打开
+            with self.pixel_limit(), ImageProcessor.source_file(path) as f, Image.open(f) as img:
+                size, mode = img.size, img.mode
+        except Exception:
+            return 0
+        return MemoryGovernor.cost(size, mode, copies)
+
+    @staticmethod
+    def cost(size, mode, copies=2):
+        """按尺寸和模式估算解码后的内存占用（字节）"""
+        w, h = size
+        if mode in ('1', 'L', 'P'):
+            per_pixel = 1
+        elif mode.startswith('I;16'):
+            per_pixel = 2
+        else:
+            per_pixel = 4
+        if mode not in ('RGB', 'RGBA', 'L'):
+            copies += 1  # normalize_mode 转换出的副本
+        return w * h * per_pixel * copies
+
+    def admit(self, path, copies=2):
+        """估算并占用内存额度，额度不足时阻塞；返回占用的字节数"""
+        return self.reserve(self.estimate(path, copies))
+
+    def reserve(self, cost):
+        """占用 cost 字节的额度，额度不足时阻塞；返回实际占用的字节数"""
+        with self.cond:
+            self.largest = max(self.largest, cost)
+            cost = min(cost, self.budget)  # 超出预算的单项独占执行
+            if self.used and self.used + cost > self.budget:
+                self.waits += 1
+                while self.used and self.used + cost > self.budget:
+                    self.cond.wait()
+            self.used += cost
+            self.peak = max(self.peak, self.used)
+        return cost
+
+    def release(self, cost):
+        with self.cond:
+            self.used -= cost
+            self.cond.notify_all()
+
+    def run(self, cost, fn, *args):
+        """执行已占用额度的 fn（期间放宽解压炸弹阈值），结束后归还额度"""
+        try:
+            with self.pixel_limit():
+                return fn(*args)
+        finally:
+            self.release(cost)
+
+    def report(self):
+        """运行统计"""
+        mb = 1024 * 1024
+        msg = f"估算内存峰值 {self.peak / mb:.0f} MB / 预算 {self.budget / mb:.0f} MB"
+        if self.waits:
+            msg += f"，因内存不足排队 {self.waits} 次"
+        if self.largest > self.budget:
+            msg += f"，最大单张约 {self.largest / mb:.0f} MB（已独占执行）"
+        return msg
+
+
+class ArchiveWriter:
+    """把批处理输出顺序写入一个 zip / tar 压缩包，代替逐个创建小文件
+
+    工作线程只负责编码，add() 把编码好的数据放入有界队列，由唯一的写线程按顺序写入。
+    图片本身已经压缩，zip 成员一律不再压缩（STORED）。关闭时附带 manifest.json 清单，
+    全部写完后才把临时文件重命名为目标文件名；出错或中途取消时不留下半个压缩包。
+    """
+
+    EXTENSIONS = ('.zip', '.tar')
+    MANIFEST = 'manifest.json'
+
+    def __init__(self, path, manifest=True, max_pending=32):
+        import queue
+        import tarfile
+        import zipfile
+        if not self.is_archive(path):
+            raise ValueError(f"不支持的压缩包格式：{path}")
+        self.path = path
+        self.manifest = manifest
+        directory, name = os.path.split(os.path.abspath(path))
+        fd, self.tmp_path = tempfile.mkstemp(prefix=f".{name}.", suffix=".tmp", dir=directory)
+        os.close(fd)
+        if path.lower().endswith('.zip'):
+            self.zip = zipfile.ZipFile(self.tmp_path, 'w', zipfile.ZIP_STORED)
+            self.tar = None
+        else:
+            self.zip = None
+            self.tar = tarfile.open(self.tmp_path, 'w', format=tarfile.PAX_FORMAT)
+        self.queue = queue.Queue(max_pending)
+        self.entries = []
+        self.names = set()
+        self.error = None
+        self.thread = threading.Thread(target=self.write_loop, name="archive-writer", daemon=True)
+        self.thread.start()
+
+    @classmethod
+    def is_archive(cls, path):
+        """按扩展名判断是否为压缩包输出"""
+        return path.lower().endswith(cls.EXTENSIONS)
+
+    def add(self, name, data, **info):
+        """加入一个成员（可在任意线程调用；写线程来不及时阻塞等待）"""
+        if self.error:
+            raise self.error
+        self.queue.put((name, data, info))
+
+    def write_loop(self):
+        """写线程：依次写入队列中的成员"""
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if self.error:
+                continue  # 出错后只清空队列，不再写入
+            try:
+                self.write_member(*item)
+            except Exception as e:
+                self.error = e
+
+    def write_member(self, name, data, info):
+        """写入一个成员；重名时自动加序号"""
+        import io
+        stem, ext = os.path.splitext(name)
+        n = 1
+        while name in self.names:
+            n += 1
+            name = f"{stem}_{n}{ext}"
+        self.names.add(name)
+        if self.zip is not None:
+            import zipfile
+            zinfo = zipfile.ZipInfo(name, date_time=time.localtime()[:6])
+            self.zip.writestr(zinfo, data, compress_type=zipfile.ZIP_STORED)
+        else:
+            import tarfile
+            tinfo = tarfile.TarInfo(name)
+            tinfo.size = len(data)
+            tinfo.mtime = time.time()
+            self.tar.addfile(tinfo, io.BytesIO(data))
+        self.entries.append(dict(info, name=name, size=len(data)))
+
+    def finish(self):
+        """等待写线程写完队列中的成员"""
+        self.queue.put(None)
+        self.thread.join()
+
+    def close(self):
+        """写入清单并完成压缩包，返回成员数"""
+        self.finish()
+        try:
+            if self.error:
+                raise self.error
+            if self.manifest:
+                data = json.dumps({'count': len(self.entries), 'entries': self.entries},
+                                  ensure_ascii=False, indent=1).encode('utf-8')
+                self.write_member(self.MANIFEST, data, {})
+            (self.zip or self.tar).close()
+            os.replace(self.tmp_path, self.path)
+        except BaseException:
+            self.abort()
+            raise
+        return len(self.entries)
+
+    def abort(self):
+        """放弃写入并删除临时文件"""
+        if self.thread.is_alive():
+            self.error = self.error or RuntimeError("写入已中止")
+            self.finish()
+        try:
+            (self.zip or self.tar).close()
+        except Exception:
+            pass
+        try:
+            os.remove(self.tmp_path)
+        except OSError:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+MemberStat = namedtuple('MemberStat', 'st_size st_mtime st_mtime_ns')
+
+
+class MemberFile:
+    """压缩包中未压缩成员的只读文件视图：直接在内存映射上按偏移读取，不先整体复制"""
+
+    def __init__(self, buf, start, size):
+        self.buf = buf
+        self.start = start
+        self.size = size
+        self.pos = 0
+
+    def read(self, n=-1):
+        end = self.size if n is None or n < 0 else min(self.size, self.pos + n)
+        if end <= self.pos:
+            return b''
+        data = self.buf[self.start + self.pos:self.start + end]
+        self.pos = end
+        return data
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.pos
+        elif whence == 2:
+            offset += self.size
+        self.pos = max(0, offset)
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def close(self):
+        self.buf = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ArchiveReader:
+    """以「压缩包::成员」路径随机读取 zip / tar 中的图片，不解压到磁盘
+
+    打开时只建立一次成员索引（名称 -> 数据偏移、大小、修改时间）。未压缩的 zip 成员和 tar 成员
+    通过内存映射按偏移直接读取；压缩过的 zip 成员读取时在内存中解压。
+    读取器按压缩包路径缓存，压缩包被修改后自动重建索引。
+    """
+
+    SEP = '::'
+    IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.tiff', '.webp')
+    MAX_OPEN = 8
+    cache = OrderedDict()
+    cache_lock = threading.Lock()
+
+    def __init__(self, path):
+        import mmap
+        import tarfile
+        import zipfile
+        self.path = path
+        self.members = {}  # 成员名 -> (数据偏移, 大小, 修改时间, 是否压缩)
+        with open(path, 'rb') as f:
+            self.buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size else b''
+        self.zip = None
+        if path.lower().endswith('.zip'):
+            self.zip = zipfile.ZipFile(path)
+            for info in self.zip.infolist():
+                if info.is_dir() or not self.is_image(info.filename):
+                    continue
+                # 本地文件头：30 字节定长部分 + 文件名 + 扩展字段
+                name_len, extra_len = struct.unpack('<HH', self.buf[info.header_offset + 26:info.header_offset + 30])
+                offset = info.header_offset + 30 + name_len + extra_len
+                mtime = time.mktime(info.date_time + (0, 0, -1))
+                compressed = info.compress_type != zipfile.ZIP_STORED
+                self.members[info.filename] = (offset, info.file_size, mtime, compressed)
+        else:
+            with tarfile.open(path, 'r:') as tar:
+                for info in tar:
+                    if info.isfile() and self.is_image(info.name):
+                        self.members[info.name] = (info.offset_data, info.size, float(info.mtime), False)
+
+    @classmethod
+    def is_image(cls, name):
+        """按扩展名判断成员是否为图片（跳过 macOS 打包时附带的元数据）"""
+        return name.lower().endswith(cls.IMAGE_EXTENSIONS) and not name.startswith('__MACOSX/')
+
+    @classmethod
+    def split(cls, path):
+        """拆分虚拟路径，返回 (压缩包路径, 成员名)；普通路径的成员名为 None"""
+        archive, sep, member = path.partition(cls.SEP)
+        if not sep:
+            return path, None
+        return archive, member
+
+    @classmethod
+    def join(cls, archive, member):
+        return f"{archive}{cls.SEP}{member}"
+
+    @classmethod
+    def abspath(cls, path):
+        """绝对路径；虚拟路径只规范化压缩包部分，成员名原样保留"""
+        archive, member = cls.split(path)
+        if member is None:
+            return os.path.abspath(path)
+        return cls.join(os.path.abspath(archive), member)
+
+    @classmethod
+    def get(cls, path):
+        """取得（必要时打开）压缩包读取器"""
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        key = (path, st.st_size, st.st_mtime_ns)
+        with cls.cache_lock:
+            reader = cls.cache.get(key)
+            if reader is not None:
+                cls.cache.move_to_end(key)
+                return reader
+        reader = cls(path)
+        with cls.cache_lock:
+            cls.cache[key] = reader
+            # 淘汰的读取器不主动关闭，仍在读取的成员文件持有映射，用完后自动释放
+            while len(cls.cache) > cls.MAX_OPEN:
+                cls.cache.popitem(last=False)
+        return reader
+
+    def image_paths(self):
+        """压缩包中所有图片的虚拟路径（按成员名排序）"""
+        return [self.join(self.path, name) for name in sorted(self.members)]
+
+    def stat(self, name):
+        try:
+            _, size, mtime, _ = self.members[name]
+        except KeyError:
+            raise FileNotFoundError(self.join(self.path, name))
+        return MemberStat(size, mtime, int(mtime * 1e9))
+
+    def open(self, name):
+        """以只读文件对象打开成员"""
+        try:
+            offset, size, _, compressed = self.members[name]
+        except KeyError:
+            raise FileNotFoundError(self.join(self.path, name))
+        if compressed:
+            import io
+            return io.BytesIO(self.zip.read(name))
+        return MemberFile(self.buf, offset, size)
+
+
+def expand_archives(paths):
+    """把路径列表中的 zip / tar 压缩包展开为其中图片的虚拟路径，其他路径原样保留"""
+    expanded = []
+    for path in paths:
+        if ArchiveWriter.is_archive(path) and os.path.isfile(path):
+            try:
+                expanded.extend(ArchiveReader.get(path).image_paths())
+            except Exception as e:
+                print(f"读取压缩包 {path} 时出错：{e}")
+        else:
+            expanded.append(path)
+    return expanded
+
+
+class WorkQueue:
+    """基于 SQLite 文件的批处理任务队列（多机分片处理）
+
+    协调端把任务切分成若干块写入队列，各机器上的工作进程领取块并持有租约，
+    处理期间定期续租；租约到期仍未完成（工作进程崩溃或失联）的块会重新分配。
+    数据库文件放在各机器都能访问的共享目录中即可（共享文件系统需支持文件锁）。
+    """
+
+    MAX_ATTEMPTS = 3
+
+    def __init__(self, db_path, lease_seconds=300):
+        import sqlite3
+        self.db_path = db_path
+        self.lease_seconds = lease_seconds
+        self.conn = sqlite3.connect(db_path, timeout=60, isolation_level=None)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY,
+                op TEXT NOT NULL,
+                params TEXT NOT NULL,
+                created REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS chunks (
+                id INTEGER PRIMARY KEY,
+                job_id INTEGER NOT NULL,
+                items TEXT NOT NULL,
+                state TEXT NOT NULL DEFAULT 'pending',
+                worker TEXT,
+                lease_until REAL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                error TEXT
+            );
+            CREATE INDEX IF NOT EXISTS chunks_state ON chunks (state, lease_until);
+        """)
+
+    def transaction(self, fn):
+        """在写事务中执行 fn(conn)"""
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            result = fn(self.conn)
+            self.conn.execute("COMMIT")
+            return result
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+
+    def submit(self, op, params, items, chunk_size=50):
+        """提交任务：items 按 chunk_size 切块，返回任务编号"""
+        def do(conn):
+            cur = conn.execute(
+                "INSERT INTO jobs (op, params, created) VALUES (?, ?, ?)",
+                (op, json.dumps(params, ensure_ascii=False), time.time())
+            )
+            job_id = cur.lastrowid
+            for i in range(0, len(items), chunk_size):
+                conn.execute(
+                    "INSERT INTO chunks (job_id, items) VALUES (?, ?)",
+                    (job_id, json.dumps(items[i:i + chunk_size], ensure_ascii=False))
+                )
+            return job_id
+        return self.transaction(do)
+
+    def lease(self, worker):
+        """领取一个待处理或租约已过期的块，返回 (块编号, 操作, 参数, 项目列表) 或 None"""
+        def do(conn):
+            now = time.time()
+            # 多次租约过期的块视为失败，避免反复拖垮工作进程
+            conn.execute(
+                "UPDATE chunks SET state = 'failed', error = '租约多次过期' "
+                "WHERE state = 'leased' AND lease_until < ? AND attempts >= ?",
+                (now, self.MAX_ATTEMPTS)
+            )
+            row = conn.execute(
+                "SELECT c.id, j.op, j.params, c.items FROM chunks c JOIN jobs j ON j.id = c.job_id "
+                "WHERE c.state = 'pending' OR (c.state = 'leased' AND c.lease_until < ?) "
+                "ORDER BY c.id LIMIT 1",
+                (now,)
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                "UPDATE chunks SET state = 'leased', worker = ?, lease_until = ?, attempts = attempts + 1 "
+                "WHERE id = ?",
+                (worker, now + self.lease_seconds, row[0])
+            )
+            return row[0], row[1], json.loads(row[2]), json.loads(row[3])
+        return self.transaction(do)
+
+    def renew(self, chunk_id, worker):
+        """续租，返回租约是否仍属于该工作进程"""
+        cur = self.conn.execute(
+            "UPDATE chunks SET lease_until = ? WHERE id = ? AND worker = ? AND state = 'leased'",
+            (time.time() + self.lease_seconds, chunk_id, worker)
+        )
+        return cur.rowcount == 1
+
+    def complete(self, chunk_id, worker, error=None):
+        """标记块完成；error 为逐项错误说明（不会重试）"""
+        self.conn.execute(
+            "UPDATE chunks SET state = 'done', error = ?, lease_until = NULL "
+            "WHERE id = ? AND worker = ? AND state = 'leased'",
+            (error, chunk_id, worker)
+        )
+
+    def status(self):
+        """各状态的块数量"""
+        counts = {'pending': 0, 'leased': 0, 'done': 0, 'failed': 0}
+        for state, n in self.conn.execute("SELECT state, COUNT(*) FROM chunks GROUP BY state"):
+            counts[state] = n
+        return counts
+
+    def close(self):
+        """关闭数据库连接"""
+        self.conn.close()
+
+
+def run_work_item(op, item, params):
+    """执行队列中的单个项目"""
+    if op == 'crop':
+        os.makedirs(params['out_dir'], exist_ok=True)
+        margins = (params.get('left', 0), params.get('top', 0), params.get('right', 0), params.get('bottom', 0))
+        if params.get('fit'):
+            # 裁剪后缩小，一次解码完成，不经过中间文件
+            Pipeline([item]).crop(*margins).fit(*params['fit']).save_each(params['out_dir'], params.get('quality', 95), 1)
+        else:
+            out_path = os.path.join(params['out_dir'], os.path.basename(item))
+            ImageProcessor.crop_file(item, out_path, *margins, params.get('quality', 95))
+    elif op == 'stitch':
+        os.makedirs(os.path.dirname(item['out']), exist_ok=True)
+        ImageProcessor.stitch_files(
+            item['inputs'], item['out'], params.get('mode', 'grid'),
+            params.get('rows', 0), params.get('cols', 0), params.get('spacing', 0),
+            tuple(params.get('bg_color', (255, 255, 255))), params.get('quality', 95),
+            tuple(params.get('cell_size', (300, 300))), params.get('crop')
+        )
+    else:
+        raise ValueError(f"未知操作：{op}")
+
+
+def run_worker(db_path, worker_id=None, lease_seconds=300, poll_interval=2.0):
+    """工作进程：循环领取任务块并执行，队列全部完成后退出"""
+    worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+    queue = WorkQueue(db_path, lease_seconds)
+    
+    def heartbeat(chunk_id, stop):
+        hb_queue = WorkQueue(db_path, lease_seconds)
+        try:
+            while not stop.wait(lease_seconds / 3):
+                if not hb_queue.renew(chunk_id, worker_id):
+                    break
+        finally:
+            hb_queue.close()
+    
+    processed = 0
+    try:
+        while True:
+            task = queue.lease(worker_id)
+            if task is None:
+                status = queue.status()
+                if not status['pending'] and not status['leased']:
+                    break
+                # 其他进程持有租约，等待其完成或过期
+                time.sleep(poll_interval)
+                continue
+            
+            chunk_id, op, params, items = task
+            stop = threading.Event()
+            hb = threading.Thread(target=heartbeat, args=(chunk_id, stop), daemon=True)
+            hb.start()
+            errors = []
+            try:
+                for item in items:
+                    try:
+                        run_work_item(op, item, params)
+                        processed += 1
+                    except Exception as e:
+                        errors.append(f"{item}: {e}")
+            finally:
+                stop.set()
+                hb.join()
+            queue.complete(chunk_id, worker_id, "\n".join(errors) or None)
+            print(f"[{worker_id}] 完成块 {chunk_id}（{len(items)} 项，失败 {len(errors)} 项）")
+    finally:
+        queue.close()
+    return processed
+
+
+class FolderWatcher:
+    """监视文件夹：按保存的处理方案自动处理新到达的图片
+
+    定时扫描输入目录（不依赖系统文件通知，网络共享目录同样适用）。文件大小和修改时间
+    连续 settle 秒不变才视为写入完成；同一次扫描中就绪的文件作为一批并行处理。
+    已完成的输出记入 BatchJournal，重启后不会重复处理；输入文件被覆盖（签名变化）时重新处理。
+    """
+    
+    IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff', '.webp')
+    RECIPE_DEFAULTS = {
+        "crop": [0, 0, 0, 0],   # 左、上、右、下边距
+        "fit": None,            # [宽, 高]：裁剪后等比缩小到不超过该尺寸
+        "format": "",           # 输出扩展名（如 "jpg"），留空保持原格式
+        "quality": 95,
+    }
+    JOURNAL_NAME = '.watch_journal.jsonl'
+    
+    def __init__(self, in_dir, out_dir, recipe, settle=2.0, poll=1.0, batch_max=64, max_retries=3, workers=None):
+        self.in_dir = in_dir
+        self.out_dir = out_dir
+        self.recipe = dict(FolderWatcher.RECIPE_DEFAULTS, **recipe)
+        self.settle = settle
+        self.poll = poll
+        self.batch_max = batch_max
+        self.max_retries = max_retries
+        self.workers = workers
+        self.journal = None
+        self.candidates = {}  # 路径 -> (签名, 签名保持不变的起始时间, 首次发现时间)
+        self.handled = {}     # 路径 -> 已处理时的签名
+        self.retries = {}     # 路径 -> 已失败次数
+        self.lock = threading.Lock()
+        # 统计
+        self.started = time.monotonic()
+        self.busy = 0.0
+        self.done = self.skipped = self.failed = 0
+        self.latencies = []
+    
     @staticmethod
-    def crop_image(img, left, top, right, bottom):
-        """裁剪图片"""
-        w, h = img.size
-        r = max(left, w - right)
-        b = max(top, h - bottom)
-        if r <= left or b <= top:
-            return None
-        return img.crop((left, top, r, b))
+    def load_recipe(path):
+        """读取处理方案（JSON），缺省项使用默认值"""
+        with open(path, 'r', encoding='utf-8') as f:
+            recipe = dict(FolderWatcher.RECIPE_DEFAULTS, **json.load(f))
+        if len(recipe['crop']) != 4:
+            raise ValueError("处理方案的 crop 应为 [左, 上, 右, 下]")
+        if recipe['fit'] and len(recipe['fit']) != 2:
+            raise ValueError("处理方案的 fit 应为 [宽, 高]")
+        return recipe
     
     @staticmethod
-    def stitch_images_grid(images, rows, cols, spacing, bg_color=(255, 255, 255)):
-        """网格拼接图片"""
-        if not images:
+    def save_recipe(path, recipe):
+        """保存处理方案"""
+        recipe = dict(FolderWatcher.RECIPE_DEFAULTS, **recipe)
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(recipe, f, ensure_ascii=False, indent=2)
+    
+    def output_path(self, path):
+        """输出文件路径：原文件名，按方案替换扩展名"""
+        name = os.path.basename(path)
+        if self.recipe['format']:
+            name = os.path.splitext(name)[0] + '.' + self.recipe['format'].lstrip('.').lower()
+        return os.path.join(self.out_dir, name)
+    
+    def scan(self):
+        """扫描输入目录，返回已写入完成、尚未处理的文件（按首次发现的先后排序）"""
+        now = time.monotonic()
+        present = set()
+        ready = []
+        with os.scandir(self.in_dir) as it:
+            for entry in it:
+                name = entry.name
+                # 跳过隐藏文件和复制工具的临时文件（如 .xxx.jpg.part）
+                if name.startswith('.') or not name.lower().endswith(self.IMAGE_EXTENSIONS):
+                    continue
+                try:
+                    if not entry.is_file():
+                        continue
+                    st = entry.stat()
+                except OSError:
+                    continue  # 扫描期间被删除或移走
+                path = entry.path
+                present.add(path)
+                sig = (st.st_size, st.st_mtime_ns)
+                if self.handled.get(path) == sig:
+                    continue
+                cand = self.candidates.get(path)
+                if cand is None or cand[0] != sig:
+                    # 新文件或仍在写入：重新计时
+                    self.candidates[path] = (sig, now, cand[2] if cand else now)
+                    continue
+                if st.st_size and now - cand[1] >= self.settle:
+                    ready.append(path)
+        
+        # 已不存在的文件不再跟踪
+        for table in (self.candidates, self.handled, self.retries):
+            for path in [p for p in table if p not in present]:
+                del table[path]
+        ready.sort(key=lambda p: self.candidates[p][2])
+        return ready
+    
+    def process_one(self, path):
+        """按方案处理单个文件，返回 'done' / 'skipped' / 'empty' / 'retry' / 'failed'"""
+        sig, _, first_seen = self.candidates[path]
+        out_path = self.output_path(path)
+        try:
+            key = BatchJournal.make_key(ImageProcessor.file_signature(path), self.recipe)
+            if self.journal.is_done(out_path, key):
+                return 'skipped'
+            pipe = Pipeline([path]).crop(*self.recipe['crop'])
+            if self.recipe['fit']:
+                pipe = pipe.fit(*self.recipe['fit'])
+            out = pipe.process(path)
+            if out is None:
+                return 'empty'
+            if ImageProcessor.format_for_path(out_path) == 'JPEG' and out.mode not in ('RGB', 'L'):
+                out = out.convert('RGB')
+            ImageProcessor.save_atomic(out, out_path, quality=self.recipe['quality'])
+            latency = time.monotonic() - first_seen
+            self.journal.record(out_path, key, src=path, latency=round(latency, 3))
+            with self.lock:
+                self.latencies.append(latency)
+            return 'done'
+        except Exception as e:
+            # 文件被占用或内容不完整时下次扫描重试，超过次数后放弃（文件再次变化时仍会处理）
+            with self.lock:
+                self.retries[path] = self.retries.get(path, 0) + 1
+                if self.retries[path] < self.max_retries:
+                    return 'retry'
+            print(f"处理 {path} 时出错：{e}")
+            return 'failed'
+    
+    def process_batch(self, paths):
+        """并行处理一批就绪的文件，返回各结果的计数"""
+        t0 = time.monotonic()
+        counts = {}
+        results = imap_bounded(self.process_one, paths, self.workers, governor=ImageProcessor.memory)
+        for path, result in zip(paths, results):
+            counts[result] = counts.get(result, 0) + 1
+            if result != 'retry':
+                self.handled[path] = self.candidates.pop(path)[0]
+                self.retries.pop(path, None)
+        elapsed = time.monotonic() - t0
+        self.busy += elapsed
+        self.done += counts.get('done', 0)
+        self.skipped += counts.get('skipped', 0)
+        self.failed += counts.get('failed', 0)
+        return counts, elapsed
+    
+    def latency_stats(self):
+        """输出延迟（从发现文件到输出写入）的中位数、P95 和最大值（秒）"""
+        if not self.latencies:
             return None
+        ordered = sorted(self.latencies)
+        p50 = ordered[len(ordered) // 2]
+        p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+        return p50, p95, ordered[-1]
+    
+    def report(self):
+        """累计统计"""
+        wall = time.monotonic() - self.started
+        lines = [
+            f"已处理 {self.done} 张，跳过 {self.skipped} 张，失败 {self.failed} 张，运行 {wall:.0f} 秒",
+            f"吞吐：{self.done / self.busy if self.busy else 0:.1f} 张/秒（处理中），"
+            f"{self.done / wall if wall else 0:.2f} 张/秒（全程）",
+        ]
+        stats = self.latency_stats()
+        if stats:
+            lines.append("延迟：中位 {:.2f} 秒，P95 {:.2f} 秒，最大 {:.2f} 秒".format(*stats))
+        return "\n".join(lines)
+    
+    def run(self, stop=None, once=False):
+        """持续监视直到 stop 被设置；once 为真时处理完当前已有的文件后退出"""
+        stop = stop or threading.Event()
+        os.makedirs(self.out_dir, exist_ok=True)
+        with BatchJournal(os.path.join(self.out_dir, self.JOURNAL_NAME)) as journal:
+            self.journal = journal
+            try:
+                while True:
+                    ready = self.scan()
+                    # 突发到达时按批并行处理，每批结束后输出本批统计
+                    for i in range(0, len(ready), self.batch_max):
+                        batch = ready[i:i + self.batch_max]
+                        counts, elapsed = self.process_batch(batch)
+                        stats = self.latency_stats()
+                        if set(counts) == {'retry'}:
+                            continue  # 只有待重试的文件时不输出
+                        print(
+                            f"[{time.strftime('%H:%M:%S')}] 本批 {len(batch)} 张："
+                            f"完成 {counts.get('done', 0)}，跳过 {counts.get('skipped', 0)}，"
+                            f"失败 {counts.get('failed', 0)}，耗时 {elapsed:.2f} 秒"
+                            f"（{len(batch) / elapsed if elapsed else 0:.1f} 张/秒）"
+                            + (f"，延迟中位 {stats[0]:.2f} 秒" if stats else ""),
+                            flush=True
+                        )
+                        if stop.is_set():
+                            return
+                    # 空文件可能永远写不完，单次模式不等待它们
+                    if once and not any(sig[0] for sig, _, _ in self.candidates.values()):
+                        return
+                    if stop.wait(self.poll):
+                        return
+            finally:
+                self.journal = None
+
+
+class QueueWaitExceeded(Exception):
+    """请求排队时间超过配置上限"""
+
+
+class ImageService:
+    """本地 HTTP 服务：以接口形式提供裁剪和拼接
+
+    POST /crop?left=&top=&right=&bottom=&format=jpg   请求体为一张图片
+    POST /stitch?mode=grid&rows=&cols=&spacing=&bg=FFFFFF&format=jpg
+                                                      请求体为 multipart/form-data，按顺序包含多张图片
+    GET  /health                                      返回运行状态
+
+    请求先占用排队名额，名额用完立即返回 503（背压）；实际处理在固定大小的工作线程池中进行，
+    处理超时的请求立即返回 504，但名额要等任务真正结束才归还，排队和处理中的总数始终不超过上限。
+    请求体和响应体都经由临时文件分块读写，multipart 请求体逐块解析，各部分分别写入临时文件，
+    大图不会整块驻留内存。
+    """
+
+    FORMATS = {'jpg': ('JPEG', 'image/jpeg'), 'jpeg': ('JPEG', 'image/jpeg'),
+               'png': ('PNG', 'image/png'), 'webp': ('WEBP', 'image/webp')}
+    CHUNK = 64 * 1024
+
+    def __init__(self, config):
+        from concurrent.futures import ThreadPoolExecutor
+        self.config = config
+        self.pool = ThreadPoolExecutor(max_workers=config['workers'])
+        self.slots = threading.BoundedSemaphore(config['workers'] + config['queue_size'])
+        self.lock = threading.Lock()
+        self.stats = {'active': 0, 'served': 0, 'rejected': 0, 'timeouts': 0, 'errors': 0}
+
+    def bump(self, name, delta=1):
+        """更新统计计数"""
+        with self.lock:
+            self.stats[name] += delta
+
+    def run_limited(self, fn, *args):
+        """在工作线程池中执行，遵守排队等待和处理超时限制
+
+        调用方已占用一个排队名额，由本函数负责归还：任务执行完毕（或尚未开始即被取消）时才归还，
+        超时返回后仍在运行的任务继续占用名额。
+        """
+        from concurrent.futures import TimeoutError as FutureTimeout
+        enqueued = time.monotonic()
+        
+        def task():
+            if time.monotonic() - enqueued > self.config['max_queue_wait']:
+                raise QueueWaitExceeded()
+            self.bump('active')
+            try:
+                return fn(*args)
+            finally:
+                self.bump('active', -1)
         
-        # 自动计算行列数
-        if rows <= 0 and cols <= 0:
-            cols = math.ceil(math.sqrt(len(images)))
-            rows = math.ceil(len(images) / cols)
-        elif rows <= 0:
-            rows = math.ceil(len(images) / cols)
-        elif cols <= 0:
-            cols = math.ceil(len(images) / rows)
-        
-        # 计算每个单元格大小
-        cell_w = max(img.width for img in images)
-        cell_h = max(img.height for img in images)
-        
-        # 计算输出图片大小
-        out_w = cols * cell_w + spacing * (cols - 1) if cols > 0 else cell_w
-        out_h = rows * cell_h + spacing * (rows - 1) if rows > 0 else cell_h
-        out = Image.new('RGB', (out_w, out_h), bg_color)
-        
-        # 粘贴图片
-        for idx, img in enumerate(images):
-            if idx >= rows * cols:
-                break
-            r = idx // cols
-            c = idx % cols
-            
-            # 等比例缩放以适应单元格
-            ratio = min(cell_w / img.width, cell_h / img.height)
-            new_size = (int(img.width * ratio), int(img.height * ratio))
-            resized_img = img.resize(new_size, Image.Resampling.LANCZOS)
-            
-            # 计算居中位置
-            offset_x = c * (cell_w + spacing) + (cell_w - resized_img.width) // 2
-            offset_y = r * (cell_h + spacing) + (cell_h - resized_img.height) // 2
-            out.paste(resized_img, (offset_x, offset_y))
-        
+        future = self.pool.submit(task)
+        future.add_done_callback(lambda f: self.slots.release())
+        try:
+            return future.result(timeout=self.config['request_timeout'])
+        except FutureTimeout:
+            future.cancel()
+            raise
+
+    @staticmethod
+    def encode(img, fmt, quality):
+        """把结果编码到临时文件，返回文件对象"""
+        out = tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024)
+        name, _ = ImageService.FORMATS[fmt]
+        if name == 'JPEG' and img.mode not in ('RGB', 'L'):
+            img = img.convert('RGB')
+        img.save(out, format=name, quality=quality)
+        out.seek(0)
         return out
-    
+
     @staticmethod
-    def stitch_images_horizontal(images, spacing, bg_color=(255, 255, 255)):
-        """水平拼接图片"""
-        if not images:
-            return None
-        
-        max_h = max(img.height for img in images)
-        resized = []
-        total_w = spacing * (len(images) - 1)
+    def reserve(images):
+        """按已打开（尚未解码）的图片头向内存调度占用额度，返回占用的字节数
+
+        上传的图片不放宽解压炸弹阈值，超过 Pillow 默认阈值的图片在打开时已被拒绝。
+        """
+        if ImageProcessor.memory is None:
+            return 0
+        cost = sum(MemoryGovernor.cost(img.size, img.mode) for img in images)
+        return ImageProcessor.memory.reserve(cost)
+
+    def do_crop(self, body, query):
+        """裁剪接口的处理函数"""
+        with Image.open(body) as img:
+            cost = self.reserve([img])
+            try:
+                cropped = ImageProcessor.crop_image(
+                    img, int(query.get('left', 0)), int(query.get('top', 0)),
+                    int(query.get('right', 0)), int(query.get('bottom', 0))
+                )
+                if not cropped:
+                    raise ValueError("裁剪区域为空")
+                return self.encode(cropped, query.get('format', 'jpg'), int(query.get('quality', 95)))
+            finally:
+                if cost:
+                    ImageProcessor.memory.release(cost)
+
+    @staticmethod
+    def split_multipart(body, content_type, chunk_size=64 * 1024):
+        """逐块解析 multipart 请求体，每个部分的内容写入单独的临时文件，按顺序返回文件列表
+
+        内存中只保留一个读取块和可能跨块的分隔符，不会把整个请求体读入内存。
+        """
+        import re
+        match = re.search(r'boundary="?([^";]+)"?', content_type)
+        if not content_type.lower().startswith('multipart/') or not match:
+            raise ValueError("拼接请求需要 multipart/form-data 请求体")
+        delimiter = b'\r\n--' + match.group(1).encode('latin-1')
+        keep = len(delimiter) - 1  # 块末尾可能是分隔符的前半部分，留到下一块再判断
+        
+        parts = []
+        part = None
+        state = 'preamble'
+        buf = b'\r\n'  # 第一个分隔符前没有换行，补上后可以统一查找
+        try:
+            while state != 'done':
+                chunk = body.read(chunk_size)
+                buf += chunk
+                while True:
+                    if state in ('preamble', 'body'):
+                        i = buf.find(delimiter)
+                        if i < 0:
+                            if len(buf) > keep:
+                                if state == 'body':
+                                    part.write(buf[:-keep])
+                                buf = buf[-keep:]
+                            break
+                        if state == 'body':
+                            part.write(buf[:i])
+                            part.seek(0)
+                            parts.append(part)
+                            part = None
+                        buf = buf[i + len(delimiter):]
+                        state = 'delimiter'
+                    if state == 'delimiter':
+                        # 分隔符后为 "--" 表示结束，否则跳过到行尾
+                        if len(buf) < 2:
+                            break
+                        if buf.startswith(b'--'):
+                            state = 'done'
+                            break
+                        j = buf.find(b'\r\n')
+                        if j < 0:
+                            break
+                        buf = buf[j + 2:]
+                        state = 'headers'
+                    if state == 'headers':
+                        j = 0 if buf.startswith(b'\r\n') else buf.find(b'\r\n\r\n')
+                        if j < 0:
+                            if len(buf) > 16 * 1024:
+                                raise ValueError("multipart 部分头过长")
+                            break
+                        buf = buf[j + (2 if j == 0 else 4):]
+                        part = tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024)
+                        state = 'body'
+                if not chunk and state != 'done':
+                    raise ValueError("multipart 请求体不完整")
+        except BaseException:
+            for f in parts + ([part] if part else []):
+                f.close()
+            raise
+        return parts
+
+    def do_stitch(self, body, query, content_type):
+        """拼接接口的处理函数"""
+        parts = self.split_multipart(body, content_type, self.CHUNK)
+        try:
+            opened = [Image.open(part) for part in parts]
+            if not opened:
+                raise ValueError("没有上传图片")
+            cost = self.reserve(opened)
+            try:
+                images = [ImageProcessor.normalize_mode(img) for img in opened]
+                return self.stitch_uploaded(images, query)
+            finally:
+                if cost:
+                    ImageProcessor.memory.release(cost)
+        finally:
+            for part in parts:
+                part.close()
+
+    def stitch_uploaded(self, images, query):
+        """按查询参数拼接已解码的上传图片，返回编码结果"""
+        spacing = int(query.get('spacing', 0))
+        bg = query.get('bg', 'FFFFFF').lstrip('#')
+        bg_color = tuple(int(bg[i:i+2], 16) for i in (0, 2, 4))
+        out_mode = ImageProcessor.output_mode(images, self.FORMATS[query.get('format', 'jpg')][0])
+        mode = query.get('mode', 'grid')
+        if mode == 'grid':
+            result = ImageProcessor.stitch_images_grid(
+                images, int(query.get('rows', 0)), int(query.get('cols', 0)), spacing, bg_color, out_mode
+            )
+        elif mode == 'horizontal':
+            result = ImageProcessor.stitch_images_horizontal(images, spacing, bg_color, out_mode)
+        elif mode == 'vertical':
+            result = ImageProcessor.stitch_images_vertical(images, spacing, bg_color, out_mode)
+        elif mode == 'vertical_overlap':
+            result = ImageProcessor.stitch_images_vertical_overlap(images, bg_color, out_mode)
+        else:
+            raise ValueError(f"未知拼接模式：{mode}")
+        return self.encode(result, query.get('format', 'jpg'), int(query.get('quality', 95)))
+
+    def make_handler(self):
+        """创建绑定到本服务的请求处理类"""
+        from http.server import BaseHTTPRequestHandler
+        from urllib.parse import urlsplit, parse_qsl
+        from concurrent.futures import TimeoutError as FutureTimeout
+        import shutil
+        service = self
+        max_body = int(self.config['max_body_mb'] * 1024 * 1024)
+        
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            
+            def send_json(self, code, data, headers=()):
+                payload = json.dumps(data, ensure_ascii=False).encode('utf-8')
+                self.send_response(code)
+                self.send_header('Content-Type', 'application/json; charset=utf-8')
+                self.send_header('Content-Length', str(len(payload)))
+                for k, v in headers:
+                    self.send_header(k, v)
+                self.end_headers()
+                self.wfile.write(payload)
+            
+            def discard_body(self):
+                """拒绝请求前丢弃较小的请求体，让客户端能收到状态码而不是连接重置"""
+                length = int(self.headers.get('Content-Length') or 0)
+                if length > 8 * 1024 * 1024:
+                    return
+                while length > 0:
+                    chunk = self.rfile.read(min(service.CHUNK, length))
+                    if not chunk:
+                        break
+                    length -= len(chunk)
+            
+            def do_GET(self):
+                if urlsplit(self.path).path != '/health':
+                    self.send_json(404, {'error': '未知接口'})
+                    return
+                with service.lock:
+                    stats = dict(service.stats)
+                self.send_json(200, dict(stats, limits=service.config))
+            
+            def do_POST(self):
+                url = urlsplit(self.path)
+                query = dict(parse_qsl(url.query))
+                if url.path not in ('/crop', '/stitch'):
+                    self.discard_body()
+                    self.close_connection = True
+                    self.send_json(404, {'error': '未知接口'})
+                    return
+                if query.get('format', 'jpg') not in service.FORMATS:
+                    self.discard_body()
+                    self.close_connection = True
+                    self.send_json(400, {'error': '不支持的输出格式'})
+                    return
+                
+                # 背压：没有排队名额时不处理请求体，直接拒绝
+                if not service.slots.acquire(blocking=False):
+                    service.bump('rejected')
+                    self.discard_body()
+                    self.close_connection = True
+                    self.send_json(503, {'error': '服务繁忙'}, [('Retry-After', '1')])
+                    return
+                slot_held = True
+                try:
+                    length = self.headers.get('Content-Length')
+                    if length is None:
+                        self.close_connection = True
+                        self.send_json(411, {'error': '需要 Content-Length'})
+                        return
+                    length = int(length)
+                    if length > max_body:
+                        self.close_connection = True
+                        self.send_json(413, {'error': '请求体过大'})
+                        return
+                    
+                    # 分块读取请求体到临时文件
+                    body = tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024)
+                    remaining = length
+                    while remaining > 0:
+                        chunk = self.rfile.read(min(service.CHUNK, remaining))
+                        if not chunk:
+                            raise ConnectionError("请求体不完整")
+                        body.write(chunk)
+                        remaining -= len(chunk)
+                    body.seek(0)
+                    
+                    try:
+                        slot_held = False  # 名额交给 run_limited，任务结束时归还
+                        if url.path == '/crop':
+                            out = service.run_limited(service.do_crop, body, query)
+                        else:
+                            out = service.run_limited(
+                                service.do_stitch, body, query, self.headers.get('Content-Type', '')
+                            )
+                    except QueueWaitExceeded:
+                        service.bump('rejected')
+                        self.send_json(503, {'error': '排队超时'}, [('Retry-After', '1')])
+                        return
+                    except FutureTimeout:
+                        service.bump('timeouts')
+                        self.send_json(504, {'error': '处理超时'})
+                        return
+                    except Exception as e:
+                        service.bump('errors')
+                        self.send_json(400, {'error': str(e)})
+                        return
+                    finally:
+                        body.close()
+                    
+                    # 分块写出响应
+                    with out:
+                        out.seek(0, os.SEEK_END)
+                        size = out.tell()
+                        out.seek(0)
+                        self.send_response(200)
+                        self.send_header('Content-Type', service.FORMATS[query.get('format', 'jpg')][1])
+                        self.send_header('Content-Length', str(size))
+                        self.end_headers()
+                        shutil.copyfileobj(out, self.wfile, service.CHUNK)
+                    service.bump('served')
+                finally:
+                    if slot_held:
+                        service.slots.release()
+            
+            def log_message(self, format, *args):
+                pass  # 默认逐请求日志开销较大，统计信息见 /health
         
-        for img in images:
-            new_w = int(img.width * (max_h / img.height))
-            resized_img = img.resize((new_w, max_h), Image.Resampling.LANCZOS)
-            resized.append(resized_img)
-            total_w += new_w
+        return Handler
+
+    def serve_forever(self, host, port):
+        """启动服务（阻塞）"""
+        from http.server import ThreadingHTTPServer
         
-        out = Image.new('RGB', (total_w, max_h), bg_color)
-        x = 0
-        for img in resized:
-            out.paste(img, (x, 0))
-            x += img.width + spacing
+        class Server(ThreadingHTTPServer):
+            daemon_threads = True
+            request_queue_size = 128  # 连接积压交给排队名额控制，避免内核直接重置连接
         
-        return out
+        server = Server((host, port), self.make_handler())
+        print(f"服务已启动：http://{host}:{port}（工作线程 {self.config['workers']}，排队 {self.config['queue_size']}）")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            self.pool.shutdown(wait=False)
+
+
+# ==================== 相似图片检测 ====================
+
+class HammingIndex:
+    """多索引哈希：按汉明距离查找近似的 64 位哈希
+
+    把哈希切成 4 段 16 位，每段各建一张哈希表。由抽屉原理，距离不超过 r 的两个哈希
+    至少有一段相差不超过 r // 4 位，因此只需在各段表中查找这些变体，再逐一核对完整距离。
+    与 BK 树不同，哈希分布均匀时查询代价也不会退化为遍历大部分节点。
+    """
+
+    CHUNKS = 4
+    BITS = 16
+
+    def __init__(self, radius):
+        from itertools import combinations
+        self.radius = radius
+        self.tables = [{} for _ in range(self.CHUNKS)]
+        # 每段需要查找的变体：翻转不超过 radius // 4 位
+        self.flips = [
+            sum(1 << b for b in bits)
+            for n in range(radius // self.CHUNKS + 1)
+            for bits in combinations(range(self.BITS), n)
+        ]
+
+    @staticmethod
+    def distance(a, b):
+        """汉明距离"""
+        return bin(a ^ b).count('1')
+
+    def chunks(self, value):
+        """切分为各段"""
+        mask = (1 << self.BITS) - 1
+        return [(value >> (self.BITS * i)) & mask for i in range(self.CHUNKS)]
+
+    def add(self, value, item):
+        """插入一项"""
+        for table, chunk in zip(self.tables, self.chunks(value)):
+            table.setdefault(chunk, []).append((value, item))
+
+    def search(self, value):
+        """返回与 value 的距离不超过 radius 的所有项"""
+        found = {}
+        for table, chunk in zip(self.tables, self.chunks(value)):
+            for flip in self.flips:
+                for other, item in table.get(chunk ^ flip, ()):
+                    if item not in found and self.distance(value, other) <= self.radius:
+                        found[item] = other
+        return list(found)
+
+
+class HashCache:
+    """感知哈希的持久缓存（SQLite），以「路径 + 大小 + 修改时间」为键，源文件修改后自动失效"""
+
+    def __init__(self, db_path):
+        import sqlite3
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS hashes (key TEXT PRIMARY KEY, hash TEXT NOT NULL)")
+
+    @staticmethod
+    def make_key(path):
+        """缓存键"""
+        st = ImageProcessor.source_stat(path)
+        return f"{ArchiveReader.abspath(path)}|{st.st_size}|{st.st_mtime_ns}"
+
+    def get_many(self, keys):
+        """批量查询，返回 {键: 哈希}"""
+        keys = list(keys)
+        found = {}
+        for i in range(0, len(keys), 500):
+            batch = keys[i:i + 500]
+            rows = self.conn.execute(
+                f"SELECT key, hash FROM hashes WHERE key IN ({','.join('?' * len(batch))})", batch
+            )
+            found.update((k, int(h, 16)) for k, h in rows)
+        return found
+
+    def put_many(self, pairs):
+        """批量写入 [(键, 哈希), ...]"""
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO hashes (key, hash) VALUES (?, ?)",
+                [(k, f"{h:016x}") for k, h in pairs]
+            )
+
+    def close(self):
+        self.conn.close()
+
+
+def find_duplicates(paths, radius=6, cache=None, workers=None, progress=None):
+    """查找近似重复的图片，返回分组列表（每组至少两张，组内按 paths 的顺序）
+
+    先查缓存，未命中的并行计算 dHash；再把哈希逐个插入多索引哈希表，
+    插入前查询半径内已有的项并合并到同一组（并查集），整体远低于两两比较的平方复杂度。
+    progress(已完成, 总数) 在计算哈希时调用，抛出异常（如取消）时已算好的哈希仍会写入缓存。
+    """
+    keys = {}
+    for path in paths:
+        try:
+            keys[path] = HashCache.make_key(path)
+        except OSError:
+            continue
+    known = cache.get_many(keys.values()) if cache else {}
+    hashes = {p: known[k] for p, k in keys.items() if k in known}
+    missing = [p for p in keys if p not in hashes]
+    
+    def compute(path):
+        try:
+            return path, ImageProcessor.dhash(path)
+        except Exception:
+            return path, None
+    
+    computed = []
+    try:
+        for i, (path, value) in enumerate(imap_bounded(compute, missing, workers)):
+            if value is not None:
+                hashes[path] = value
+                computed.append((keys[path], value))
+            if progress:
+                progress(i + 1, len(missing))
+    finally:
+        if cache and computed:
+            cache.put_many(computed)
+    
+    parent = {}
+    
+    def find(p):
+        while parent[p] != p:
+            parent[p] = parent[parent[p]]
+            p = parent[p]
+        return p
     
+    index = HammingIndex(radius)
+    for path in paths:
+        if path not in hashes or path in parent:
+            continue
+        parent[path] = path
+        for other in index.search(hashes[path]):
+            root_a, root_b = find(path), find(other)
+            if root_a != root_b:
+                parent[root_a] = root_b
+        index.add(hashes[path], path)
+    
+    groups = {}
+    for path in parent:
+        groups.setdefault(find(path), []).append(path)
+    return [g for g in groups.values() if len(g) > 1]
+
+
+class ImagePyramid:
+    """图像金字塔（mipmap）：每层为上一层的一半，加载时构建一次，用于快速缩放显示
+
+    size 为源图坐标系的尺寸，默认与 img 相同；img 是缩小解码的预览图时传入原图尺寸，
+    render 的 box 仍按原图坐标给出。
+    """
+
+    def __init__(self, img, min_size=256, size=None):
+        if img.mode not in ('RGB', 'RGBX', 'RGBA', 'L'):
+            img = img.convert('RGB')
+        self.size = size or img.size
+        self.levels = [img]
+        while max(self.levels[-1].size) > min_size:
+            self.levels.append(self.levels[-1].reduce(2))
+
+    def render(self, box, out_size):
+        """把源图坐标系中的 box 区域渲染成 out_size 大小的图片
+
+        选择分辨率不低于目标的最小一层，只缩放可见区域；
+        放大超过 1:1 时使用最近邻，保证能看清每个源像素。
+        """
+        scale = out_size[0] / max(box[2] - box[0], 1e-6)
+        level = 0
+        while level + 1 < len(self.levels) and self.levels[level + 1].width >= self.size[0] * scale:
+            level += 1
+        img = self.levels[level]
+        fx = img.width / self.size[0]
+        fy = img.height / self.size[1]
+        tier = 'zoom' if scale >= 1 else 'interactive'
+        return ImageProcessor.resize(img, out_size, tier, box=(box[0] * fx, box[1] * fy, box[2] * fx, box[3] * fy))
+
+
+class SelectionModel:
+    """选择模型：以稳定的键（文件路径）记录选中项，移除其他项不影响已选中项
+
+    每次修改只把实际变化的键通知给订阅者：callback(added, removed)。
+    """
+
+    def __init__(self):
+        self.selected = set()
+        self.anchor = None  # 范围选择的起点
+        self.listeners = []
+
+    def __contains__(self, key):
+        return key in self.selected
+
+    def __len__(self):
+        return len(self.selected)
+
+    def subscribe(self, callback):
+        """订阅选择变化"""
+        self.listeners.append(callback)
+
+    def replace(self, keys):
+        """把选择替换为 keys，只通知差异部分"""
+        keys = set(keys)
+        added = keys - self.selected
+        removed = self.selected - keys
+        self.selected = keys
+        self.emit(added, removed)
+
+    def emit(self, added, removed):
+        """通知订阅者"""
+        if not added and not removed:
+            return
+        for callback in self.listeners:
+            callback(added, removed)
+
+    def select_only(self, key):
+        """单选"""
+        self.anchor = key
+        self.replace([key])
+
+    def toggle(self, key):
+        """切换单项"""
+        self.anchor = key
+        if key in self.selected:
+            self.selected.discard(key)
+            self.emit(set(), {key})
+        else:
+            self.selected.add(key)
+            self.emit({key}, set())
+
+    def select_range(self, order, key, extend=False):
+        """选中 order 中从起点到 key 的连续范围；extend 为真时保留原有选择"""
+        if self.anchor is None or self.anchor not in order:
+            self.select_only(key)
+            return
+        i, j = order.index(self.anchor), order.index(key)
+        if i > j:
+            i, j = j, i
+        span = order[i:j + 1]
+        if extend:
+            added = set(span) - self.selected
+            self.selected |= added
+            self.emit(added, set())
+        else:
+            self.replace(span)
+
+    def select_all(self, keys):
+        """全选"""
+        self.replace(keys)
+
+    def invert(self, keys):
+        """反选"""
+        self.replace(k for k in keys if k not in self.selected)
+
+    def clear(self):
+        """清除选择"""
+        self.anchor = None
+        self.replace(())
+
+    def discard(self, keys):
+        """移除已不存在的项"""
+        removed = self.selected & set(keys)
+        self.selected -= removed
+        if self.anchor in removed:
+            self.anchor = None
+        self.emit(set(), removed)
+
+    def ordered(self, order):
+        """按 order 的顺序返回选中项"""
+        return [k for k in order if k in self.selected]
+
+
+class FileRecord:
+    """文件目录中的单条记录"""
+
+    __slots__ = ('id', 'path', 'name', 'size', 'mtime', 'width', 'height', 'dup_group')
+
+    def __init__(self, file_id, path, size, mtime):
+        self.id = file_id
+        self.path = path
+        self.name = os.path.basename(path)
+        self.size = size
+        self.mtime = mtime
+        self.width = None  # 尺寸由后台任务读取文件头后填入
+        self.height = None
+        self.dup_group = None  # 相似图片分组编号
+
+
+class FileCatalog:
+    """文件目录：规范化路径 -> 编号的哈希索引，按插入顺序保存记录，并提供排序/筛选视图"""
+
+    SORT_KEYS = {
+        'name': lambda r: r.name.lower(),
+        'size': lambda r: r.size,
+        'mtime': lambda r: r.mtime,
+        'pixels': lambda r: r.width * r.height,
+        'group': lambda r: (r.dup_group is None, r.dup_group or 0, r.name.lower()),
+    }
+
+    def __init__(self):
+        self.records = {}  # 编号 -> FileRecord（dict 保持插入顺序）
+        self.index = {}    # 规范化路径 -> 编号
+        self.next_id = 0
+        self.version = 0   # 每次增删加一，用于视图缓存失效
+        self.view_cache = None
+
     @staticmethod
-    def stitch_images_vertical(images, spacing, bg_color=(255, 255, 255)):
-        """垂直拼接图片"""
-        if not images:
+    def normalize(path):
+        """规范化路径：绝对路径、统一分隔符，大小写不敏感的系统上统一大小写"""
+        return os.path.normcase(ArchiveReader.abspath(path))
+
+    def __len__(self):
+        return len(self.records)
+
+    def __contains__(self, path):
+        return self.normalize(path) in self.index
+
+    def add(self, path, st=None):
+        """添加文件（st 为已有的 stat 结果，可省去一次系统调用），已存在时返回 None，否则返回记录"""
+        abs_path = ArchiveReader.abspath(path)
+        key = os.path.normcase(abs_path)
+        if key in self.index:
             return None
-        
-        max_w = max(img.width for img in images)
-        resized = []
-        total_h = spacing * (len(images) - 1)
-        
-        for img in images:
-            new_h = int(img.height * (max_w / img.width))
-            resized_img = img.resize((max_w, new_h), Image.Resampling.LANCZOS)
-            resized.append(resized_img)
-            total_h += new_h
-        
-        out = Image.new('RGB', (max_w, total_h), bg_color)
-        y = 0
-        for img in resized:
-            out.paste(img, (0, y))
-            y += img.height + spacing
-        
-        return out
+        try:
+            st = st or ImageProcessor.source_stat(abs_path)
+            size, mtime = st.st_size, st.st_mtime
+        except OSError:
+            size, mtime = 0, 0.0
+        record = FileRecord(self.next_id, abs_path, size, mtime)
+        self.next_id += 1
+        self.records[record.id] = record
+        self.index[key] = record.id
+        self.version += 1
+        return record
+
+    def add_many(self, paths):
+        """批量添加，返回新增的路径"""
+        added = []
+        for path in paths:
+            record = self.add(path)
+            if record:
+                added.append(record.path)
+        return added
+
+    def remove(self, paths):
+        """移除文件"""
+        for path in paths:
+            file_id = self.index.pop(self.normalize(path), None)
+            if file_id is not None:
+                del self.records[file_id]
+        self.version += 1
+
+    def clear(self):
+        """清空目录"""
+        self.records.clear()
+        self.index.clear()
+        self.version += 1
+
+    def set_groups(self, groups):
+        """记录相似图片分组（编号从 1 开始），其余文件清除分组"""
+        for record in self.records.values():
+            record.dup_group = None
+        for number, paths in enumerate(groups, 1):
+            for path in paths:
+                record = self.get(path)
+                if record:
+                    record.dup_group = number
+        self.version += 1
+    
+    def get(self, path):
+        """按路径取记录"""
+        file_id = self.index.get(self.normalize(path))
+        return self.records.get(file_id)
+
+    @staticmethod
+    def read_dimensions(path):
+        """读取图片尺寸（只解析文件头），无法识别时为 (0, 0)；可在工作线程中调用"""
+        try:
+            with ImageProcessor.source_file(path) as f, Image.open(f) as img:
+                return img.size
+        except Exception:
+            return 0, 0
+
+    def missing_dimensions(self):
+        """尚未读取尺寸的文件路径"""
+        return [r.path for r in self.records.values() if r.width is None]
+
+    def set_dimensions(self, dims):
+        """填入后台读取的尺寸 {路径: (宽, 高)}"""
+        for path, (width, height) in dims.items():
+            record = self.get(path)
+            if record:
+                record.width, record.height = width, height
+        self.version += 1
+
+    def view(self, sort_key=None, reverse=False, pattern=''):
+        """返回排序、筛选后的路径列表（结果按参数缓存）"""
+        cache_key = (self.version, sort_key, reverse, pattern)
+        if self.view_cache and self.view_cache[0] == cache_key:
+            return self.view_cache[1]
+        records = self.records.values()
+        pattern = pattern.strip().lower()
+        if pattern:
+            records = [r for r in records if pattern in r.name.lower()]
+        if sort_key == 'pixels':
+            # 尺寸由后台读取，尚未读到的文件无论升序降序都排在最后
+            known = [r for r in records if r.width is not None]
+            unknown = [r for r in records if r.width is None]
+            records = sorted(known, key=self.SORT_KEYS[sort_key], reverse=reverse) + unknown
+        elif sort_key:
+            records = sorted(records, key=self.SORT_KEYS[sort_key], reverse=reverse)
+        elif reverse:
+            records = list(records)[::-1]
+        paths = [r.path for r in records]
+        self.view_cache = (cache_key, paths)
+        return paths
+
+
+class JobCancelled(Exception):
+    """后台任务已被取消"""
+
+
+class CancelToken:
+    """取消令牌：界面线程调用 cancel()，工作线程在检查点调用 check()"""
+
+    def __init__(self):
+        self.event = threading.Event()
+
+    def cancel(self):
+        self.event.set()
+
+    @property
+    def cancelled(self):
+        return self.event.is_set()
+
+    def check(self):
+        """已取消时抛出 JobCancelled"""
+        if self.event.is_set():
+            raise JobCancelled()
+
+
+class Job:
+    """调度器中的一个后台任务"""
+
+    def __init__(self, seq, fn, args, priority, key, label, on_done, on_error, on_progress):
+        self.seq = seq
+        self.fn = fn
+        self.args = args
+        self.priority = priority
+        self.key = key
+        self.label = label
+        self.on_done = on_done
+        self.on_error = on_error
+        self.on_progress = on_progress
+        self.token = CancelToken()
+        self.started = False
+        self.progress = None  # (已完成, 总数)
+
+
+class JobScheduler:
+    """后台任务调度器：工作线程执行任务，结果经队列由 Tk 的 after 轮询交回界面线程
+
+    - 任务函数签名为 fn(token, progress, *args)，在工作线程中执行，不得访问界面控件；
+      progress(done, total, payload=None) 汇报进度，同时作为取消检查点；
+    - priority 越小越先执行；
+    - 提交相同 key 的新任务会取消排队中或正在执行的旧任务（例如连续点击预览只保留最后一次）；
+    - on_done / on_error / on_progress 回调都在界面线程中调用。
+    """
+
+    def __init__(self, widget, workers=2, poll_ms=50, on_status=None):
+        import queue
+        self.widget = widget
+        self.poll_ms = poll_ms
+        self.on_status = on_status
+        self.heap = []
+        self.cond = threading.Condition()
+        self.results = queue.Queue()
+        self.by_key = {}   # key -> 最新提交的任务
+        self.active = {}   # 序号 -> 排队或执行中的任务
+        self.seq = 0
+        self.last_status = None
+        for i in range(workers):
+            threading.Thread(target=self.worker_loop, name=f"job-worker-{i}", daemon=True).start()
+        self.widget.after(poll_ms, self.poll)
+
+    def submit(self, fn, *args, priority=5, key=None, label="", on_done=None, on_error=None, on_progress=None):
+        """提交任务，返回 Job"""
+        import heapq
+        with self.cond:
+            if key is not None and key in self.by_key:
+                self.by_key[key].token.cancel()
+            self.seq += 1
+            job = Job(self.seq, fn, args, priority, key, label, on_done, on_error, on_progress)
+            self.active[job.seq] = job
+            if key is not None:
+                self.by_key[key] = job
+            heapq.heappush(self.heap, (priority, job.seq, job))
+            self.cond.notify()
+        self.report_status()
+        return job
+
+    def cancel(self, key=None):
+        """取消指定 key 的任务；不指定时取消全部任务"""
+        with self.cond:
+            if key is None:
+                jobs = list(self.active.values())
+            else:
+                jobs = [self.by_key[key]] if key in self.by_key else []
+        for job in jobs:
+            job.token.cancel()
+
+    def worker_loop(self):
+        """工作线程：按优先级取出任务执行，把结果放回队列"""
+        import heapq
+        while True:
+            with self.cond:
+                while not self.heap:
+                    self.cond.wait()
+                _, _, job = heapq.heappop(self.heap)
+            if job.token.cancelled:
+                self.results.put(('cancelled', job, None))
+                continue
+            job.started = True
+            
+            def progress(done, total, payload=None, job=job):
+                job.token.check()
+                self.results.put(('progress', job, (done, total, payload)))
+            
+            try:
+                result = job.fn(job.token, progress, *job.args)
+                self.results.put(('done', job, result))
+            except JobCancelled:
+                self.results.put(('cancelled', job, None))
+            except Exception as e:
+                self.results.put(('error', job, e))
+
+    def poll(self):
+        """界面线程中定时分发任务结果"""
+        import queue
+        try:
+            while True:
+                try:
+                    kind, job, value = self.results.get_nowait()
+                except queue.Empty:
+                    break
+                try:
+                    self.dispatch(kind, job, value)
+                except Exception as e:
+                    print(f"任务回调出错（{job.label}）：{e}")
+            self.report_status()
+        finally:
+            try:
+                self.widget.after(self.poll_ms, self.poll)
+            except tk.TclError:
+                pass  # 窗口已关闭
+
+    def dispatch(self, kind, job, value):
+        """调用任务回调"""
+        if kind == 'progress':
+            job.progress = value[:2]
+            if job.on_progress and not job.token.cancelled:
+                job.on_progress(*value)
+            return
+        with self.cond:
+            self.active.pop(job.seq, None)
+            if job.key is not None and self.by_key.get(job.key) is job:
+                del self.by_key[job.key]
+        if kind == 'done' and job.on_done and not job.token.cancelled:
+            job.on_done(value)
+        elif kind == 'error':
+            if job.on_error:
+                job.on_error(value)
+            else:
+                messagebox.showerror("错误", f"{job.label or '后台任务'}失败：{value}")
+
+    def report_status(self):
+        """汇总当前任务状态，变化时通知状态栏"""
+        if not self.on_status:
+            return
+        with self.cond:
+            jobs = sorted(self.active.values(), key=lambda j: (not j.started, j.priority, j.seq))
+        if not jobs:
+            status = ("就绪", None)
+        else:
+            job = jobs[0]
+            text = job.label or "处理中"
+            if job.progress and job.progress[1]:
+                text += f" {job.progress[0]}/{job.progress[1]}"
+            if len(jobs) > 1:
+                text += f"（另有 {len(jobs) - 1} 个任务排队）"
+            fraction = job.progress[0] / job.progress[1] if job.progress and job.progress[1] else None
+            status = (text, fraction)
+        if status != self.last_status:
+            self.last_status = status
+            self.on_status(*status)
 
 
 class ModernImageApp(DnDCTk):
     """主应用程序类"""
     
-    def __init__(self):
+    def __init__(self, profile_startup=False):
         super().__init__()
+        self.profile_startup = profile_startup
+        self.startup_times = {}  # 启动各阶段完成时刻（相对 STARTUP_T0）
         
         # 设置主题
         ctk.set_appearance_mode("dark")
@@ -155,11 +3366,24 @@ class ModernImageApp(DnDCTk):
         
         # 数据
         self.folder = os.path.abspath('.')
-        self.files = []
-        self.selected_files = set()  # 存储选中的文件索引
+        self.catalog = FileCatalog()  # 全部已加载的文件
+        self.files = []  # 当前视图（排序、筛选后）中的文件
+        self.selection = SelectionModel()  # 选中的文件（以路径为键）
+        self.selection.subscribe(self.on_selection_changed)
+        self.file_positions = {}  # 路径 -> 卡片下标
         self.thumbnail_cache = {}  # 缩略图缓存
+        self.pending_thumbnails = {}  # 待生成缩略图的卡片 {path: card_frame}
+        self.stitch_thumb_cache = {}  # 拼接列表缩略图缓存
+        self.pending_stitch_thumbs = {}  # 待生成缩略图的拼接卡片 {path: [label, ...]}
         self.file_frames = []  # 文件卡片框架
         self.preview_img = None
+        self.crop_pyramid = None  # 裁剪预览的图像金字塔（坐标为原图像素）
+        self.view_scale = 1.0  # 预览缩放：画布像素 / 源图像素
+        self.view_origin = (0.0, 0.0)  # 画布左上角对应的源图坐标
+        self.pan_start = None
+        self.crop_view_cache = OrderedDict()  # 按画布尺寸和视图缓存的预览位图
+        self.crop_redraw_job = None  # 待执行的防抖重绘
+        self.crop_redraw_full = False
         self.canvas_image = None
         self.crop_rect = None
         self.crop_start = None
@@ -173,6 +3397,10 @@ class ModernImageApp(DnDCTk):
         self.spacing_var = tk.IntVar(value=10)
         self.rows_var = tk.IntVar(value=0)
         self.cols_var = tk.IntVar(value=3)
+        self.cell_size_var = tk.IntVar(value=300)
+        self.slice_rows_var = tk.IntVar(value=2)
+        self.slice_cols_var = tk.IntVar(value=2)
+        self.slice_tile_var = tk.IntVar(value=0)
         self.stitch_mode = tk.StringVar(value="grid")
         self.stitch_image_order = []  # 保存拼接图片的顺序列表 [(path, name), ...]
         self.stitch_order_frames = []  # 保存拼接顺序卡片框架
@@ -180,22 +3408,74 @@ class ModernImageApp(DnDCTk):
         self.bg_color = "#FFFFFF"
         
         self.setup_ui()
-        self.load_images(self.folder)
+        self.jobs = JobScheduler(self, on_status=self.update_status_bar)
+        self.startup_times['widgets'] = time.perf_counter() - STARTUP_T0
+        
+        # 窗口先显示出来，再扫描文件夹
+        self.after(0, self.on_first_paint)
     
     def setup_ui(self):
         """构建 UI"""
+        # 底部状态栏：显示后台任务进度，可取消
+        status_bar = ctk.CTkFrame(self, height=36)
+        status_bar.pack(side="bottom", fill="x", padx=10, pady=(0, 10))
+        self.status_label = ctk.CTkLabel(status_bar, text="就绪", anchor="w")
+        self.status_label.pack(side="left", fill="x", expand=True, padx=10)
+        self.status_cancel_btn = ctk.CTkButton(
+            status_bar, text="取消", width=80, state="disabled", command=lambda: self.jobs.cancel()
+        )
+        self.status_cancel_btn.pack(side="right", padx=5, pady=4)
+        self.status_progress = ctk.CTkProgressBar(status_bar, width=240)
+        self.status_progress.set(0)
+        self.status_progress.pack(side="right", padx=5)
+        
         # 创建选项卡视图
-        self.tabview = ctk.CTkTabview(self, width=1380, height=880)
-        self.tabview.pack(padx=10, pady=10, fill="both", expand=True)
+        self.tabview = ctk.CTkTabview(self, width=1380, height=880, command=self.on_tab_changed)
+        self.tabview.pack(padx=10, pady=(10, 5), fill="both", expand=True)
         
         # 添加选项卡
         self.tab_files = self.tabview.add("📁 文件管理")
         self.tab_crop = self.tabview.add("✂️ 批量裁剪")
         self.tab_stitch = self.tabview.add("🧩 智能拼接")
         
+        # 只构建首页，其余选项卡首次切换时再构建
         self.setup_files_tab()
-        self.setup_crop_tab()
-        self.setup_stitch_tab()
+        self.tab_builders = {
+            "✂️ 批量裁剪": self.setup_crop_tab,
+            "🧩 智能拼接": self.setup_stitch_tab,
+        }
+    
+    def on_tab_changed(self):
+        """首次切换到选项卡时构建其界面"""
+        builder = self.tab_builders.pop(self.tabview.get(), None)
+        if builder:
+            builder()
+    
+    def update_status_bar(self, text, fraction):
+        """显示后台任务状态"""
+        self.status_label.configure(text=text)
+        self.status_progress.set(fraction or 0)
+        self.status_cancel_btn.configure(state="disabled" if text == "就绪" else "normal")
+    
+    def on_first_paint(self):
+        """窗口首次绘制后加载当前文件夹"""
+        self.update_idletasks()
+        self.startup_times['first_paint'] = time.perf_counter() - STARTUP_T0
+        self.load_images(self.folder)
+    
+    def on_thumbnails_done(self):
+        """缩略图全部生成；启动计时模式下输出各阶段耗时并退出"""
+        if 'thumbnails' in self.startup_times:
+            return
+        self.startup_times['thumbnails'] = time.perf_counter() - STARTUP_T0
+        if not self.profile_startup:
+            return
+        times = self.startup_times
+        print(f"导入模块：{times['imports'] * 1000:.0f} ms")
+        print(f"构建界面：{(times['widgets'] - times['imports']) * 1000:.0f} ms")
+        print(f"首次绘制：{times['first_paint'] * 1000:.0f} ms（可交互）")
+        print(f"缩略图完成：{times['thumbnails'] * 1000:.0f} ms（{len(self.files)} 张）")
+        self.after(0, self.destroy)
     
     def setup_files_tab(self):
         """文件管理选项卡"""
@@ -249,6 +3529,14 @@ class ModernImageApp(DnDCTk):
             hover_color="red"
         ).pack(pady=10)
         
+        ctk.CTkButton(
+            left_frame,
+            text="🔍 查找相似图片",
+            command=self.find_duplicate_files,
+            width=320,
+            height=40
+        ).pack(pady=(0, 10))
+        
         # 统计信息
         self.stats_label = ctk.CTkLabel(left_frame, text="", font=("Arial", 14, "bold"))
         self.stats_label.pack(pady=10)
@@ -257,7 +3545,7 @@ class ModernImageApp(DnDCTk):
         help_frame = ctk.CTkFrame(left_frame)
         help_frame.pack(fill="x", padx=5, pady=10)
         ctk.CTkLabel(help_frame, text="💡 提示", font=("Arial", 12, "bold")).pack(pady=5)
-        tip_text = "点击图片卡片选择\nCtrl+点击多选"
+        tip_text = "点击图片卡片选择\nCtrl+点击多选，Shift+点击连选"
         if HAS_DND:
             tip_text += "\n📎 支持拖拽图片到右侧"
         ctk.CTkLabel(help_frame, text=tip_text, font=("Arial", 10)).pack(pady=2)
@@ -272,6 +3560,28 @@ class ModernImageApp(DnDCTk):
         title_text += "）"
         ctk.CTkLabel(right_frame, text=title_text, font=("Arial", 16, "bold")).pack(pady=10)
         
+        # 排序与筛选
+        view_row = ctk.CTkFrame(right_frame, fg_color="transparent")
+        view_row.pack(fill="x", padx=10)
+        ctk.CTkLabel(view_row, text="排序：").pack(side="left")
+        self.sort_options = {
+            "添加顺序": None, "名称": "name", "大小": "size", "修改时间": "mtime", "像素数": "pixels", "相似分组": "group",
+        }
+        self.sort_var = tk.StringVar(value="添加顺序")
+        ctk.CTkOptionMenu(
+            view_row, variable=self.sort_var, values=list(self.sort_options),
+            command=lambda _: self.apply_file_view(), width=120
+        ).pack(side="left", padx=5)
+        self.sort_reverse_var = ctk.BooleanVar(value=False)
+        ctk.CTkCheckBox(view_row, text="倒序", variable=self.sort_reverse_var,
+                        command=self.apply_file_view).pack(side="left", padx=5)
+        ctk.CTkLabel(view_row, text="筛选：").pack(side="left", padx=(20, 0))
+        self.filter_var = tk.StringVar(value="")
+        filter_entry = ctk.CTkEntry(view_row, textvariable=self.filter_var, width=200, placeholder_text="文件名包含…")
+        filter_entry.pack(side="left", padx=5)
+        self.filter_job = None
+        filter_entry.bind("<KeyRelease>", self.on_filter_changed)
+        
         # 创建可滚动框架
         self.file_scroll_frame = ctk.CTkScrollableFrame(right_frame, width=950, height=750)
         self.file_scroll_frame.pack(fill="both", expand=True, padx=10, pady=10)
@@ -313,6 +3623,7 @@ class ModernImageApp(DnDCTk):
         
         ctk.CTkLabel(mode_b_frame, text="模式 B：可视化裁剪", font=("Arial", 14, "bold")).pack(pady=5)
         ctk.CTkLabel(mode_b_frame, text="在右侧预览区用鼠标拖拽画框", font=("Arial", 10)).pack(pady=2)
+        ctk.CTkLabel(mode_b_frame, text="滚轮缩放，右键拖动平移", font=("Arial", 10)).pack(pady=2)
         
         ctk.CTkButton(
             mode_b_frame,
@@ -323,14 +3634,26 @@ class ModernImageApp(DnDCTk):
         
         ctk.CTkButton(
             mode_b_frame,
-            text="重置裁剪区域",
-            command=self.reset_crop_area,
+            text="重置裁剪区域",
+            command=self.reset_crop_area,
+            width=350
+        ).pack(pady=5)
+        
+        ctk.CTkButton(
+            mode_b_frame,
+            text="适应窗口",
+            command=self.fit_crop_view,
             width=350
         ).pack(pady=5)
         
         # 操作按钮
         ctk.CTkLabel(left_frame, text="").pack(pady=10)
         
+        self.crop_archive_var = ctk.BooleanVar(value=False)
+        ctk.CTkCheckBox(
+            left_frame, text="输出到压缩包 cropped.zip（大量图片时更快）", variable=self.crop_archive_var
+        ).pack(pady=2)
+        
         ctk.CTkButton(
             left_frame,
             text="💾 批量裁剪并保存",
@@ -342,6 +3665,34 @@ class ModernImageApp(DnDCTk):
             hover_color="darkgreen"
         ).pack(pady=10)
         
+        ctk.CTkButton(
+            left_frame,
+            text="保存为处理方案（用于监视文件夹）",
+            command=self.save_crop_recipe,
+            width=350
+        ).pack(pady=5)
+        
+        # 大图切片
+        slice_frame = ctk.CTkFrame(left_frame)
+        slice_frame.pack(fill="x", padx=10, pady=10)
+        
+        ctk.CTkLabel(slice_frame, text="大图切片", font=("Arial", 14, "bold")).pack(pady=5)
+        ctk.CTkLabel(slice_frame, text="切片边长填 0 时按行列数均分", font=("Arial", 10)).pack(pady=2)
+        
+        for label, var in [("行数:", self.slice_rows_var), ("列数:", self.slice_cols_var),
+                           ("切片边长 (px):", self.slice_tile_var)]:
+            row = ctk.CTkFrame(slice_frame)
+            row.pack(fill="x", pady=3)
+            ctk.CTkLabel(row, text=label, width=100).pack(side="left", padx=5)
+            ctk.CTkEntry(row, textvariable=var, width=150).pack(side="left", padx=5)
+        
+        ctk.CTkButton(
+            slice_frame,
+            text="✂️ 切片选中的图片",
+            command=self.slice_selected,
+            width=350
+        ).pack(pady=5)
+        
         # 提示信息
         help_text = ctk.CTkTextbox(left_frame, height=150)
         help_text.pack(fill="x", padx=10, pady=10)
@@ -351,7 +3702,7 @@ class ModernImageApp(DnDCTk):
             "2. 使用模式A输入像素值或模式B画框\n"
             "3. 两种模式会自动联动\n"
             "4. 点击「批量裁剪并保存」应用到所有选中图片\n"
-            "5. 裁剪后的图片保存在 cropped 文件夹"
+            "5. 裁剪后的图片保存在 cropped 文件夹（或 cropped.zip）"
         )
         help_text.configure(state="disabled")
         
@@ -369,6 +3720,18 @@ class ModernImageApp(DnDCTk):
         self.crop_canvas.bind("<ButtonPress-1>", self.on_crop_mouse_down)
         self.crop_canvas.bind("<B1-Motion>", self.on_crop_mouse_drag)
         self.crop_canvas.bind("<ButtonRelease-1>", self.on_crop_mouse_up)
+        
+        # 画布尺寸变化时（防抖）重绘
+        self.crop_canvas.bind("<Configure>", lambda e: self.schedule_crop_redraw(full=True, delay=100))
+        
+        # 缩放与平移
+        self.crop_canvas.bind("<MouseWheel>", self.on_crop_zoom)
+        self.crop_canvas.bind("<Button-4>", self.on_crop_zoom)
+        self.crop_canvas.bind("<Button-5>", self.on_crop_zoom)
+        self.crop_canvas.bind("<ButtonPress-3>", self.on_crop_pan_start)
+        self.crop_canvas.bind("<B3-Motion>", self.on_crop_pan_drag)
+        self.crop_canvas.bind("<ButtonPress-2>", self.on_crop_pan_start)
+        self.crop_canvas.bind("<B2-Motion>", self.on_crop_pan_drag)
     
     def setup_stitch_tab(self):
         """拼接选项卡"""
@@ -387,12 +3750,18 @@ class ModernImageApp(DnDCTk):
         ctk.CTkRadioButton(mode_frame, text="网格布局", variable=self.stitch_mode, value="grid").pack(pady=2)
         ctk.CTkRadioButton(mode_frame, text="水平拼接", variable=self.stitch_mode, value="horizontal").pack(pady=2)
         ctk.CTkRadioButton(mode_frame, text="垂直拼接", variable=self.stitch_mode, value="vertical").pack(pady=2)
+        ctk.CTkRadioButton(
+            mode_frame, text="垂直拼接（滚动截图去重叠）", variable=self.stitch_mode, value="vertical_overlap"
+        ).pack(pady=2)
+        ctk.CTkRadioButton(
+            mode_frame, text="联系表（按行列分页）", variable=self.stitch_mode, value="contact"
+        ).pack(pady=2)
         
         # 网格设置
         grid_frame = ctk.CTkFrame(left_frame)
         grid_frame.pack(fill="x", padx=10, pady=10)
         
-        ctk.CTkLabel(grid_frame, text="网格布局（仅网格模式）", font=("Arial", 12, "bold")).pack(pady=5)
+        ctk.CTkLabel(grid_frame, text="网格布局（网格 / 联系表模式）", font=("Arial", 12, "bold")).pack(pady=5)
         
         row = ctk.CTkFrame(grid_frame)
         row.pack(fill="x", pady=3)
@@ -404,6 +3773,11 @@ class ModernImageApp(DnDCTk):
         ctk.CTkLabel(row, text="列数 (0=自动):", width=120).pack(side="left", padx=5)
         ctk.CTkEntry(row, textvariable=self.cols_var, width=150).pack(side="left", padx=5)
         
+        row = ctk.CTkFrame(grid_frame)
+        row.pack(fill="x", pady=3)
+        ctk.CTkLabel(row, text="单元格边长 (px):", width=120).pack(side="left", padx=5)
+        ctk.CTkEntry(row, textvariable=self.cell_size_var, width=150).pack(side="left", padx=5)
+        
         # 通用设置
         common_frame = ctk.CTkFrame(left_frame)
         common_frame.pack(fill="x", padx=10, pady=10)
@@ -429,9 +3803,13 @@ class ModernImageApp(DnDCTk):
         
         self.use_cropped_var = ctk.BooleanVar(value=True)
         self.use_selected_var = ctk.BooleanVar(value=True)
+        self.stitch_apply_crop_var = ctk.BooleanVar(value=False)
         
         ctk.CTkCheckBox(source_frame, text="优先使用 cropped 文件夹", variable=self.use_cropped_var).pack(pady=2)
         ctk.CTkCheckBox(source_frame, text="仅拼接列表中选中的图片", variable=self.use_selected_var).pack(pady=2)
+        ctk.CTkCheckBox(
+            source_frame, text="直接应用裁剪设置（无需先导出 cropped）", variable=self.stitch_apply_crop_var
+        ).pack(pady=2)
         
         # 操作按钮
         ctk.CTkLabel(left_frame, text="").pack(pady=5)
@@ -572,6 +3950,12 @@ class ModernImageApp(DnDCTk):
     
     # ==================== 拼接顺序调整功能 ====================
     
+    def get_stitch_crop(self):
+        """勾选「直接应用裁剪设置」时返回裁剪边距 (左, 上, 右, 下)，否则返回 None"""
+        if not self.stitch_apply_crop_var.get():
+            return None
+        return (self.left_var.get(), self.top_var.get(), self.right_var.get(), self.bottom_var.get())
+    
     def get_image_paths_for_stitching(self):
         """获取要拼接的图片路径列表"""
         if self.use_selected_var.get():
@@ -580,10 +3964,14 @@ class ModernImageApp(DnDCTk):
                 return []
         else:
             folder = self.folder
-            if self.use_cropped_var.get():
+            # 直接应用裁剪设置时使用原图，避免重复裁剪
+            if self.use_cropped_var.get() and not self.stitch_apply_crop_var.get():
                 cropped_folder = os.path.join(folder, 'cropped')
                 if os.path.isdir(cropped_folder):
                     folder = cropped_folder
+                elif os.path.isfile(cropped_folder + '.zip'):
+                    # 裁剪结果输出到了压缩包时直接读取其中的图片
+                    return ArchiveReader.get(cropped_folder + '.zip').image_paths()
             
             valid = ('.jpg', '.jpeg', '.png', '.bmp', '.tiff', '.webp')
             paths = [os.path.join(folder, f) for f in os.listdir(folder) if f.lower().endswith(valid)]
@@ -608,19 +3996,16 @@ class ModernImageApp(DnDCTk):
         num_label.pack(side="left", padx=(0, 5))
         num_label.bind("<Button-1>", lambda e: self.select_stitch_item(index))
         
-        # 缩略图
-        try:
-            img = Image.open(img_path)
-            img.thumbnail((60, 60), Image.Resampling.LANCZOS)
-            photo = ctk.CTkImage(light_image=img, dark_image=img, size=(60, 60))
+        # 缩略图（已缓存的直接显示，否则先放占位符，由后台任务生成）
+        photo = self.stitch_thumb_cache.get(img_path)
+        if photo:
             img_label = ctk.CTkLabel(left_part, image=photo, text="")
             img_label.image = photo  # 保持引用
-            img_label.pack(side="left", padx=5)
-            img_label.bind("<Button-1>", lambda e: self.select_stitch_item(index))
-        except:
-            placeholder = ctk.CTkLabel(left_part, text="📷", font=("Arial", 30), width=60, height=60)
-            placeholder.pack(side="left", padx=5)
-            placeholder.bind("<Button-1>", lambda e: self.select_stitch_item(index))
+        else:
+            img_label = ctk.CTkLabel(left_part, text="📷", font=("Arial", 30), width=60, height=60)
+            self.pending_stitch_thumbs.setdefault(img_path, []).append(img_label)
+        img_label.pack(side="left", padx=5)
+        img_label.bind("<Button-1>", lambda e: self.select_stitch_item(index))
         
         # 右侧：文件名
         name_label = ctk.CTkLabel(card, text=filename, font=("Arial", 11), anchor="w")
@@ -640,6 +4025,7 @@ class ModernImageApp(DnDCTk):
         for frame in self.stitch_order_frames:
             frame.destroy()
         self.stitch_order_frames.clear()
+        self.pending_stitch_thumbs.clear()
         self.stitch_image_order.clear()
         self.selected_stitch_index = None
         
@@ -655,6 +4041,29 @@ class ModernImageApp(DnDCTk):
             self.stitch_image_order.append((img_path, filename))
             card = self.create_stitch_order_card(img_path, filename, i)
             self.stitch_order_frames.append(card)
+        self.load_stitch_thumbnails()
+    
+    def load_stitch_thumbnails(self):
+        """后台生成拼接列表中尚未缓存的缩略图"""
+        if self.pending_stitch_thumbs:
+            self.jobs.submit(
+                self.decode_thumbnails, list(self.pending_stitch_thumbs), (60, 60),
+                priority=7, key='stitch_thumbnails', label="生成缩略图",
+                on_progress=self.on_stitch_thumbnail_ready
+            )
+    
+    def on_stitch_thumbnail_ready(self, done, total, payload):
+        """拼接列表缩略图解码完成"""
+        img_path, img = payload
+        labels = self.pending_stitch_thumbs.pop(img_path, [])
+        if img is None:
+            return
+        photo = ctk.CTkImage(light_image=img, dark_image=img, size=(60, 60))
+        self.stitch_thumb_cache[img_path] = photo
+        for label in labels:
+            if label.winfo_exists():
+                label.configure(image=photo, text="")
+                label.image = photo  # 保持引用
     
     def move_image_up(self):
         """将选中图片上移"""
@@ -755,6 +4164,7 @@ class ModernImageApp(DnDCTk):
         for frame in self.stitch_order_frames:
             frame.destroy()
         self.stitch_order_frames.clear()
+        self.pending_stitch_thumbs.clear()
         
         # 重新创建所有卡片
         for i, (img_path, filename) in enumerate(self.stitch_image_order):
@@ -764,6 +4174,7 @@ class ModernImageApp(DnDCTk):
             # 高亮选中项
             if i == self.selected_stitch_index:
                 card.configure(fg_color="#1f6aa5")
+        self.load_stitch_thumbnails()
     
     # ==================== 文件管理功能 ====================
     
@@ -820,28 +4231,24 @@ class ModernImageApp(DnDCTk):
         
         for file_path in files:
             if os.path.isfile(file_path):
-                # 检查是否是图片文件
+                # 检查是否是图片文件；压缩包展开为其中的图片
                 if file_path.lower().endswith(valid_extensions):
-                    if file_path not in self.files:
-                        new_files.append(file_path)
+                    new_files.append(file_path)
+                elif ArchiveWriter.is_archive(file_path):
+                    new_files.extend(expand_archives([file_path]))
             elif os.path.isdir(file_path):
                 # 如果是文件夹，加载其中的所有图片
                 try:
-                    dir_files = [os.path.join(file_path, f) for f in os.listdir(file_path) 
-                                 if f.lower().endswith(valid_extensions)]
-                    for f in dir_files:
-                        if f not in self.files:
-                            new_files.append(f)
+                    new_files.extend(os.path.join(file_path, f) for f in os.listdir(file_path)
+                                     if f.lower().endswith(valid_extensions))
                 except Exception as e:
                     print(f"读取文件夹错误: {e}")
         
+        # 目录按规范化路径去重
+        new_files = self.catalog.add_many(new_files)
         if new_files:
-            # 添加新文件
-            self.files.extend(new_files)
-            
             # 刷新显示
-            self.refresh_file_grid()
-            self.update_stats()
+            self.apply_file_view()
             
             # 显示提示
             messagebox.showinfo("成功", f"已添加 {len(new_files)} 张图片")
@@ -883,22 +4290,89 @@ class ModernImageApp(DnDCTk):
             self.load_images(self.folder)
     
     def load_images(self, folder):
-        """加载图片文件"""
+        """加载图片文件（后台扫描文件夹）"""
         valid = ('.jpg', '.jpeg', '.png', '.bmp', '.tiff', '.webp')
-        try:
-            files = [f for f in os.listdir(folder) if f.lower().endswith(valid)]
-        except Exception:
-            files = []
-        files.sort()
-        self.files = [os.path.join(folder, f) for f in files]
-        self.selected_files.clear()
+        
+        def scan(token, progress):
+            try:
+                # scandir 顺带返回文件大小和修改时间（Windows 上无需额外 stat）
+                with os.scandir(folder) as it:
+                    entries = [e for e in it if e.name.lower().endswith(valid + ArchiveWriter.EXTENSIONS)]
+            except Exception:
+                return []
+            entries.sort(key=lambda e: e.name)
+            found = []
+            for entry in entries:
+                if ArchiveWriter.is_archive(entry.name):
+                    # 压缩包中的图片直接按成员索引列出，不解压
+                    try:
+                        reader = ArchiveReader.get(entry.path)
+                        found.extend((p, reader.stat(ArchiveReader.split(p)[1])) for p in reader.image_paths())
+                    except Exception as e:
+                        print(f"读取压缩包 {entry.path} 时出错：{e}")
+                    continue
+                try:
+                    found.append((entry.path, entry.stat()))
+                except OSError:
+                    found.append((entry.path, None))
+            return found
+        
+        self.jobs.submit(scan, priority=1, key='load_folder', label="扫描文件夹", on_done=self.on_folder_scanned)
+    
+    def on_folder_scanned(self, entries):
+        """文件夹扫描完成"""
+        self.catalog.clear()
+        for path, st in entries:
+            self.catalog.add(path, st)
         self.thumbnail_cache.clear()
         
         # 更新缩略图网格显示
+        self.apply_file_view()
+        self.selection.clear()
+        if not self.pending_thumbnails:
+            self.on_thumbnails_done()
+    
+    def apply_file_view(self):
+        """按当前排序和筛选条件刷新文件视图"""
+        sort_key = self.sort_options[self.sort_var.get()]
+        self.files = self.catalog.view(sort_key, self.sort_reverse_var.get(), self.filter_var.get())
         self.refresh_file_grid()
-        
-        # 更新统计信息
         self.update_stats()
+        
+        # 按像素数排序时在后台读取尚未读取的尺寸，读完后重新排序
+        missing = self.catalog.missing_dimensions() if sort_key == 'pixels' else []
+        if missing:
+            self.jobs.submit(
+                self.scan_dimensions, missing, priority=6, key='dimensions', label="读取图片尺寸",
+                on_progress=lambda done, total, dims: self.catalog.set_dimensions(dims),
+                on_done=lambda _: self.on_dimensions_loaded()
+            )
+    
+    @staticmethod
+    def scan_dimensions(token, progress, paths):
+        """后台任务：读取图片头中的尺寸，每批通过进度回调交回界面线程"""
+        batch = {}
+        for i, path in enumerate(paths, 1):
+            batch[path] = FileCatalog.read_dimensions(path)
+            if len(batch) >= 500 or i == len(paths):
+                progress(i, len(paths), batch)
+                batch = {}
+    
+    def on_dimensions_loaded(self):
+        """尺寸读取完成：仍按像素数排序时刷新视图"""
+        if self.sort_options[self.sort_var.get()] == 'pixels':
+            self.apply_file_view()
+    
+    def on_filter_changed(self, event=None):
+        """筛选输入防抖：停止输入 200 毫秒后再刷新"""
+        if self.filter_job:
+            self.after_cancel(self.filter_job)
+        self.filter_job = self.after(200, self.run_filter)
+    
+    def run_filter(self):
+        """执行筛选"""
+        self.filter_job = None
+        self.apply_file_view()
     
     def refresh_file_grid(self):
         """刷新文件网格显示"""
@@ -906,6 +4380,9 @@ class ModernImageApp(DnDCTk):
         for frame in self.file_frames:
             frame.destroy()
         self.file_frames.clear()
+        self.pending_thumbnails.clear()
+        self.jobs.cancel('thumbnails')
+        self.file_positions = {path: idx for idx, path in enumerate(self.files)}
         
         # 创建网格布局（每行4个）
         cols = 4
@@ -921,11 +4398,44 @@ class ModernImageApp(DnDCTk):
         # 配置列权重
         for c in range(cols):
             self.file_scroll_frame.grid_columnconfigure(c, weight=1)
+        
+        if self.pending_thumbnails:
+            self.jobs.submit(
+                self.decode_thumbnails, list(self.pending_thumbnails), (180, 180),
+                priority=8, key='thumbnails', label="生成缩略图",
+                on_progress=self.on_thumbnail_ready, on_done=lambda _: self.on_thumbnails_done()
+            )
+    
+    @staticmethod
+    def decode_thumbnails(token, progress, paths, max_size):
+        """后台任务：逐个解码缩略图，通过进度回调交回界面线程（失败时为 None）"""
+        for i, path in enumerate(paths):
+            try:
+                img = ImageProcessor.open_thumbnail(path, max_size)
+            except Exception:
+                img = None
+            progress(i + 1, len(paths), (path, img))
+    
+    def on_thumbnail_ready(self, done, total, payload):
+        """缩略图解码完成：在界面线程中创建 PhotoImage 并替换占位符"""
+        file_path, img = payload
+        card_frame = self.pending_thumbnails.pop(file_path, None)
+        if card_frame is None or not card_frame.winfo_exists():
+            return
+        img_label = card_frame.card_widgets['img_label']
+        if img is None:
+            # 如果加载失败，显示占位符
+            img_label.configure(text="❌\n无法加载")
+            return
+        thumb = ImageTk.PhotoImage(img)
+        self.thumbnail_cache[file_path] = thumb
+        img_label.configure(image=thumb, text="")
+        img_label.image = thumb  # 保持引用
     
     def create_file_card(self, file_path, index):
         """创建文件卡片"""
         # 主框架 - 移除固定高度，让其自适应内容
-        is_selected = index in self.selected_files
+        is_selected = file_path in self.selection
         card_frame = ctk.CTkFrame(
             self.file_scroll_frame,
             width=220,
@@ -939,29 +4449,22 @@ class ModernImageApp(DnDCTk):
         card_frame.card_index = index
         card_frame.card_widgets = {}
         
-        # 缩略图
-        try:
-            if file_path in self.thumbnail_cache:
-                thumb = self.thumbnail_cache[file_path]
-            else:
-                img = Image.open(file_path)
-                # 创建缩略图（保持宽高比）
-                img.thumbnail((180, 180), Image.Resampling.LANCZOS)
-                thumb = ImageTk.PhotoImage(img)
-                self.thumbnail_cache[file_path] = thumb
-            
+        # 缩略图：已缓存的直接显示，否则先放占位符，由后台任务逐个生成
+        if file_path in self.thumbnail_cache:
+            thumb = self.thumbnail_cache[file_path]
             img_label = ctk.CTkLabel(card_frame, image=thumb, text="")
             img_label.image = thumb  # 保持引用
-            img_label.pack(pady=(8, 3))
-            card_frame.card_widgets['img_label'] = img_label
-        except Exception as e:
-            # 如果加载失败，显示占位符
-            img_label = ctk.CTkLabel(card_frame, text="❌\n无法加载", font=("Arial", 12), height=100)
-            img_label.pack(pady=(8, 3))
-            card_frame.card_widgets['img_label'] = img_label
+        else:
+            img_label = ctk.CTkLabel(card_frame, text="⏳", font=("Arial", 12), height=100)
+            self.pending_thumbnails[file_path] = card_frame
+        img_label.pack(pady=(8, 3))
+        card_frame.card_widgets['img_label'] = img_label
         
-        # 文件名
+        # 文件名（相似图片标出分组）
         filename = os.path.basename(file_path)
+        record = self.catalog.get(file_path)
+        if record and record.dup_group:
+            filename = f"[相似 {record.dup_group}] {filename}"
         name_label = ctk.CTkLabel(
             card_frame,
             text=filename,
@@ -972,20 +4475,22 @@ class ModernImageApp(DnDCTk):
         name_label.pack(pady=(0, 3), padx=5)
         card_frame.card_widgets['name_label'] = name_label
         
-        # 选中标记（使用容器以便动态更新）
+        # 选中标记（常驻标签，切换状态时只改文字）
         check_container = ctk.CTkFrame(card_frame, fg_color="transparent", height=20)
         check_container.pack(pady=(0, 5), fill="x")
         check_container.pack_propagate(False)
         card_frame.card_widgets['check_container'] = check_container
         
-        if is_selected:
-            check_label = ctk.CTkLabel(check_container, text="✓ 已选中", font=("Arial", 9, "bold"), text_color="#4a9eff")
-            check_label.pack()
-            card_frame.card_widgets['check_label'] = check_label
+        check_label = ctk.CTkLabel(
+            check_container, text=("✓ 已选中" if is_selected else ""),
+            font=("Arial", 9, "bold"), text_color="#4a9eff"
+        )
+        check_label.pack()
+        card_frame.card_widgets['check_label'] = check_label
         
         # 绑定点击事件
         def on_click(event):
-            self.toggle_file_selection(index, event)
+            self.toggle_file_selection(file_path, event)
         
         card_frame.bind("<Button-1>", on_click)
         img_label.bind("<Button-1>", on_click)
@@ -999,7 +4504,7 @@ class ModernImageApp(DnDCTk):
             return
         
         card_frame = self.file_frames[index]
-        is_selected = index in self.selected_files
+        is_selected = self.files[index] in self.selection
         
         # 更新边框和背景色
         card_frame.configure(
@@ -1008,118 +4513,129 @@ class ModernImageApp(DnDCTk):
         )
         
         # 更新选中标记
-        check_container = card_frame.card_widgets.get('check_container')
-        if check_container:
-            # 清除旧的选中标记
-            if 'check_label' in card_frame.card_widgets:
-                card_frame.card_widgets['check_label'].destroy()
-                del card_frame.card_widgets['check_label']
-            
-            # 如果需要，添加新的选中标记
-            if is_selected:
-                check_label = ctk.CTkLabel(check_container, text="✓ 已选中", font=("Arial", 10, "bold"), text_color="#4a9eff")
-                check_label.pack()
-                card_frame.card_widgets['check_label'] = check_label
-    
-    def toggle_file_selection(self, index, event=None):
-        """切换文件选择状态"""
-        # 检查是否按住 Ctrl 键
-        ctrl_pressed = event and (event.state & 0x4)
-        
-        # 记录之前的选中状态，用于确定需要更新哪些卡片
-        old_selection = self.selected_files.copy()
-        
-        if not ctrl_pressed:
-            # 单选模式：清除其他选择
-            self.selected_files.clear()
-        
-        # 切换当前选择
-        if index in self.selected_files:
-            self.selected_files.remove(index)
-        else:
-            self.selected_files.add(index)
-        
-        # 只更新受影响的卡片，而不是刷新整个网格
-        # 计算哪些卡片的状态发生了变化
-        changed_indices = old_selection.symmetric_difference(self.selected_files)
-        
-        # 只更新变化的卡片
-        for idx in changed_indices:
-            self.update_card_selection_state(idx)
-        
-        # 更新统计信息
+        check_label = card_frame.card_widgets.get('check_label')
+        if check_label:
+            check_label.configure(text=("✓ 已选中" if is_selected else ""))
+    
+    def on_selection_changed(self, added, removed):
+        """选择变化时只重绘状态变化的卡片"""
+        for path in added | removed:
+            idx = self.file_positions.get(path)
+            if idx is not None:
+                self.update_card_selection_state(idx)
         self.update_stats()
     
+    def toggle_file_selection(self, path, event=None):
+        """切换文件选择状态：单击单选，Ctrl+单击多选，Shift+单击连选"""
+        state = event.state if event else 0
+        ctrl_pressed = state & 0x4
+        shift_pressed = state & 0x1
+        
+        if shift_pressed:
+            self.selection.select_range(self.files, path, extend=bool(ctrl_pressed))
+        elif ctrl_pressed:
+            self.selection.toggle(path)
+        else:
+            self.selection.select_only(path)
+    
     def add_images(self):
         """添加图片文件"""
         paths = filedialog.askopenfilenames(
             initialdir=self.folder,
-            filetypes=[('图片文件', '*.jpg *.jpeg *.png *.bmp *.tiff *.webp')]
+            filetypes=[('图片文件', '*.jpg *.jpeg *.png *.bmp *.tiff *.webp'), ('压缩包', '*.zip *.tar')]
         )
         if not paths:
             return
         
-        for p in paths:
-            if p not in self.files:
-                self.files.append(p)
-        
-        # 刷新网格显示
-        self.refresh_file_grid()
-        self.update_stats()
+        if self.catalog.add_many(expand_archives(paths)):
+            # 刷新网格显示
+            self.apply_file_view()
     
     def select_all(self):
         """全选"""
-        self.selected_files = set(range(len(self.files)))
-        self.refresh_file_grid()
-        self.update_stats()
+        self.selection.select_all(self.files)
     
     def invert_selection(self):
         """反选"""
-        all_indices = set(range(len(self.files)))
-        self.selected_files = all_indices - self.selected_files
-        self.refresh_file_grid()
-        self.update_stats()
+        self.selection.invert(self.files)
     
     def clear_selection(self):
         """清除选择"""
-        self.selected_files.clear()
-        self.refresh_file_grid()
-        self.update_stats()
+        self.selection.clear()
     
     def remove_selected(self):
         """移除选中项"""
-        if not self.selected_files:
+        if not self.selection:
             messagebox.showwarning("警告", "请先选择要移除的图片")
             return
         
-        # 从后向前删除
-        for idx in sorted(self.selected_files, reverse=True):
-            if 0 <= idx < len(self.files):
-                # 从缓存中删除
-                if self.files[idx] in self.thumbnail_cache:
-                    del self.thumbnail_cache[self.files[idx]]
-                del self.files[idx]
+        removed = self.selection.ordered(self.files)
+        for path in removed:
+            # 从缓存中删除
+            self.thumbnail_cache.pop(path, None)
+        self.catalog.remove(removed)
         
-        # 清空选择
-        self.selected_files.clear()
+        # 刷新显示，再把已移除的项从选择中去掉
+        self.apply_file_view()
+        self.selection.discard(removed)
+    
+    def find_duplicate_files(self):
+        """查找相似图片：按组排列，并选中每组中除第一张外的副本，便于直接移除"""
+        paths = self.catalog.view()
+        if not paths:
+            messagebox.showwarning("提示", "没有可检查的图片")
+            return
         
-        # 刷新显示
-        self.refresh_file_grid()
-        self.update_stats()
+        settings = ImageProcessor.dedupe
+        cache_path = settings.get('cache') or os.path.join(tempfile.gettempdir(), 'image_processor_hashes.db')
+        radius = int(settings.get('radius', 6))
+        
+        def scan(token, progress):
+            # SQLite 连接只能在创建它的线程中使用，因此在任务内打开
+            cache = HashCache(cache_path)
+            try:
+                return find_duplicates(paths, radius, cache, progress=progress)
+            finally:
+                cache.close()
+        
+        self.jobs.submit(
+            scan, priority=4, key='find_duplicates', label="查找相似图片",
+            on_done=self.on_duplicates_found,
+            on_error=lambda e: messagebox.showerror("错误", f"查找相似图片失败：{e}")
+        )
+    
+    def on_duplicates_found(self, groups):
+        """相似图片查找完成：按组排列并选中每组中多余的副本"""
+        self.catalog.set_groups(groups)
+        if not groups:
+            self.apply_file_view()
+            messagebox.showinfo("完成", "没有找到相似图片")
+            return
+        
+        self.sort_var.set("相似分组")
+        self.sort_reverse_var.set(False)
+        self.apply_file_view()
+        # 查找期间可能已移除了部分文件
+        extras = [p for group in groups for p in group[1:] if self.catalog.get(p)]
+        self.selection.replace(extras)
+        messagebox.showinfo(
+            "完成",
+            f"找到 {len(groups)} 组相似图片（共 {len(extras) + len(groups)} 张），"
+            f"已选中每组中多余的 {len(extras)} 张，可点击「移除选中项」去掉"
+        )
     
     def update_stats(self):
         """更新统计信息"""
-        total = len(self.files)
-        selected = len(self.selected_files)
-        self.stats_label.configure(
-            text=f"共 {total} 张图片\n已选中 {selected} 张"
-        )
+        total = len(self.catalog)
+        selected = len(self.selection)
+        text = f"共 {total} 张图片\n已选中 {selected} 张"
+        if len(self.files) != total:
+            text += f"\n筛选后显示 {len(self.files)} 张"
+        self.stats_label.configure(text=text)
     
     def get_selected_files(self):
-        """获取选中的文件"""
-        if not self.selected_files:
-            return []
-        return [self.files[i] for i in sorted(self.selected_files) if 0 <= i < len(self.files)]
+        """获取选中的文件（按列表顺序）"""
+        return self.selection.ordered(self.files)
     
     # ==================== 裁剪功能 ====================
     
@@ -1133,60 +4649,187 @@ class ModernImageApp(DnDCTk):
                 messagebox.showwarning("警告", "没有可用的图片")
                 return
         
-        try:
-            self.original_img = Image.open(selected[0])
-            self.display_crop_preview()
-        except Exception as e:
-            messagebox.showerror("错误", f"加载图片失败：{e}")
+        # 在后台解码：先交回缩小解码的预览，完整分辨率解码完成后再替换
+        self.crop_pyramid = None
+        self.jobs.submit(
+            self.decode_crop_preview, selected[0], priority=1, key='crop_preview', label="加载裁剪预览",
+            on_progress=lambda done, total, pyramid: self.show_crop_pyramid(pyramid),
+            on_done=self.show_crop_pyramid,
+            on_error=lambda e: messagebox.showerror("错误", f"加载图片失败：{e}")
+        )
     
-    def display_crop_preview(self):
-        """显示裁剪预览"""
-        if not self.original_img:
+    @staticmethod
+    def decode_crop_preview(token, progress, path):
+        """后台任务：先缩小解码（JPEG 在 DCT 阶段缩小）得到预览金字塔，再完整解码供放大查看"""
+        with ImageProcessor.source_file(path) as f, Image.open(f) as img:
+            size = img.size
+            preview = ImageProcessor.thumbnail(img, (2048, 2048))
+        pyramid = ImagePyramid(preview, size=size)
+        if preview.size == size:
+            return pyramid  # 图片不大于预览尺寸，已是完整分辨率
+        progress(1, 2, pyramid)
+        return ImagePyramid(ImageProcessor.open_image(path))
+    
+    def show_crop_pyramid(self, pyramid):
+        """显示后台解码的预览；首次显示时适应画布，替换为完整分辨率时保持当前视图"""
+        first = self.crop_pyramid is None
+        self.crop_pyramid = pyramid
+        self.crop_view_cache.clear()
+        if first:
+            self.fit_crop_view()
+        else:
+            self.schedule_crop_redraw(full=True, delay=0)
+    
+    def fit_crop_view(self):
+        """缩放预览以完整显示图片"""
+        if not self.crop_pyramid:
             return
         
-        # 获取画布大小
         canvas_w = self.crop_canvas.winfo_width()
         canvas_h = self.crop_canvas.winfo_height()
         
         if canvas_w <= 1 or canvas_h <= 1:
-            self.crop_canvas.after(100, self.display_crop_preview)
+            self.crop_canvas.after(100, self.fit_crop_view)
             return
         
-        # 计算缩放比例
-        img_w, img_h = self.original_img.size
+        img_w, img_h = self.crop_pyramid.size
         scale = min(canvas_w / img_w, canvas_h / img_h, 1.0)
         
-        new_w = int(img_w * scale)
-        new_h = int(img_h * scale)
+        # 居中显示
+        self.view_scale = scale
+        self.view_origin = (-(canvas_w - img_w * scale) / 2 / scale,
+                            -(canvas_h - img_h * scale) / 2 / scale)
+        self.schedule_crop_redraw(full=True, delay=0)
+    
+    def schedule_crop_redraw(self, full=False, delay=30):
+        """合并短时间内的多次重绘请求，只执行最后一次"""
+        self.crop_redraw_full = self.crop_redraw_full or full
+        if self.crop_redraw_job is not None:
+            self.crop_canvas.after_cancel(self.crop_redraw_job)
+        self.crop_redraw_job = self.crop_canvas.after(delay, self.run_crop_redraw)
+    
+    def run_crop_redraw(self):
+        """执行防抖后的重绘"""
+        self.crop_redraw_job = None
+        full, self.crop_redraw_full = self.crop_redraw_full, False
+        if full:
+            self.display_crop_preview()
+        else:
+            self.draw_crop_rect()
+    
+    def display_crop_preview(self):
+        """显示裁剪预览（只渲染可见区域，位图按画布尺寸和视图缓存）"""
+        if not self.crop_pyramid:
+            return
+        
+        # 获取画布大小
+        canvas_w = self.crop_canvas.winfo_width()
+        canvas_h = self.crop_canvas.winfo_height()
         
-        # 缩放图片
-        display_img = self.original_img.resize((new_w, new_h), Image.Resampling.LANCZOS)
-        self.canvas_image = ImageTk.PhotoImage(display_img)
+        if canvas_w <= 1 or canvas_h <= 1:
+            self.schedule_crop_redraw(full=True, delay=100)
+            return
         
-        # 显示图片
-        self.crop_canvas.delete("all")
-        offset_x = (canvas_w - new_w) // 2
-        offset_y = (canvas_h - new_h) // 2
-        self.crop_canvas.create_image(offset_x, offset_y, anchor="nw", image=self.canvas_image)
+        scale = self.view_scale
+        origin_x, origin_y = self.view_origin
+        img_w, img_h = self.crop_pyramid.size
+        
+        key = (canvas_w, canvas_h, scale, origin_x, origin_y)
+        cached = self.crop_view_cache.get(key)
+        if cached is None:
+            # 可见区域（源图坐标）
+            x0 = max(0.0, origin_x)
+            y0 = max(0.0, origin_y)
+            x1 = min(float(img_w), origin_x + canvas_w / scale)
+            y1 = min(float(img_h), origin_y + canvas_h / scale)
+            
+            if x1 > x0 and y1 > y0:
+                # 画布上的对应位置
+                left = round((x0 - origin_x) * scale)
+                top = round((y0 - origin_y) * scale)
+                out_w = max(1, round((x1 - origin_x) * scale) - left)
+                out_h = max(1, round((y1 - origin_y) * scale) - top)
+                
+                display_img = self.crop_pyramid.render((x0, y0, x1, y1), (out_w, out_h))
+                cached = (ImageTk.PhotoImage(display_img), left, top)
+            else:
+                cached = (None, 0, 0)
+            
+            self.crop_view_cache[key] = cached
+            while len(self.crop_view_cache) > 8:
+                self.crop_view_cache.popitem(last=False)
+        else:
+            self.crop_view_cache.move_to_end(key)
+        
+        # 复用画布中的图片项，只更新位置和位图
+        photo, left, top = cached
+        self.canvas_image = photo
+        if not self.crop_canvas.find_withtag("preview_img"):
+            self.crop_canvas.create_image(0, 0, anchor="nw", tags="preview_img")
+            self.crop_canvas.tag_lower("preview_img")
+        if photo is None:
+            self.crop_canvas.itemconfigure("preview_img", state="hidden")
+        else:
+            self.crop_canvas.itemconfigure("preview_img", image=photo, state="normal")
+            self.crop_canvas.coords("preview_img", left, top)
         
         # 存储用于坐标转换的信息
         self.canvas_scale = scale
-        self.canvas_offset = (offset_x, offset_y)
-        self.canvas_size = (new_w, new_h)
+        self.canvas_offset = (-origin_x * scale, -origin_y * scale)
         
         # 绘制裁剪框
         self.draw_crop_rect()
     
+    def on_crop_zoom(self, event):
+        """滚轮缩放（以鼠标位置为中心）"""
+        if not self.crop_pyramid:
+            return "break"
+        
+        if getattr(event, 'num', None) == 5 or getattr(event, 'delta', 0) < 0:
+            factor = 1 / 1.25
+        else:
+            factor = 1.25
+        
+        img_w, img_h = self.crop_pyramid.size
+        min_scale = min(self.crop_canvas.winfo_width() / img_w, self.crop_canvas.winfo_height() / img_h, 1.0) / 2
+        new_scale = max(min_scale, min(self.view_scale * factor, 32.0))
+        
+        # 保持鼠标下的源图像素不动
+        origin_x, origin_y = self.view_origin
+        src_x = origin_x + event.x / self.view_scale
+        src_y = origin_y + event.y / self.view_scale
+        self.view_scale = new_scale
+        self.view_origin = (src_x - event.x / new_scale, src_y - event.y / new_scale)
+        self.schedule_crop_redraw(full=True, delay=10)
+        return "break"
+    
+    def on_crop_pan_start(self, event):
+        """开始平移"""
+        self.pan_start = (event.x, event.y, self.view_origin)
+    
+    def on_crop_pan_drag(self, event):
+        """拖动平移"""
+        if not self.pan_start or not self.crop_pyramid:
+            return
+        
+        start_x, start_y, (origin_x, origin_y) = self.pan_start
+        self.view_origin = (origin_x - (event.x - start_x) / self.view_scale,
+                            origin_y - (event.y - start_y) / self.view_scale)
+        self.schedule_crop_redraw(full=True, delay=10)
+    
     def draw_crop_rect(self):
-        """根据裁剪值绘制矩形框"""
-        if not self.original_img or not hasattr(self, 'canvas_scale'):
+        """根据裁剪值更新矩形框（复用画布项，只修改坐标）"""
+        if not self.crop_pyramid or not hasattr(self, 'canvas_scale'):
             return
         
-        img_w, img_h = self.original_img.size
-        left = self.left_var.get()
-        top = self.top_var.get()
-        right = self.right_var.get()
-        bottom = self.bottom_var.get()
+        img_w, img_h = self.crop_pyramid.size
+        try:
+            left = self.left_var.get()
+            top = self.top_var.get()
+            right = self.right_var.get()
+            bottom = self.bottom_var.get()
+        except tk.TclError:
+            return  # 输入框内容暂时不是有效数字
         
         # 计算实际裁剪区域
         x1 = left
@@ -1194,7 +4837,13 @@ class ModernImageApp(DnDCTk):
         x2 = img_w - right
         y2 = img_h - bottom
         
+        if not self.crop_canvas.find_withtag("crop_rect"):
+            self.crop_canvas.create_rectangle(0, 0, 0, 0, outline="red", width=2, tags=("crop_rect", "crop_frame"))
+            for i in range(4):
+                self.crop_canvas.create_oval(0, 0, 0, 0, fill="red", tags=("crop_rect", f"crop_corner{i}"))
+        
         if x2 <= x1 or y2 <= y1:
+            self.crop_canvas.itemconfigure("crop_rect", state="hidden")
             return
         
         # 转换到画布坐标
@@ -1206,23 +4855,14 @@ class ModernImageApp(DnDCTk):
         canvas_x2 = x2 * scale + offset_x
         canvas_y2 = y2 * scale + offset_y
         
-        # 删除旧矩形
-        self.crop_canvas.delete("crop_rect")
-        
-        # 绘制新矩形
-        self.crop_canvas.create_rectangle(
-            canvas_x1, canvas_y1, canvas_x2, canvas_y2,
-            outline="red", width=2, tags="crop_rect"
-        )
+        self.crop_canvas.itemconfigure("crop_rect", state="normal")
+        self.crop_canvas.coords("crop_frame", canvas_x1, canvas_y1, canvas_x2, canvas_y2)
         
-        # 绘制角点
+        # 更新角点
         r = 5
-        for x, y in [(canvas_x1, canvas_y1), (canvas_x2, canvas_y1), 
-                     (canvas_x1, canvas_y2), (canvas_x2, canvas_y2)]:
-            self.crop_canvas.create_oval(
-                x-r, y-r, x+r, y+r,
-                fill="red", tags="crop_rect"
-            )
+        for i, (x, y) in enumerate([(canvas_x1, canvas_y1), (canvas_x2, canvas_y1),
+                                    (canvas_x1, canvas_y2), (canvas_x2, canvas_y2)]):
+            self.crop_canvas.coords(f"crop_corner{i}", x-r, y-r, x+r, y+r)
     
     def on_crop_mouse_down(self, event):
         """鼠标按下"""
@@ -1242,16 +4882,15 @@ class ModernImageApp(DnDCTk):
         if y2 < y1:
             y1, y2 = y2, y1
         
-        # 绘制临时矩形
-        self.crop_canvas.delete("temp_rect")
-        self.crop_canvas.create_rectangle(
-            x1, y1, x2, y2,
-            outline="yellow", width=2, tags="temp_rect"
-        )
+        # 更新临时矩形
+        if not self.crop_canvas.find_withtag("temp_rect"):
+            self.crop_canvas.create_rectangle(0, 0, 0, 0, outline="yellow", width=2, tags="temp_rect")
+        self.crop_canvas.itemconfigure("temp_rect", state="normal")
+        self.crop_canvas.coords("temp_rect", x1, y1, x2, y2)
     
     def on_crop_mouse_up(self, event):
         """鼠标松开"""
-        if not self.crop_start or not self.original_img or not hasattr(self, 'canvas_scale'):
+        if not self.crop_start or not self.crop_pyramid or not hasattr(self, 'canvas_scale'):
             return
         
         x1, y1 = self.crop_start
@@ -1267,13 +4906,13 @@ class ModernImageApp(DnDCTk):
         scale = self.canvas_scale
         offset_x, offset_y = self.canvas_offset
         
-        img_x1 = int((x1 - offset_x) / scale)
-        img_y1 = int((y1 - offset_y) / scale)
-        img_x2 = int((x2 - offset_x) / scale)
-        img_y2 = int((y2 - offset_y) / scale)
+        img_x1 = round((x1 - offset_x) / scale)
+        img_y1 = round((y1 - offset_y) / scale)
+        img_x2 = round((x2 - offset_x) / scale)
+        img_y2 = round((y2 - offset_y) / scale)
         
         # 限制范围
-        img_w, img_h = self.original_img.size
+        img_w, img_h = self.crop_pyramid.size
         img_x1 = max(0, min(img_x1, img_w))
         img_y1 = max(0, min(img_y1, img_h))
         img_x2 = max(0, min(img_x2, img_w))
@@ -1285,8 +4924,8 @@ class ModernImageApp(DnDCTk):
         self.right_var.set(img_w - img_x2)
         self.bottom_var.set(img_h - img_y2)
         
-        # 清除临时矩形
-        self.crop_canvas.delete("temp_rect")
+        # 隐藏临时矩形
+        self.crop_canvas.itemconfigure("temp_rect", state="hidden")
         
         # 重绘裁剪框
         self.draw_crop_rect()
@@ -1294,8 +4933,8 @@ class ModernImageApp(DnDCTk):
         self.crop_start = None
     
     def on_crop_values_changed(self, event):
-        """裁剪值改变时更新预览"""
-        self.draw_crop_rect()
+        """裁剪值改变时更新预览（输入过程中防抖）"""
+        self.schedule_crop_redraw(delay=150)
     
     def reset_crop_area(self):
         """重置裁剪区域"""
@@ -1318,22 +4957,129 @@ class ModernImageApp(DnDCTk):
         bottom = self.bottom_var.get()
         
         out_dir = os.path.join(self.folder, 'cropped')
-        os.makedirs(out_dir, exist_ok=True)
         
-        count = 0
-        for path in selected:
-            try:
-                with Image.open(path) as img:
-                    cropped = ImageProcessor.crop_image(img, left, top, right, bottom)
-                    if cropped:
-                        base = os.path.basename(path)
-                        save_path = os.path.join(out_dir, base)
-                        cropped.save(save_path, quality=95)
-                        count += 1
-            except Exception as e:
-                print(f"处理 {path} 时出错：{e}")
+        if self.crop_archive_var.get():
+            archive_path = out_dir + '.zip'
+            
+            def crop_to_archive(token, progress):
+                if ImageProcessor.memory:
+                    ImageProcessor.memory.reset_peak()
+                return ImageProcessor.crop_files_to_archive(
+                    selected, archive_path, left, top, right, bottom, 95, progress=progress
+                )
+            
+            self.jobs.submit(
+                crop_to_archive, priority=3, label="批量裁剪",
+                on_done=lambda count: messagebox.showinfo(
+                    "完成", f"成功裁剪 {count} 张图片\n保存位置：{archive_path}" + self.memory_report()
+                )
+            )
+            return
+        
+        def crop_all(token, progress):
+            os.makedirs(out_dir, exist_ok=True)
+            count = 0
+            skipped = 0
+            if ImageProcessor.memory:
+                ImageProcessor.memory.reset_peak()
+            # 并行裁剪，同时解码的图片总内存受预算限制；
+            # 中途取消时已完成的输出都已记入日志，再次运行会从断点继续
+            with BatchJournal(os.path.join(out_dir, '.crop_journal.jsonl')) as journal:
+                results = imap_bounded(
+                    lambda path: self.crop_one(journal, path, out_dir, left, top, right, bottom),
+                    selected, governor=ImageProcessor.memory
+                )
+                for i, (done, was_skipped) in enumerate(results):
+                    count += done
+                    skipped += was_skipped
+                    progress(i + 1, len(selected))
+            return count, skipped
+        
+        def on_done(result):
+            count, skipped = result
+            msg = f"成功裁剪 {count} 张图片"
+            if skipped:
+                msg += f"\n跳过未变化 {skipped} 张"
+            messagebox.showinfo("完成", f"{msg}\n保存位置：{out_dir}" + self.memory_report())
+        
+        self.jobs.submit(crop_all, priority=3, label="批量裁剪", on_done=on_done)
+    
+    def slice_selected(self):
+        """把选中的图片切成网格或固定尺寸的切片，保存到 sliced 文件夹"""
+        selected = self.get_selected_files()
+        if not selected:
+            messagebox.showwarning("警告", "请先选择要切片的图片")
+            return
+        try:
+            rows, cols, tile = self.slice_rows_var.get(), self.slice_cols_var.get(), self.slice_tile_var.get()
+        except tk.TclError:
+            messagebox.showwarning("提示", "行数、列数和切片边长必须是整数")
+            return
+        tile_size = (tile, tile) if tile > 0 else None
+        out_dir = os.path.join(self.folder, 'sliced')
         
-        messagebox.showinfo("完成", f"成功裁剪 {count} 张图片\n保存位置：{out_dir}")
+        def slice_all(token, progress):
+            count = 0
+            for i, path in enumerate(selected):
+                token.check()
+                try:
+                    count += ImageProcessor.slice_image(path, out_dir, rows, cols, tile_size)
+                except Exception as e:
+                    print(f"处理 {path} 时出错：{e}")
+                progress(i + 1, len(selected))
+            return count
+        
+        self.jobs.submit(
+            slice_all, priority=3, label="大图切片",
+            on_done=lambda count: messagebox.showinfo("完成", f"共生成 {count} 张切片\n保存位置：{out_dir}")
+        )
+    
+    def save_crop_recipe(self):
+        """把当前裁剪设置保存为处理方案，供命令行 watch 监视文件夹使用"""
+        path = filedialog.asksaveasfilename(
+            defaultextension='.json', filetypes=[('处理方案', '*.json')], initialfile='recipe.json'
+        )
+        if not path:
+            return
+        crop = [self.left_var.get(), self.top_var.get(), self.right_var.get(), self.bottom_var.get()]
+        try:
+            FolderWatcher.save_recipe(path, {"crop": crop, "quality": 95})
+        except OSError as e:
+            messagebox.showerror("错误", f"保存失败：{e}")
+            return
+        messagebox.showinfo(
+            "完成", f"处理方案已保存到：\n{path}\n\n"
+                    f"启动监视：python image_processor.py watch --recipe \"{path}\" -o 输出目录 输入目录"
+        )
+    
+    @staticmethod
+    def memory_report():
+        """批处理完成提示中附带的内存统计"""
+        if ImageProcessor.memory is None:
+            return ""
+        return "\n" + ImageProcessor.memory.report()
+    
+    @staticmethod
+    def crop_one(journal, path, out_dir, left, top, right, bottom):
+        """裁剪单张图片（在工作线程中执行），返回 (是否生成输出, 是否跳过)"""
+        base = os.path.basename(path)
+        save_path = os.path.join(out_dir, base)
+        try:
+            key = BatchJournal.make_key(ImageProcessor.file_signature(path), left, top, right, bottom, 95)
+            
+            # 输入和参数都没变、输出仍完好的项目直接跳过
+            if journal.is_done(save_path, key):
+                return 0, 1
+            
+            with ImageProcessor.source_file(path) as f, Image.open(f) as img:
+                cropped = ImageProcessor.crop_image(img, left, top, right, bottom)
+                if cropped:
+                    ImageProcessor.save_atomic(cropped, save_path, quality=95)
+                    journal.record(save_path, key, src=path)
+                    return 1, 0
+        except Exception as e:
+            print(f"处理 {path} 时出错：{e}")
+        return 0, 0
     
     # ==================== 拼接功能 ====================
     
@@ -1368,14 +5114,14 @@ class ModernImageApp(DnDCTk):
                 return None
         
         try:
-            images = [Image.open(p).convert('RGB') for p in paths]
+            images = [ImageProcessor.open_image(p) for p in paths]
             return images
         except Exception as e:
             messagebox.showerror("错误", f"加载图片失败：{e}")
             return None
     
     def generate_stitch_preview(self):
-        """生成拼接预览"""
+        """生成拼接预览（后台执行，重复点击只保留最后一次）"""
         # 如果用户还没有刷新列表，自动刷新
         if not self.stitch_image_order:
             self.refresh_stitch_list()
@@ -1385,70 +5131,77 @@ class ModernImageApp(DnDCTk):
             messagebox.showwarning("提示", "没有可拼接的图片")
             return
         
-        # 从顺序列表获取图片路径
+        # 从顺序列表获取图片路径；界面参数在界面线程中读取
         image_paths = [path for path, _ in self.stitch_image_order]
-        
-        try:
-            images = [Image.open(p).convert('RGB') for p in image_paths]
-        except Exception as e:
-            messagebox.showerror("错误", f"加载图片失败：{e}")
-            return
-        
-        if not images:
+        bg_color = tuple(int(self.bg_color.lstrip('#')[i:i+2], 16) for i in (0, 2, 4))
+        spacing = self.spacing_var.get()
+        mode = self.stitch_mode.get()
+        rows = self.rows_var.get()
+        cols = self.cols_var.get()
+        cell = self.cell_size_var.get()
+        crop = self.get_stitch_crop()
+        if crop and mode == "contact":
+            messagebox.showwarning("提示", "联系表不支持直接应用裁剪设置，请先导出裁剪结果")
             return
-        
-        try:
-            # 解析背景颜色
-            bg_color = tuple(int(self.bg_color.lstrip('#')[i:i+2], 16) for i in (0, 2, 4))
-            
-            spacing = self.spacing_var.get()
-            mode = self.stitch_mode.get()
-            
-            # 生成拼接图
-            if mode == "grid":
-                rows = self.rows_var.get()
-                cols = self.cols_var.get()
-                result = ImageProcessor.stitch_images_grid(images, rows, cols, spacing, bg_color)
-            elif mode == "horizontal":
-                result = ImageProcessor.stitch_images_horizontal(images, spacing, bg_color)
-            else:  # vertical
-                result = ImageProcessor.stitch_images_vertical(images, spacing, bg_color)
-            
-            if not result:
-                messagebox.showerror("错误", "拼接失败")
-                return
-            
-            # 保存结果用于导出
-            self.stitch_result = result
-            
-            # 显示预览（缩略图）
-            canvas_w = self.stitch_canvas.winfo_width()
-            canvas_h = self.stitch_canvas.winfo_height()
-            
-            if canvas_w <= 1 or canvas_h <= 1:
-                canvas_w, canvas_h = 800, 600
+        canvas_w = self.stitch_canvas.winfo_width()
+        canvas_h = self.stitch_canvas.winfo_height()
+        if canvas_w <= 1 or canvas_h <= 1:
+            canvas_w, canvas_h = 800, 600
+        
+        def build(token, progress):
+            if mode == "contact":
+                # 联系表只预览第一页
+                page_rows, page_cols = ImageProcessor.contact_grid(rows, cols)
+                per_page = page_rows * page_cols
+                result = ImageProcessor.render_contact_page(
+                    image_paths[:per_page], page_rows, page_cols, (cell, cell), spacing, bg_color, 'interactive'
+                )
+                info = f"第 1 页，共 {math.ceil(len(image_paths) / per_page)} 页"
+            else:
+                result, info = build_stitch(token, progress), ""
+            token.check()
             
             # 计算缩放比例
             scale = min(canvas_w / result.width, canvas_h / result.height, 1.0)
-            preview_w = int(result.width * scale)
-            preview_h = int(result.height * scale)
+            preview_w = max(1, int(result.width * scale))
+            preview_h = max(1, int(result.height * scale))
+            preview = ImageProcessor.resize(result, (preview_w, preview_h), 'interactive')
+            return preview, result.size, info
+        
+        def build_stitch(token, progress):
+            pipe = Pipeline(image_paths)
+            if crop:
+                pipe = pipe.crop(*crop)
+            
+            def report(done, total):
+                token.check()
+                progress(done, total)
             
-            preview = result.resize((preview_w, preview_h), Image.Resampling.LANCZOS)
+            # 生成拼接图（预览用交互档位，导出时再按高质量重新生成）
+            result = pipe.stitch(mode, rows, cols, spacing, bg_color).render(tier='interactive', progress=report)
+            if not result:
+                raise ValueError("拼接失败")
+            return result
+        
+        def on_done(value):
+            preview, (width, height), info = value
             self.stitch_preview_img = ImageTk.PhotoImage(preview)
             
             # 显示
             self.stitch_canvas.delete("all")
-            offset_x = (canvas_w - preview_w) // 2
-            offset_y = (canvas_h - preview_h) // 2
+            offset_x = (canvas_w - preview.width) // 2
+            offset_y = (canvas_h - preview.height) // 2
             self.stitch_canvas.create_image(offset_x, offset_y, anchor="nw", image=self.stitch_preview_img)
             
-            messagebox.showinfo("完成", f"预览已生成\n尺寸：{result.width} x {result.height} 像素")
-            
-        except Exception as e:
-            messagebox.showerror("错误", f"生成预览失败：{e}")
+            messagebox.showinfo("完成", f"预览已生成\n尺寸：{width} x {height} 像素" + (f"\n{info}" if info else ""))
+        
+        self.jobs.submit(
+            build, priority=2, key='stitch_preview', label="生成拼接预览", on_done=on_done,
+            on_error=lambda e: messagebox.showerror("错误", f"生成预览失败：{e}")
+        )
     
     def export_stitch_image(self):
-        """导出拼接图片"""
+        """导出拼接图片（后台执行）"""
         # 如果用户还没有刷新列表，自动刷新
         if not self.stitch_image_order:
             self.refresh_stitch_list()
@@ -1460,55 +5213,269 @@ class ModernImageApp(DnDCTk):
         # 从顺序列表获取图片路径
         image_paths = [path for path, _ in self.stitch_image_order]
         
-        try:
-            images = [Image.open(p).convert('RGB') for p in image_paths]
-        except Exception as e:
-            messagebox.showerror("错误", f"加载图片失败：{e}")
-            return
+        # 选择保存位置
+        out_dir = os.path.join(self.folder, 'stitched')
+        os.makedirs(out_dir, exist_ok=True)
         
-        if not images:
+        save_path = filedialog.asksaveasfilename(
+            defaultextension='.jpg',
+            filetypes=[('JPEG', '*.jpg'), ('PNG', '*.png'), ('PDF（联系表多页）', '*.pdf'),
+                       ('TIFF（联系表多页）', '*.tif'), ('ZIP 压缩包（联系表）', '*.zip'),
+                       ('DeepZoom 瓦片金字塔', '*.dzi')],
+            initialfile='stitched.jpg',
+            initialdir=out_dir
+        )
+        if not save_path:
+            return
+        save_path = os.path.abspath(save_path)
+        
+        # 解析背景颜色
+        bg_color = tuple(int(self.bg_color.lstrip('#')[i:i+2], 16) for i in (0, 2, 4))
+        spacing = self.spacing_var.get()
+        mode = self.stitch_mode.get()
+        rows = self.rows_var.get()
+        cols = self.cols_var.get()
+        cell = self.cell_size_var.get()
+        crop = self.get_stitch_crop()
+        is_dzi = save_path.lower().endswith('.dzi')
+        
+        if is_dzi and mode == "vertical_overlap":
+            # 去重叠需要先解码像素比较，无法只按图片头规划布局
+            messagebox.showwarning("提示", "去重叠拼接不支持导出 DZI，请导出为普通图片")
+            return
+        if is_dzi and mode == "contact":
+            messagebox.showwarning("提示", "联系表请导出为 JPEG / PNG（按页编号）或多页 PDF / TIFF")
+            return
+        if mode != "contact" and (ImageProcessor.format_for_path(save_path) == 'PDF'
+                                  or ArchiveWriter.is_archive(save_path)):
+            messagebox.showwarning("提示", "PDF 和压缩包仅用于联系表模式，请选择 JPEG / PNG / TIFF")
+            return
+        if crop and (is_dzi or mode == "contact"):
+            messagebox.showwarning("提示", "联系表和 DZI 不支持直接应用裁剪设置，请先导出裁剪结果")
             return
         
-        try:
-            # 解析背景颜色
-            bg_color = tuple(int(self.bg_color.lstrip('#')[i:i+2], 16) for i in (0, 2, 4))
-            
-            spacing = self.spacing_var.get()
-            mode = self.stitch_mode.get()
-            
-            # 生成高清拼接图
-            if mode == "grid":
-                rows = self.rows_var.get()
-                cols = self.cols_var.get()
-                result = ImageProcessor.stitch_images_grid(images, rows, cols, spacing, bg_color)
-            elif mode == "horizontal":
-                result = ImageProcessor.stitch_images_horizontal(images, spacing, bg_color)
+        def export(token, progress):
+            # 增量构建：输入文件和参数都没变时无需重新生成
+            key = BatchJournal.make_key(
+                [ImageProcessor.file_signature(p) for p in image_paths], mode, rows, cols, spacing, bg_color, 95, cell,
+                crop
+            )
+            # 联系表按页编号保存时，实际输出是各页文件而不是 save_path
+            if mode == "contact":
+                outputs = ImageProcessor.contact_sheet_outputs(save_path, len(image_paths), rows, cols)
             else:
-                result = ImageProcessor.stitch_images_vertical(images, spacing, bg_color)
-            
-            if result:
-                # 保存文件
-                out_dir = os.path.join(self.folder, 'stitched')
-                os.makedirs(out_dir, exist_ok=True)
+                outputs = [save_path]
+            # 日志放在临时目录中，按输出的绝对路径记录，不在用户选择的保存位置留下额外文件
+            journal_path = os.path.join(tempfile.gettempdir(), 'image_processor_stitch_journal.jsonl')
+            with BatchJournal(journal_path) as journal:
+                if outputs and all(journal.is_done(p, key) for p in outputs):
+                    return f"输出已是最新，无需重新生成：\n{save_path}"
                 
-                save_path = filedialog.asksaveasfilename(
-                    defaultextension='.jpg',
-                    filetypes=[('JPEG', '*.jpg'), ('PNG', '*.png')],
-                    initialfile='stitched.jpg',
-                    initialdir=out_dir
-                )
+                if mode == "contact":
+                    pages = ImageProcessor.export_contact_sheets(
+                        image_paths, save_path, rows, cols, (cell, cell), spacing, bg_color, 95, progress=progress
+                    )
+                    for p in outputs:
+                        journal.record(p, key, pages=pages)
+                    return f"联系表已保存（共 {pages} 页）：\n{save_path}"
                 
-                if save_path:
-                    result.save(save_path, quality=95)
-                    messagebox.showinfo("完成", f"图片已保存到：\n{save_path}")
-        except Exception as e:
-            messagebox.showerror("错误", f"导出失败：{e}")
+                if is_dzi:
+                    msg = self.export_stitch_deepzoom(image_paths, save_path, mode, rows, cols, spacing, bg_color)
+                    journal.record(save_path, key)
+                    return msg
+                
+                pipe = Pipeline(image_paths)
+                if crop:
+                    pipe = pipe.crop(*crop)
+                
+                def report(done, total):
+                    token.check()
+                    progress(done, total)
+                
+                # 生成高清拼接图（PNG 等格式保留透明通道），裁剪结果只在内存中传递
+                if not pipe.stitch(mode, rows, cols, spacing, bg_color).save(save_path, 95, progress=report):
+                    raise ValueError("拼接失败")
+                journal.record(save_path, key)
+                return f"图片已保存到：\n{save_path}"
+        
+        self.jobs.submit(
+            export, priority=3, key='stitch_export', label="导出拼接图",
+            on_done=lambda msg: messagebox.showinfo("完成", msg),
+            on_error=lambda e: messagebox.showerror("错误", f"导出失败：{e}")
+        )
+    
+    @staticmethod
+    def export_stitch_deepzoom(image_paths, save_path, mode, rows, cols, spacing, bg_color):
+        """导出为 DeepZoom 瓦片金字塔（只读取图片头，不生成完整大图），返回完成提示"""
+        sizes = []
+        for p in image_paths:
+            with ImageProcessor.source_file(p) as f, Image.open(f) as img:
+                sizes.append(img.size)
+        
+        layout = ImageProcessor.plan_stitch_layout(sizes, mode, rows, cols, spacing)
+        levels = ImageProcessor.export_deepzoom(image_paths, layout, save_path, bg_color)
+        return f"瓦片金字塔已保存到：\n{save_path}\n尺寸：{layout[0]} x {layout[1]} 像素，共 {levels} 层"
+
+
+def collect_image_paths(inputs):
+    """展开命令行输入（文件或文件夹）为图片路径列表"""
+    valid = ('.jpg', '.jpeg', '.png', '.bmp', '.tiff', '.webp')
+    paths = []
+    for p in inputs:
+        if os.path.isdir(p):
+            paths.extend(sorted(os.path.join(p, f) for f in os.listdir(p) if f.lower().endswith(valid)))
+        else:
+            paths.append(p)
+    # 压缩包展开为其中的图片（以「压缩包::成员」路径直接读取）
+    return [ArchiveReader.abspath(p) for p in expand_archives(paths)]
 
 
-def main():
-    """主函数"""
-    app = ModernImageApp()
-    app.mainloop()
+def main(argv=None):
+    """主函数：无参数时启动图形界面，否则执行命令行子命令"""
+    imports_done = time.perf_counter() - STARTUP_T0
+    import argparse
+    
+    parser = argparse.ArgumentParser(description="图片批处理工具")
+    sub = parser.add_subparsers(dest='command')
+    
+    p = sub.add_parser('submit', help="把批处理任务切块提交到共享队列")
+    p.add_argument('--db', required=True, help="队列数据库文件（放在共享目录）")
+    p.add_argument('--op', choices=['crop', 'stitch'], required=True)
+    p.add_argument('--params', default='{}', help="操作参数 JSON，例如 {\"left\": 10, \"out_dir\": \"...\"}")
+    p.add_argument('--chunk-size', type=int, default=50, help="每块包含的项目数")
+    p.add_argument('--group-size', type=int, default=0, help="拼接：每张输出包含的图片数（0=全部）")
+    p.add_argument('inputs', nargs='+', help="图片文件或文件夹")
+    
+    p = sub.add_parser('worker', help="从共享队列领取并执行任务")
+    p.add_argument('--db', required=True)
+    p.add_argument('--id', default=None, help="工作进程名称（默认 主机名-进程号）")
+    p.add_argument('--lease', type=float, default=300, help="租约秒数")
+    p.add_argument('--spawn', type=int, default=1, help="在本机启动的工作进程数")
+    
+    p = sub.add_parser('status', help="查看队列进度")
+    p.add_argument('--db', required=True)
+    
+    p = sub.add_parser('contact', help="生成分页联系表（编号图片或多页 PDF / TIFF）")
+    p.add_argument('-o', '--out', required=True, help="输出文件：.pdf / .tif 为多页文件，.zip / .tar 为压缩包，其他格式按页编号")
+    p.add_argument('--rows', type=int, default=6, help="每页行数")
+    p.add_argument('--cols', type=int, default=4, help="每页列数")
+    p.add_argument('--cell', type=int, default=300, help="单元格边长（像素）")
+    p.add_argument('--spacing', type=int, default=10)
+    p.add_argument('--quality', type=int, default=90)
+    p.add_argument('--workers', type=int, default=None, help="并行渲染的线程数（默认 CPU 核数）")
+    p.add_argument('inputs', nargs='+', help="图片文件或文件夹")
+    
+    p = sub.add_parser('slice', help="把大图切成网格或固定尺寸的切片（TIFF / PNG 逐条解码，JPEG 等格式需完整解码一次）")
+    p.add_argument('-o', '--out', required=True, help="输出目录，或 .zip / .tar 压缩包")
+    p.add_argument('--rows', type=int, default=2, help="均分的行数")
+    p.add_argument('--cols', type=int, default=2, help="均分的列数")
+    p.add_argument('--tile', default=None, help="固定切片尺寸，如 512 或 1024x768（指定后忽略行列数）")
+    p.add_argument('--format', default=None, help="切片格式扩展名（默认 JPEG 源图输出 jpg，其他输出 png）")
+    p.add_argument('--quality', type=int, default=95)
+    p.add_argument('--workers', type=int, default=None, help="并行编码的线程数（默认 CPU 核数）")
+    p.add_argument('inputs', nargs='+', help="图片文件或文件夹")
+    
+    p = sub.add_parser('watch', help="监视文件夹，按处理方案自动处理新到达的图片")
+    p.add_argument('--recipe', required=True, help="处理方案 JSON（可在界面的裁剪选项卡中保存）")
+    p.add_argument('-o', '--out', required=True, help="输出目录")
+    p.add_argument('--config', default=None, help="配置文件（默认程序目录下的 config.json）")
+    p.add_argument('--workers', type=int, default=None, help="并行处理的线程数（默认 CPU 核数）")
+    p.add_argument('--once', action='store_true', help="处理完当前已有的文件后退出")
+    p.add_argument('input', help="输入（热文件夹）目录")
+    
+    p = sub.add_parser('serve', help="启动本地 HTTP 服务，提供裁剪和拼接接口")
+    p.add_argument('--config', default=None, help="配置文件（默认程序目录下的 config.json）")
+    p.add_argument('--host', default=None)
+    p.add_argument('--port', type=int, default=None)
+    
+    parser.add_argument('--profile-startup', action='store_true', help="启动图形界面并输出各阶段耗时后退出")
+    
+    args = parser.parse_args(argv)
+    config = load_config(getattr(args, 'config', None))
+    ImageProcessor.configure(config)
+    
+    if args.command == 'submit':
+        params = json.loads(args.params)
+        paths = collect_image_paths(args.inputs)
+        out_dir = os.path.abspath(params.setdefault('out_dir', 'cropped' if args.op == 'crop' else 'stitched'))
+        params['out_dir'] = out_dir
+        os.makedirs(out_dir, exist_ok=True)
+        if args.op == 'crop':
+            items = paths
+        else:
+            size = args.group_size or len(paths)
+            ext = params.get('format', 'jpg')
+            items = [
+                {'inputs': paths[i:i + size], 'out': os.path.join(out_dir, f"stitched_{i // size + 1:04d}.{ext}")}
+                for i in range(0, len(paths), size)
+            ]
+        queue = WorkQueue(args.db)
+        job_id = queue.submit(args.op, params, items, args.chunk_size)
+        print(f"已提交任务 {job_id}：{len(items)} 项，{queue.status()['pending']} 块待处理")
+        queue.close()
+    elif args.command == 'worker':
+        if args.spawn > 1:
+            import multiprocessing
+            procs = [
+                multiprocessing.Process(target=run_worker, args=(args.db, None, args.lease))
+                for _ in range(args.spawn)
+            ]
+            for proc in procs:
+                proc.start()
+            for proc in procs:
+                proc.join()
+        else:
+            run_worker(args.db, args.id, args.lease)
+    elif args.command == 'status':
+        queue = WorkQueue(args.db)
+        print(json.dumps(queue.status(), ensure_ascii=False))
+        queue.close()
+    elif args.command == 'contact':
+        paths = collect_image_paths(args.inputs)
+        pages = ImageProcessor.export_contact_sheets(
+            paths, args.out, args.rows, args.cols, (args.cell, args.cell), args.spacing,
+            quality=args.quality, workers=args.workers,
+            progress=lambda done, total: print(f"\r已完成 {done}/{total} 页", end='', flush=True)
+        )
+        print(f"\n共 {len(paths)} 张图片，{pages} 页")
+    elif args.command == 'slice':
+        tile_size = None
+        if args.tile:
+            w, _, h = args.tile.lower().partition('x')
+            tile_size = (int(w), int(h or w))
+        paths = collect_image_paths(args.inputs)
+        if ArchiveWriter.is_archive(args.out) and len(paths) > 1:
+            parser.error("输出到压缩包时一次只能切一张图片")
+        count = 0
+        for path in paths:
+            # 切片文件名以源文件名开头，多张图片可以输出到同一目录
+            count += ImageProcessor.slice_image(
+                path, args.out, args.rows, args.cols, tile_size, args.format, args.quality, args.workers,
+                progress=lambda done, total: print(f"\r{os.path.basename(path)}：{done}/{total}", end='', flush=True)
+            )
+            print()
+        print(f"共 {len(paths)} 张图片，{count} 张切片")
+    elif args.command == 'watch':
+        watch_config = config['watch']
+        watcher = FolderWatcher(
+            args.input, args.out, FolderWatcher.load_recipe(args.recipe),
+            float(watch_config['settle_seconds']), float(watch_config['poll_interval']),
+            int(watch_config['batch_max']), int(watch_config['max_retries']), args.workers
+        )
+        print(f"正在监视 {os.path.abspath(args.input)}，输出到 {os.path.abspath(args.out)}（Ctrl+C 退出）")
+        try:
+            watcher.run(once=args.once)
+        except KeyboardInterrupt:
+            pass
+        print(watcher.report())
+    elif args.command == 'serve':
+        server_config = config['server']
+        service = ImageService(server_config)
+        service.serve_forever(args.host or server_config['host'], args.port or server_config['port'])
+    else:
+        app = ModernImageApp(profile_startup=args.profile_startup)
+        app.startup_times['imports'] = imports_done
+        app.mainloop()
 
 
 if __name__ == '__main__':
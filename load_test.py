@@ -0,0 +1,128 @@
+"""
+HTTP 服务压测脚本
+向本机 `python image_processor.py serve` 启动的服务并发发送请求，统计吞吐量、延迟和拒绝数
+
+用法：
+    python load_test.py --concurrency 8 --requests 200
+    python load_test.py --endpoint stitch --image a.jpg --image b.jpg
+"""
+
+import io
+import time
+import uuid
+import argparse
+import threading
+import urllib.error
+import urllib.request
+from collections import Counter
+
+from PIL import Image
+
+
+def make_sample_image(width=1920, height=1080):
+    """生成一张测试用 JPEG"""
+    img = Image.new('RGB', (width, height))
+    # 渐变填充，避免纯色图被编码器过度压缩
+    img.putdata([((x * 255) // width, (y * 255) // height, 128)
+                 for y in range(0, height) for x in range(0, width)])
+    buf = io.BytesIO()
+    img.save(buf, format='JPEG', quality=90)
+    return buf.getvalue()
+
+
+def build_multipart(images):
+    """把多张图片编码为 multipart/form-data 请求体"""
+    boundary = uuid.uuid4().hex
+    parts = []
+    for i, data in enumerate(images):
+        parts.append(
+            f"--{boundary}\r\n"
+            f'Content-Disposition: form-data; name="image"; filename="{i}.jpg"\r\n'
+            "Content-Type: image/jpeg\r\n\r\n".encode('utf-8') + data + b"\r\n"
+        )
+    parts.append(f"--{boundary}--\r\n".encode('utf-8'))
+    return b"".join(parts), f"multipart/form-data; boundary={boundary}"
+
+
+def percentile(values, p):
+    """计算百分位数"""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[k]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="图片批处理 HTTP 服务压测")
+    parser.add_argument('--url', default='http://127.0.0.1:8765')
+    parser.add_argument('--endpoint', choices=['crop', 'stitch'], default='crop')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=100)
+    parser.add_argument('--image', action='append', help="测试图片（可重复），默认自动生成")
+    parser.add_argument('--timeout', type=float, default=120)
+    args = parser.parse_args()
+
+    if args.image:
+        images = []
+        for path in args.image:
+            with open(path, 'rb') as f:
+                images.append(f.read())
+    else:
+        images = [make_sample_image()]
+
+    if args.endpoint == 'crop':
+        url = f"{args.url}/crop?left=100&top=100&right=100&bottom=100&format=jpg"
+        body, content_type = images[0], 'application/octet-stream'
+    else:
+        if len(images) == 1:
+            images = images * 4
+        url = f"{args.url}/stitch?mode=grid&cols=2&spacing=10&format=jpg"
+        body, content_type = build_multipart(images)
+
+    latencies = []
+    codes = Counter()
+    lock = threading.Lock()
+    remaining = [args.requests]
+
+    def worker():
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    return
+                remaining[0] -= 1
+            req = urllib.request.Request(url, data=body, method='POST',
+                                         headers={'Content-Type': content_type})
+            start = time.perf_counter()
+            try:
+                with urllib.request.urlopen(req, timeout=args.timeout) as resp:
+                    resp.read()
+                    code = resp.status
+            except urllib.error.HTTPError as e:
+                code = e.code
+            except Exception as e:
+                code = type(e).__name__
+            elapsed = time.perf_counter() - start
+            with lock:
+                codes[code] += 1
+                if code == 200:
+                    latencies.append(elapsed)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(args.concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    total = time.perf_counter() - start
+
+    print(f"接口：{url}")
+    print(f"请求：{args.requests}，并发：{args.concurrency}，请求体：{len(body) / 1024:.0f} KB")
+    print(f"耗时：{total:.2f} s，成功吞吐：{len(latencies) / total:.1f} 请求/秒")
+    print(f"延迟（成功请求）：p50 {percentile(latencies, 50) * 1000:.0f} ms，"
+          f"p95 {percentile(latencies, 95) * 1000:.0f} ms，p99 {percentile(latencies, 99) * 1000:.0f} ms")
+    print("状态码：" + "，".join(f"{k}: {v}" for k, v in sorted(codes.items(), key=str)))
+
+
+if __name__ == '__main__':
+    main()
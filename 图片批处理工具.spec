@@ -15,16 +15,21 @@ binaries += tmp_ret[1]
 hiddenimports += tmp_ret[2]
 
 # 收集其他依赖
+# 只打包用到的 PIL 格式插件（Pillow 在首次打开/保存时按需加载），不再收集全部 PIL 和 tkinter 子模块
 datas += collect_data_files('darkdetect')
-hiddenimports += collect_submodules('PIL')
-hiddenimports += collect_submodules('tkinter')
 hiddenimports += [
     'PIL._imaging', 
     'PIL._tkinter_finder',
     'PIL.Image',
     'PIL.ImageTk',
-    'PIL.ImageDraw',
-    'PIL.ImageFont',
+    'PIL.BmpImagePlugin',
+    'PIL.GifImagePlugin',
+    'PIL.JpegImagePlugin',
+    'PIL.PngImagePlugin',
+    'PIL.PpmImagePlugin',
+    'PIL.TiffImagePlugin',
+    'PIL.WebPImagePlugin',
+    'PIL.PdfImagePlugin',
     'darkdetect',
     'packaging',
     'packaging.version',
@@ -32,6 +37,9 @@ hiddenimports += [
     'packaging.requirements',
     'tkinter',
     'tkinter.ttk',
+    'tkinter.filedialog',
+    'tkinter.messagebox',
+    'tkinter.colorchooser',
     '_tkinter',
 ]
 
@@ -44,7 +52,7 @@ a = Analysis(
     hookspath=[],
     hooksconfig={},
     runtime_hooks=[],
-    excludes=['matplotlib', 'numpy', 'pandas', 'scipy'],
+    excludes=['matplotlib', 'pandas', 'scipy', 'PIL.ImageQt', 'PIL.ImageShow', 'tkinter.test', 'pydoc'],
     noarchive=False,
     optimize=0,
 )